@@ -0,0 +1,103 @@
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+class AnswerCache:
+  """
+    Answers (the final chat completion) to first turn queries, reused for later queries that mean nearly the same
+    thing, i.e. whose embeddings are at least `similarity` (cosine) similar, and that were answered from exactly the
+    same context: the same course info under the same filters. The context check keeps a similar sounding question
+    that retrieval sent somewhere else (a new term, different filters) from getting the old answer.
+
+    Entries last `ttl` seconds, the least recently used go once there are more than `max_entries`, and the whole
+    cache is dropped when the vector index version it was filled under is swapped out.
+  """
+
+  def __init__(self, max_entries=1024, ttl=3600.0, similarity=0.92):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.similarity = similarity
+
+    # Entry id -> {"embedding", "context", "created", "response"}, least recently used first
+    self.entries = OrderedDict()
+    # Context hash -> ids of the entries answered from it, so a lookup only compares against those
+    self.by_context = {}
+    self.next_id = 0
+    self.version = None
+    self.lock = threading.Lock()
+    self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+
+  def get(self, embedding, info, filters, version):
+    """The cached response for a query embedded as `embedding` and answered from `info` under `filters`, or None."""
+    (embedding, context) = (unit(embedding), context_hash(info, filters))
+    now = time.time()
+    with self.lock:
+      self.__check_version(version)
+      (best, best_similarity) = (None, self.similarity)
+      for entry_id in list(self.by_context.get(context, ())):
+        entry = self.entries[entry_id]
+        if now - entry["created"] > self.ttl:
+          self.__remove(entry_id)
+          self.counters["expired"] += 1
+          continue
+        similarity = float(entry["embedding"] @ embedding)
+        if similarity >= best_similarity:
+          (best, best_similarity) = (entry_id, similarity)
+
+      if best is None:
+        self.counters["misses"] += 1
+        return None
+      self.entries.move_to_end(best)
+      self.counters["hits"] += 1
+      return self.entries[best]["response"]
+
+  def put(self, embedding, info, filters, version, response):
+    """Caches `response` as the answer to a query embedded as `embedding`, answered from `info` under `filters`."""
+    context = context_hash(info, filters)
+    with self.lock:
+      self.__check_version(version)
+      entry_id = self.next_id
+      self.next_id += 1
+      self.entries[entry_id] = {"embedding": unit(embedding), "context": context, "created": time.time(), "response": response}
+      self.by_context.setdefault(context, set()).add(entry_id)
+      while len(self.entries) > self.max_entries:
+        self.__remove(next(iter(self.entries)))
+        self.counters["evictions"] += 1
+
+  def __check_version(self, version):
+    # Answers from an index that's been replaced may cite courses it no longer has
+    if version != self.version:
+      if self.entries:
+        self.counters["invalidations"] += 1
+      self.entries.clear()
+      self.by_context.clear()
+      self.version = version
+
+  def __remove(self, entry_id):
+    entry = self.entries.pop(entry_id)
+    ids = self.by_context[entry["context"]]
+    ids.discard(entry_id)
+    if not ids:
+      del self.by_context[entry["context"]]
+
+  def stats(self) -> dict:
+    with self.lock:
+      lookups = self.counters["hits"] + self.counters["misses"]
+      return {
+        **self.counters,
+        "hit_rate": round(self.counters["hits"] / lookups, 3) if lookups else 0.0,
+        "entries": len(self.entries),
+        "version": self.version,
+      }
+
+
+def unit(embedding) -> np.ndarray:
+  embedding = np.asarray(embedding, dtype=np.float32)
+  return embedding / (np.linalg.norm(embedding) or 1.0)
+
+def context_hash(info, filters) -> str:
+  """What an answer was generated from, as a hash: the course info put in the prompt, and the filters."""
+  return hashlib.sha256(json.dumps([info, filters], sort_keys=True, default=str).encode()).hexdigest()
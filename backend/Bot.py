@@ -1,19 +1,26 @@
 import os
+import asyncio
 import openai
+from typing import AsyncIterator
 from dotenv import load_dotenv
 from tenacity import retry, stop_after_attempt, wait_random_exponential
+from openai.types.chat import ChatCompletion
 from Artifact import Artifact
 from VectorDatabase import VectorDatabase
 from textwrap import dedent
 import sqlite3
 import sys
+import time
 import io
 import json
+import numpy as np
 from Common import Filters
 
 
 load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# For the async pipeline (the `a`-prefixed methods), which the server awaits instead of blocking a worker thread
+async_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # CODE POINTER: The Bot class is our instantiation of the 'AI Assistant' concept.
 # it maintains 'sessions' via the use of 'Artifact's (see Artifact.py for more).
@@ -24,9 +31,33 @@ class Bot:
   Bot class to handle the actual computation & interactions with openAI API.
   """
 
-  def __init__(self, vector_db: VectorDatabase, debug=False):
+  def __init__(self, vector_db: VectorDatabase, debug=False, retriever=None, speculative=False, speculative_results=5,
+               reuse_similarity=0.9, keyword_extractor=None, answer_cache=None):
     self.vector_db = vector_db
     self.debug = debug
+    # Optional HybridRetriever (see HybridRetriever.py), to find courses by lexical as well as vector search
+    self.retriever = retriever
+
+    # Optional KeywordExtractor (see KeywordExtractor.py), to find keywords without a chat completion when it's
+    # confident it can, and how often it was
+    self.keyword_extractor = keyword_extractor
+    self.keyword_sources = {"local": 0, "llm": 0}
+
+    # Optional AnswerCache (see AnswerCache.py), answering first turn queries like ones already answered from the
+    # same context without another gpt-4-turbo call
+    self.answer_cache = answer_cache
+
+    # Speculative retrieval (async pipeline only): search on the raw query while `find_keywords` is still running,
+    # for the `speculative_results` best courses. Those are used as they are if the keywords embed within
+    # `reuse_similarity` (cosine) of the query, otherwise the keywords are searched too and the two merged.
+    self.speculative = speculative
+    self.speculative_results = speculative_results
+    self.reuse_similarity = reuse_similarity
+    self.speculation = {
+      "decisions": {"reused": 0, "merged": 0, "discarded": 0, "failed": 0},
+      # Total seconds and count, per stage
+      "timings": {stage: [0.0, 0] for stage in ["speculative_search", "find_keywords", "keyword_search", "retrieval"]},
+    }
 
   @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(3))
   def gpt_get_completion(self, **kwargs):
@@ -39,6 +70,12 @@ class Bot:
 
     return client.chat.completions.create(**kwargs)
 
+  @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(3))
+  async def agpt_get_completion(self, **kwargs):
+    """Async `gpt_get_completion`, on the AsyncOpenAI client, retrying the same way."""
+
+    return await async_client.chat.completions.create(**kwargs)
+
   # CODE POINTER: These helper functions are tied to the `message` concept - in particular, its types.
   # User messages must be wrapped by `user_message`, and system messages are wrapped by `assistant` according to the
   # openAI spec. The system message is used for guiding the Bot's behavior via a 'system role'.
@@ -61,7 +98,84 @@ class Bot:
         2) Identifies the number of results that should be retrieved from the vector database.
       Returns an Artifact, where the latest response identifies the keywords and number of embeddings to use for context retrieval.
       NOTE: Currently does not `set_answer` before returning.
+      With a `keyword_extractor`, queries it's confident about are answered locally, in the same format.
+    """
+    local_artifact = self.__local_keywords(query, prev_messages)
+    if local_artifact is not None:
+      return local_artifact
+
+    (prompt, messages) = self.__keyword_messages(query, prev_messages)
+
+    response = self.gpt_get_completion(
+      messages=messages, model="gpt-3.5-turbo", temperature=0, user="anon"
+    )
+
+    return Artifact(
+      query_message=query, prompt=prompt, response=response, references=[]
+    )
+
+  async def afind_keywords(self, query: str, prev_messages: list[dict[str, str]]) -> Artifact:
+    """Async `find_keywords`."""
+    local_artifact = self.__local_keywords(query, prev_messages)
+    if local_artifact is not None:
+      return local_artifact
+    return await self.__allm_keywords(query, prev_messages)
+
+  async def __allm_keywords(self, query: str, prev_messages: list[dict[str, str]]) -> Artifact:
+    (prompt, messages) = self.__keyword_messages(query, prev_messages)
+
+    response = await self.agpt_get_completion(
+      messages=messages, model="gpt-3.5-turbo", temperature=0, user="anon"
+    )
+
+    return Artifact(
+      query_message=query, prompt=prompt, response=response, references=[]
+    )
+
+  def __local_keywords(self, query: str, prev_messages: list[dict[str, str]]):
     """
+      A `find_keywords` artifact from the `keyword_extractor`, or None if there isn't one or it isn't confident enough
+      (so the LLM should be asked). Its response is a ChatCompletion made up locally, so nothing downstream can tell.
+    """
+    if self.keyword_extractor is None:
+      return None
+
+    extraction = self.keyword_extractor.extract(query, prev_messages)
+    if self.debug:
+      print(f"Local keywords: {extraction}")
+    if extraction["confidence"] < self.keyword_extractor.min_confidence:
+      self.keyword_sources["llm"] += 1
+      return None
+    self.keyword_sources["local"] += 1
+
+    response = ChatCompletion(
+      id="local-keywords",
+      object="chat.completion",
+      created=int(time.time()),
+      model="local-keyword-extractor",
+      choices=[{
+        "index": 0,
+        "finish_reason": "stop",
+        "message": {
+          "role": "assistant",
+          "content": json.dumps({"keywords": extraction["keywords"], "num_results": extraction["num_results"]}),
+        },
+      }],
+    )
+    return Artifact(
+      query_message=query, prompt=query, response=response, references=[]
+    )
+
+  def keyword_stats(self) -> dict:
+    """How many keyword extractions the `keyword_extractor` did locally, and how many it left to the LLM."""
+    total = sum(self.keyword_sources.values())
+    return {
+      **self.keyword_sources,
+      "local_rate": round(self.keyword_sources["local"] / total, 3) if total else 0.0,
+    }
+
+  def __keyword_messages(self, query: str, prev_messages: list[dict[str, str]]) -> tuple[str, list[dict[str, str]]]:
+    """The prompt and messages `find_keywords` sends, as (prompt, messages)."""
     sys_role = dedent(f"""\
       You are a keyword identifier for a course/class search system for a university. You job is to first decide if the user is asking the bot to search for a NEW course or if they are asking about a course that has already been mentioned by the bot.
       You should maintain any words that could help identify a course, while removing very common words.
@@ -112,46 +226,204 @@ class Bot:
     )
 
     messages = [self.system_message(sys_role), *examples, self.user_message(prompt)]
+    return (prompt, messages)
 
-    response = self.gpt_get_completion(
-      messages=messages, model="gpt-3.5-turbo", temperature=0, user="anon"
-    )
-
-    return Artifact(
-      query_message=query, prompt=prompt, response=response, references=[]
-    )
+  def __parse_keywords(self, keyword_artifact: Artifact):
+    """The {"keywords", "num_results"} from a `find_keywords` artifact, or None if it didn't find any."""
+    # If we have any keywords to work with, let's use them
+    if (
+      keyword_artifact.get_latest_response()
+      and "keywords" in keyword_artifact.get_latest_response()
+      and "num_results" in keyword_artifact.get_latest_response()
+    ):
+      return json.loads(keyword_artifact.get_latest_response())
+    return None
 
   def __clean_filters(self, filters: Filters):
-    """Creates a dictionary of filters only if they are valid/non-empty/non-default."""
-    return {k: v for k, v in filters.items() if k != "num_embeds" and v}
+    """
+      Creates a `where` from only the filters that are valid/non-empty/non-default. More than one is combined with
+      an explicit `$and` (Chroma rejects several fields in one dict), which the numpy backend resolves as an
+      intersection of its precomputed row sets.
+    """
+    clauses = [{k: v} for k, v in filters.items() if k != "num_embeds" and v]
+    if len(clauses) > 1:
+      return {"$and": clauses}
+    return clauses[0] if clauses else {}
 
   def retrieve_context(self, query, filters: Filters, prev_messages: list[dict[str, str]], threshold=0.0):
     """
       Takes the result from `find_keywords` API call, and queries the vector database to get appropriate
       context to answer the original question. Returns a list of objects, filtered by having similarity score
-      of at least `threshold`.
+      of at least `threshold`. Results are grouped by course, so asking for n results gets n different courses
+      rather than n chunks that may all come from one. With a `retriever`, courses are found by its fused
+      lexical + vector score instead.
     """
     keyword_artifact = self.find_keywords(query, prev_messages)
     context = []
 
-    # If we have any keywords to work with, let's use them
-    if (
-      keyword_artifact.get_latest_response()
-      and "keywords" in keyword_artifact.get_latest_response()
-      and "num_results" in keyword_artifact.get_latest_response()
-    ):
-
-      parsed_as_json = json.loads(keyword_artifact.get_latest_response())
+    parsed_as_json = self.__parse_keywords(keyword_artifact)
+    if parsed_as_json:
+      if self.retriever is not None:
+        return self.retriever.retrieve(
+          query=parsed_as_json["keywords"],
+          n_results=parsed_as_json["num_results"],
+          filters=self.__clean_filters(filters=filters),
+        )
 
       context = self.vector_db.query(
         source="course_chunks",
         query=parsed_as_json["keywords"],
         n_results=parsed_as_json["num_results"],
         filters=self.__clean_filters(filters=filters),
+        group_by="courseID",
       )
 
     return list(filter(lambda x: x["score"] > threshold, context))
 
+  async def aretrieve_context(self, query, filters: Filters, prev_messages: list[dict[str, str]], threshold=0.0):
+    """
+      Async `retrieve_context`. The keyword and query embedding calls are awaited, and only the search itself (CPU
+      and local disk) runs on a worker thread.
+    """
+    (context, _) = await self.__aretrieve(query, filters, prev_messages, threshold)
+    return context
+
+  async def __aretrieve(self, query, filters: Filters, prev_messages: list[dict[str, str]], threshold=0.0, embed_query=False):
+    """
+      `aretrieve_context`, as (context, embedding of `query` itself), for the answer cache. The embedding is the one
+      speculative retrieval searched with, if it made one. Otherwise, with `embed_query`, it's made while the
+      keywords are found and searched, so it adds no latency, and it's None without.
+    """
+    # Speculating only pays while the keywords take a round trip to find
+    keyword_artifact = self.__local_keywords(query, prev_messages)
+    if keyword_artifact is None and self.speculative:
+      return await self.__aretrieve_speculatively(query, filters, prev_messages, threshold)
+
+    query_embedding = asyncio.create_task(self.vector_db.aembed_queries([query])) if embed_query else None
+    try:
+      if keyword_artifact is None:
+        keyword_artifact = await self.__allm_keywords(query, prev_messages)
+      context = []
+
+      parsed_as_json = self.__parse_keywords(keyword_artifact)
+      if parsed_as_json:
+        context = await self.__asearch(
+          parsed_as_json["keywords"], parsed_as_json["num_results"], self.__clean_filters(filters=filters)
+        )
+    except BaseException:
+      if query_embedding is not None:
+        query_embedding.cancel()
+      raise
+
+    return (self.__above_threshold(context, threshold), (await query_embedding)[0] if query_embedding else None)
+
+  async def __aretrieve_speculatively(self, query, filters: Filters, prev_messages: list[dict[str, str]], threshold):
+    """
+      `__aretrieve`, with the search on the raw query run while `find_keywords` is in flight, so the two
+      latencies overlap instead of adding up. Then, depending on the keywords, the speculative results are:
+        reused     the keywords mean about the same as the query (their embeddings are within `reuse_similarity`),
+                   and the speculative search (for `speculative_results`) found as many courses as were asked for
+        merged     with a search on the keywords, the best score of each course kept
+        discarded  there are no keywords, so (as without speculation) no context
+        failed     the speculative search raised, so only the keywords are searched
+      Every decision, and the time each stage took, is counted in `speculation_stats`.
+    """
+    start = time.perf_counter()
+    clean_filters = self.__clean_filters(filters=filters)
+
+    async def speculate():
+      query_embedding = (await self.vector_db.aembed_queries([query]))[0]
+      results = await self.__asearch(query, self.speculative_results, clean_filters, query_embedding)
+      self.__time("speculative_search", start)
+      return query_embedding, results
+
+    speculation = asyncio.create_task(speculate())
+    try:
+      parsed_as_json = self.__parse_keywords(await self.__allm_keywords(query, prev_messages))
+    except BaseException:
+      speculation.cancel()
+      raise
+    self.__time("find_keywords", start)
+
+    if not parsed_as_json:
+      speculation.cancel()
+      return (self.__decide("discarded", start, []), None)
+
+    (keywords, num_results) = (parsed_as_json["keywords"], parsed_as_json["num_results"])
+    try:
+      (query_embedding, speculative) = await speculation
+    except Exception as e:
+      print(f"Speculative retrieval failed, searching the keywords alone: {e}")
+      context = await self.__asearch(keywords, num_results, clean_filters)
+      return (self.__decide("failed", start, self.__above_threshold(context, threshold)), None)
+
+    keyword_embedding = (await self.vector_db.aembed_queries([keywords]))[0]
+    similarity = float(np.dot(query_embedding, keyword_embedding) / (
+      np.linalg.norm(query_embedding) * np.linalg.norm(keyword_embedding)
+    ))
+    if self.debug:
+      print(f"Speculative retrieval: keywords {keywords!r} are {similarity:.3f} similar to the query")
+    # (more results than speculated for can't come from the speculative search alone)
+    if similarity >= self.reuse_similarity and len(speculative) >= num_results:
+      return (self.__decide("reused", start, self.__above_threshold(speculative[:num_results], threshold)), query_embedding)
+
+    search_start = time.perf_counter()
+    context = await self.__asearch(keywords, num_results, clean_filters, keyword_embedding)
+    self.__time("keyword_search", search_start)
+
+    # Each course keeps its better hit of the two. The retriever's fused "score" is higher-is-better, but the vector
+    # database's "score" is a distance, so there courses are compared by "group_score", their similarity.
+    similarity_of = (lambda hit: hit["score"]) if self.retriever is not None else (lambda hit: hit["group_score"])
+    courses = {}
+    for hit in [*context, *speculative]:
+      course_id = str(hit["metadata"]["courseID"])
+      if course_id not in courses or similarity_of(hit) > similarity_of(courses[course_id]):
+        courses[course_id] = hit
+    merged = sorted(courses.values(), key=lambda hit: -similarity_of(hit))[:num_results]
+    return (self.__decide("merged", start, self.__above_threshold(merged, threshold)), query_embedding)
+
+  async def __asearch(self, query: str, n_results: int, filters: dict, query_embedding=None) -> list[dict]:
+    """The best `n_results` courses for `query`, from the retriever if there is one, or the vector database."""
+    if self.retriever is not None:
+      return await self.retriever.aretrieve(
+        query=query, n_results=n_results, filters=filters, query_embedding=query_embedding
+      )
+    return await self.vector_db.aquery(
+      source="course_chunks",
+      query=query,
+      query_embedding=query_embedding,
+      n_results=n_results,
+      filters=filters,
+      group_by="courseID",
+    )
+
+  def __above_threshold(self, context: list[dict], threshold) -> list[dict]:
+    # The retriever's fused scores are scaled per query (its worst candidate scores 0), so they aren't thresholded
+    if self.retriever is not None:
+      return context
+    return list(filter(lambda x: x["score"] > threshold, context))
+
+  def __time(self, stage: str, start: float):
+    timing = self.speculation["timings"][stage]
+    timing[0] += time.perf_counter() - start
+    timing[1] += 1
+
+  def __decide(self, decision: str, start: float, context: list[dict]) -> list[dict]:
+    self.speculation["decisions"][decision] += 1
+    self.__time("retrieval", start)
+    return context
+
+  def speculation_stats(self) -> dict:
+    """How often speculative retrieval's results were reused, merged or thrown away, and how long each stage took."""
+    return {
+      "enabled": self.speculative,
+      "decisions": dict(self.speculation["decisions"]),
+      "mean_ms": {
+        stage: round(total / count * 1000, 1) if count else None
+        for (stage, (total, count)) in self.speculation["timings"].items()
+      },
+    }
+
   def context_to_course_info(self, context):
     """
       Takes the context information from `retrieve_context` (i.e. from the vector database),
@@ -173,6 +445,10 @@ class Bot:
       results = cur.execute(query, ids).fetchall()
       return results
 
+  async def acontext_to_course_info(self, context):
+    """Async `context_to_course_info`. sqlite3 only blocks, so the lookup runs on a worker thread."""
+    return await asyncio.to_thread(self.context_to_course_info, context)
+
   def answer_query(
     self, query: str, prev_messages: list[dict[str, str]], filters: Filters
   ) -> Artifact:
@@ -193,6 +469,120 @@ class Bot:
     info = self.context_to_course_info(context)
 
     # Then perform API call using this course info
+    (prompt, messages) = self.__answer_messages(query, prev_messages, info)
+
+    # Unless a query meaning the same was answered from the same course info already. Only first turns are cached,
+    # since later answers depend on the conversation too. (Embedded through the query cache, like the keywords.)
+    query_embedding = self.vector_db.embed_queries([query])[0] if self.__caches_answer(prev_messages) else None
+    response = self.__cached_answer(query_embedding, info, filters)
+
+    # Generate response
+    if response is None:
+      response = self.gpt_get_completion(
+        messages=messages, model="gpt-4-turbo", temperature=0, user="anon"
+      )
+      self.__cache_answer(query_embedding, info, filters, response)
+
+    # Create artifact and set answer to respond to query
+    # CODE POINTER: Note here how `references = info` - here we store in the artifact what info was used to generate the response.
+    artifact = Artifact(
+      query_message=query, prompt=prompt, response=response, references=info
+    )
+    artifact.set_answer(artifact.get_latest_response())
+
+    return artifact
+
+  async def aanswer_query(
+    self, query: str, prev_messages: list[dict[str, str]], filters: Filters
+  ) -> Artifact:
+    """
+      Async `answer_query`, for the server's async route: while one conversation waits on OpenAI, the event loop
+      gets on with the others, instead of each holding a threadpool thread for the whole pipeline.
+    """
+    (context, query_embedding) = await self.__aretrieve(
+      query, filters, prev_messages, embed_query=self.__caches_answer(prev_messages)
+    )
+    info = await self.acontext_to_course_info(context)
+
+    (prompt, messages) = self.__answer_messages(query, prev_messages, info)
+    query_embedding = await self.__answer_embedding(query, prev_messages, query_embedding)
+    response = self.__cached_answer(query_embedding, info, filters)
+    if response is None:
+      response = await self.agpt_get_completion(
+        messages=messages, model="gpt-4-turbo", temperature=0, user="anon"
+      )
+      self.__cache_answer(query_embedding, info, filters, response)
+
+    artifact = Artifact(
+      query_message=query, prompt=prompt, response=response, references=info
+    )
+    artifact.set_answer(artifact.get_latest_response())
+
+    return artifact
+
+  async def astream_answer_query(
+    self, query: str, prev_messages: list[dict[str, str]], filters: Filters
+  ) -> AsyncIterator[tuple[str, object]]:
+    """
+      Streaming `aanswer_query`, as (event, data) pairs: ("references", info) as soon as retrieval is done, then
+      ("token", text) for each piece of the answer as it's generated, and last ("artifact", Artifact), the same
+      artifact `aanswer_query` would have returned.
+    """
+    (context, query_embedding) = await self.__aretrieve(
+      query, filters, prev_messages, embed_query=self.__caches_answer(prev_messages)
+    )
+    info = await self.acontext_to_course_info(context)
+    yield ("references", info)
+
+    (prompt, messages) = self.__answer_messages(query, prev_messages, info)
+    query_embedding = await self.__answer_embedding(query, prev_messages, query_embedding)
+    response = self.__cached_answer(query_embedding, info, filters)
+    if response is not None:
+      # A cached answer is all there already, so it goes out as a single token
+      yield ("token", response.choices[0].message.content)
+    else:
+      # Not retried like the other calls: once tokens have gone out, a second attempt would repeat them
+      async with async_client.chat.completions.stream(
+        messages=messages, model="gpt-4-turbo", temperature=0, user="anon"
+      ) as stream:
+        async for event in stream:
+          if event.type == "content.delta" and event.delta:
+            yield ("token", event.delta)
+        response = await stream.get_final_completion()
+      self.__cache_answer(query_embedding, info, filters, response)
+
+    artifact = Artifact(
+      query_message=query, prompt=prompt, response=response, references=info
+    )
+    artifact.set_answer(artifact.get_latest_response())
+    yield ("artifact", artifact)
+
+  def __caches_answer(self, prev_messages: list[dict[str, str]]) -> bool:
+    return self.answer_cache is not None and not prev_messages
+
+  async def __answer_embedding(self, query: str, prev_messages: list[dict[str, str]], query_embedding):
+    """
+      What the answer cache looks `query` up by: the embedding retrieval already made of it, or (when speculation
+      was thrown away before making one) a fresh one through the query cache. None when the answer isn't cached.
+    """
+    if not self.__caches_answer(prev_messages):
+      return None
+    if query_embedding is None:
+      query_embedding = (await self.vector_db.aembed_queries([query]))[0]
+    return query_embedding
+
+  def __cached_answer(self, query_embedding, info, filters: Filters):
+    # `query_embedding` is only set for queries `__caches_answer`
+    if query_embedding is None:
+      return None
+    return self.answer_cache.get(query_embedding, info, filters, self.vector_db.version)
+
+  def __cache_answer(self, query_embedding, info, filters: Filters, response):
+    if query_embedding is not None:
+      self.answer_cache.put(query_embedding, info, filters, self.vector_db.version, response)
+
+  def __answer_messages(self, query: str, prev_messages: list[dict[str, str]], info) -> tuple[str, list[dict[str, str]]]:
+    """The prompt and messages `answer_query` sends for `query`, given the course `info` found for it, as (prompt, messages)."""
     sys_role = dedent(f"""\
       You are a university course search assistant. Your goal is to help students find courses offered at the university that interest them.
       You have access to the course titles and descriptions of every course, but nothing more currently. If students ask
@@ -228,25 +618,12 @@ class Bot:
       )
 
     # Setup messages to make API call
-    prev_messages = [
+    messages = [
       self.system_message(sys_role),
       *prev_messages,
       self.user_message(prompt),
     ]
-
-    # Generate response
-    response = self.gpt_get_completion(
-      messages=prev_messages, model="gpt-4-turbo", temperature=0, user="anon"
-    )
-
-    # Create artifact and set answer to respond to query
-    # CODE POINTER: Note here how `references = info` - here we store in the artifact what info was used to generate the response.
-    artifact = Artifact(
-      query_message=query, prompt=prompt, response=response, references=info
-    )
-    artifact.set_answer(artifact.get_latest_response())
-
-    return artifact
+    return (prompt, messages)
 
 
 # Playground to test Bot upon running script as main
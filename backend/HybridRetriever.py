@@ -0,0 +1,134 @@
+import re
+import asyncio
+import sqlite3
+import threading
+from VectorDatabase import VectorDatabase
+
+# How much a match in each column of the courses_fts index (see scripts/to_sql.py) counts towards its BM25 score.
+# Titles, names and numbers are short, so a match there says a lot more than one somewhere in a description.
+COLUMN_WEIGHTS = {
+  "courseTitle": 10.0,
+  "courseDescription": 1.0,
+  "publishedInstructors": 8.0,
+  "catalogSubjectDescription": 4.0,
+  "catalogSubject": 4.0,
+  "courseNumber": 8.0,
+}
+
+class HybridRetriever:
+  """
+    Course retrieval fusing lexical scores (BM25 over the courses_fts full text index `to_sql.py` builds) with vector
+    scores. Exact words, like an instructor's name or a course number, are found by the index locally in well under
+    a millisecond, where embeddings only get somewhere near them; what a query means is left to the vectors.
+  """
+
+  def __init__(self, vector_db: VectorDatabase, sql_db_path="courses.db", lexical_weight=0.5, source="course_chunks"):
+    self.vector_db = vector_db
+    self.sql_db_path = sql_db_path
+    # 0 is vector search alone, 1 lexical search alone
+    self.lexical_weight = lexical_weight
+    self.source = source
+
+    # SQLite connections can't be shared between threads, and the server answers requests from a pool of them
+    self.local = threading.local()
+
+  def connection(self) -> sqlite3.Connection:
+    if not hasattr(self.local, "connection"):
+      self.local.connection = sqlite3.connect(self.sql_db_path)
+      self.local.columns = {row[1] for row in self.local.connection.execute("PRAGMA table_info(courses)")}
+    return self.local.connection
+
+  def __where_sql(self, filters: dict) -> tuple[list[str], list]:
+    """SQL conditions on `courses` for the Chroma style `where`s the Bot builds: field equality, ANDed."""
+    (conditions, params) = ([], [])
+    for (key, value) in (filters or {}).items():
+      if key == "$and":
+        for clause in value:
+          (clause_conditions, clause_params) = self.__where_sql(clause)
+          conditions.extend(clause_conditions)
+          params.extend(clause_params)
+        continue
+      if isinstance(value, dict):
+        (op, value) = next(iter(value.items()))
+        if op != "$eq":
+          raise ValueError(f"Unsupported lexical filter operator {op}")
+      if key not in self.local.columns:
+        raise ValueError(f"Can't filter courses on {key}, it isn't a column of the courses table")
+      conditions.append(f"c.{key} = ?")
+      params.append(value)
+    return conditions, params
+
+  def lexical_search(self, query: str, n_results=10, filters={}) -> list[dict]:
+    """
+      The best `n_results` courses for the words of `query` by BM25 (any word can match, courses matching more
+      and rarer words rank higher), as {courseID, termDescription, score} dicts, highest score first.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+      return []
+
+    con = self.connection()
+    (conditions, params) = self.__where_sql(filters)
+    weights = ", ".join(str(weight) for weight in COLUMN_WEIGHTS.values())
+    rows = con.execute(f"""
+      SELECT c.courseID, c.termDescription, -bm25(courses_fts, {weights}) AS score
+      FROM courses_fts JOIN courses c ON c.rowid = courses_fts.rowid
+      WHERE courses_fts MATCH ? {"".join(f" AND {condition}" for condition in conditions)}
+      ORDER BY score DESC
+      LIMIT ?
+      """,
+      # Quoted, so words like AND/NOT/NEAR are searched for rather than taken as operators
+      [" OR ".join(f'"{word}"' for word in words), *params, n_results]
+    ).fetchall()
+    return [{"courseID": course_id, "termDescription": term, "score": score} for (course_id, term, score) in rows]
+
+  def retrieve(self, query: str, n_results=3, filters={}, overfetch=2, query_embedding=None) -> list[dict]:
+    """
+      The best `n_results` courses for `query`, by a weighted sum of their lexical and vector scores, each scaled to
+      [0, 1] over the `n_results * overfetch` candidates that side found (a course one side didn't find scores 0 there).
+
+      Returns the same {id, metadata, score} dicts `VectorDatabase.query` does, one per course, where "score" is the
+      fused score (higher is better), alongside the "lexical_score" and "vector_score" it came from. Courses only
+      the lexical search found have no chunk, so their "id" is None and their metadata only courseID/termDescription.
+      `query_embedding` is searched with instead of embedding `query` again, if given.
+    """
+    candidates = n_results * overfetch
+    lexical = self.lexical_search(query, candidates, filters) if self.lexical_weight > 0 else []
+    vector = self.vector_db.query(
+      source=self.source, query=query, n_results=candidates, filters=filters, group_by="courseID",
+      query_embedding=query_embedding
+    ) if self.lexical_weight < 1 else []
+
+    lexical_scores = scale({str(hit["courseID"]): hit["score"] for hit in reversed(lexical)})
+    vector_scores = scale({str(hit["metadata"]["courseID"]): hit["group_score"] for hit in vector})
+
+    courses = {str(hit["metadata"]["courseID"]): hit for hit in vector}
+    for hit in lexical:
+      courses.setdefault(str(hit["courseID"]), {
+        "id": None, "metadata": {"courseID": hit["courseID"], "termDescription": hit["termDescription"]}
+      })
+
+    results = []
+    for (course_id, hit) in courses.items():
+      (lexical_score, vector_score) = (lexical_scores.get(course_id, 0.0), vector_scores.get(course_id, 0.0))
+      results.append({
+        **hit,
+        "score": self.lexical_weight * lexical_score + (1 - self.lexical_weight) * vector_score,
+        "lexical_score": lexical_score,
+        "vector_score": vector_score,
+      })
+    return sorted(results, key=lambda result: -result["score"])[:n_results]
+
+  async def aretrieve(self, query: str, n_results=3, filters={}, overfetch=2, query_embedding=None) -> list[dict]:
+    """Async `retrieve`: the query embedding is awaited (unless given), then both searches run on a worker thread."""
+    if query_embedding is None and self.lexical_weight < 1:
+      query_embedding = (await self.vector_db.aembed_queries([query]))[0]
+    return await asyncio.to_thread(self.retrieve, query, n_results, filters, overfetch, query_embedding)
+
+
+def scale(scores: dict) -> dict:
+  """Min-max scales `scores` to [0, 1] (all 1 when they're equal), so the two kinds can be added up."""
+  if not scores:
+    return {}
+  (low, high) = (min(scores.values()), max(scores.values()))
+  return {key: (score - low) / (high - low) if high > low else 1.0 for (key, score) in scores.items()}
@@ -0,0 +1,263 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+
+# Words that never identify a course: English function words, and how people ask for courses
+STOPWORDS = set("""
+  a about above after again all also am an and any are as at be been before being below between both but by can could
+  did do does doing down during each few for from further had has have having he her here hers him his how i if in
+  into is it its itself just me more most my myself no nor not now of off on once only or other our ours out over own
+  same she should so some such than that the their theirs them then there these they this those through to too under
+  until up very was we were what when where which while who whom why will with would you your yours
+  course courses class classes find show give list recommend recommendations suggest search looking look want wanna
+  need like love enjoy interested interest learn learning take taking study studying good great best fun easy cool
+  something anything stuff things thing some please semester term offered offering ones one kind sort topics topic
+  taught teach teaches teaching professor prof instructor lecturer
+""".split())
+
+# How people shorten subjects, where the catalog's subject codes and names don't give it away
+COMMON_ABBREVIATIONS = {
+  "ai": "Artificial Intelligence",
+  "ml": "Machine Learning",
+  "cs": "Computer Science",
+  "bio": "Biology",
+  "chem": "Chemistry",
+  "econ": "Economics",
+  "stat": "Statistics",
+  "stats": "Statistics",
+  "math": "Mathematics",
+  "maths": "Mathematics",
+  "psych": "Psychology",
+  "gov": "Government",
+  "phil": "Philosophy",
+  "lit": "Literature",
+  "astro": "Astronomy",
+  "physio": "Physiology",
+  "neuro": "Neuroscience",
+  "soc": "Sociology",
+  "anthro": "Anthropology",
+  "comp sci": "Computer Science",
+  "data sci": "Data Science",
+  "poli sci": "Political Science",
+  "polisci": "Political Science",
+}
+
+# The query is talking to the bot, not searching
+CONVERSATIONAL = {"you", "your", "yourself", "hi", "hello", "hey", "thanks", "thank", "bye", "prompt", "chatgpt", "gpt"}
+# The query only makes sense with the messages before it ("courses by him", "something else")
+REFERENTIAL = {
+  "him", "her", "them", "those", "these", "it", "that", "also", "instead", "else", "another", "more", "other", "same",
+  "forget", "previous", "first", "second", "last", "again"
+}
+# Keyword search can't say "not"
+NEGATIONS = {"not", "no", "without", "except", "excluding", "besides", "avoid", "nothing"}
+
+# Words, in queries and in the catalog alike: letters and digits in any script ("José"), with hyphens splitting
+# ("Mary-Jane" is "Mary" "Jane") but an apostrophe not ("O'Brien", "what's")
+TOKEN = re.compile(r"[^\W_]+(?:'[^\W_]+)?")
+
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10}
+COURSE_WORDS = {"course", "courses", "class", "classes", "options", "results", "recommendations", "suggestions"}
+
+class KeywordExtractor:
+  """
+    Does `Bot.find_keywords`' job locally, for the queries simple enough not to need a chat completion: drops
+    stopwords (common English, and words in a large share of the catalog's course descriptions), expands subject
+    abbreviations ("econ" -> "Economics") from the catalog's subject codes and names, matches instructor names (a last
+    name alone becomes the instructor's full name), and picks up how many results are asked for ("5 courses ...").
+
+    Every extraction comes with a confidence in [0, 1]: the share of the words left that the catalog knows, halved for
+    each abbreviation or name that could mean more than one thing, and 0 for queries that are talking to the bot,
+    referring back to earlier messages, or saying what they don't want. Below `min_confidence`, ask the LLM instead.
+  """
+
+  def __init__(self, sql_db_path="courses.db", min_confidence=0.75, common_fraction=0.25, max_results=10):
+    self.sql_db_path = sql_db_path
+    self.min_confidence = min_confidence
+    # Words in more than this share of course descriptions are as good as stopwords
+    self.common_fraction = common_fraction
+    self.max_results = max_results
+
+    # What's known about the catalog, from `__load`. Rebuilt when courses.db changes (e.g. update_incremental.py
+    # ran), which every `extract` checks: in a background thread, so the scan never holds up a query, with queries
+    # answered from the old catalog until the new one is swapped in whole
+    self.loaded_mtime = os.path.getmtime(self.sql_db_path)
+    self.catalog = self.__load()
+    self.lock = threading.Lock()
+    self.reloading = False
+
+  def __refresh(self):
+    mtime = os.path.getmtime(self.sql_db_path)
+    with self.lock:
+      if mtime == self.loaded_mtime or self.reloading:
+        return
+      self.reloading = True
+    threading.Thread(target=self.__reload, args=(mtime,), daemon=True).start()
+
+  def __reload(self, mtime):
+    try:
+      self.catalog = self.__load()
+      self.loaded_mtime = mtime
+    except Exception as e:
+      print(f"Reloading the catalog for keyword extraction failed, keeping the old one: {e}")
+    finally:
+      with self.lock:
+        self.reloading = False
+
+  def __load(self) -> tuple:
+    """(vocabulary, common words, abbreviations, full names, last names, subject names) of the catalog."""
+    con = sqlite3.connect(self.sql_db_path)
+    try:
+      subjects = con.execute(
+        "SELECT DISTINCT catalogSubject, catalogSubjectDescription FROM courses WHERE catalogSubject IS NOT NULL"
+      ).fetchall()
+
+      (vocabulary, document_frequency, num_courses) = (set(), Counter(), 0)
+      instructors = set()
+      for (title, description, names) in con.execute(
+        "SELECT courseTitle, courseDescription, publishedInstructors FROM courses"
+      ):
+        num_courses += 1
+        vocabulary |= set(TOKEN.findall(f"{title or ''} {description or ''}".lower()))
+        document_frequency.update(set(TOKEN.findall((description or "").lower())))
+        instructors.update(json.loads(names) if names else [])
+    finally:
+      con.close()
+
+    # (but a subject's own name, however common, is what it's searched by)
+    subject_words = {word for (_, name) in subjects for word in re.findall(r"[a-z]+", (name or "").lower())}
+    common = {
+      word for (word, count) in document_frequency.items()
+      if count > self.common_fraction * num_courses and word not in subject_words
+    }
+
+    # Subject codes, the initials of multi word subject names ("Computer Science" -> "cs") and the prefixes of
+    # one word names ("Economics" -> "econ"), wherever they point at a single subject
+    candidates = defaultdict(set)
+    for (code, name) in subjects:
+      name = name or code
+      candidates[code.lower()].add(name)
+      words = re.findall(r"[A-Za-z]+", name)
+      capitalised = [word for word in words if word[0].isupper()]
+      if len(capitalised) > 1:
+        candidates["".join(word[0] for word in capitalised).lower()].add(name)
+      elif words:
+        first = words[0].lower()
+        for n in range(3, len(first)):
+          # A prefix that's a word in its own right ("art", "his") means that word
+          if first[:n] not in vocabulary:
+            candidates[first[:n]].add(name)
+    abbreviations = {abbr: names for (abbr, names) in candidates.items()}
+    for (abbr, name) in COMMON_ABBREVIATIONS.items():
+      abbreviations[abbr] = {name}
+
+    full_names = {}
+    last_names = defaultdict(set)
+    for name in instructors:
+      parts = TOKEN.findall(name)
+      if len(parts) < 2:
+        continue
+      full_names[" ".join(parts).lower()] = name
+      # (a hyphenated last name is all of its parts: "García-López" is "garcía lópez")
+      last = TOKEN.findall(name.split()[-1]) or parts[-1:]
+      last_names[" ".join(last).lower()].add(name)
+
+    subject_names = {name.lower() for names in abbreviations.values() for name in names}
+    return vocabulary, common, abbreviations, full_names, dict(last_names), subject_names
+
+  def extract(self, query: str, prev_messages: list[dict[str, str]] = []) -> dict:
+    """
+      {"keywords", "num_results", "confidence", "reason"} for `query`, where "keywords" is what `find_keywords`
+      would search for (None when there's nothing to search for), and "reason" says what lowered the confidence.
+    """
+    self.__refresh()
+    (vocabulary, common, abbreviations, full_names, last_names, subject_names) = self.catalog
+    tokens = TOKEN.findall(query)
+    lowered = [token.lower() for token in tokens]
+
+    if not tokens:
+      return self.__result(None, 3, 0.0, "no words")
+    if CONVERSATIONAL & set(lowered):
+      return self.__result(None, 3, 0.0, "conversational")
+    if prev_messages and REFERENTIAL & set(lowered):
+      return self.__result(None, 3, 0.0, "refers to earlier messages")
+    if NEGATIONS & set(lowered):
+      return self.__result(None, 3, 0.0, "negation")
+
+    (keywords, num_results, known, content, ambiguous) = ([], 3, 0, 0, 0)
+    i = 0
+    while i < len(tokens):
+      (token, word) = (tokens[i], lowered[i])
+      following = lowered[i + 1] if i + 1 < len(tokens) else None
+
+      # "5 courses", "three classes"
+      number = int(word) if word.isdecimal() else NUMBER_WORDS.get(word)
+      if number and following in COURSE_WORDS and 0 < number <= 50:
+        num_results = min(number, self.max_results)
+        i += 1
+        continue
+
+      # Two word abbreviations ("comp sci")
+      pair = " ".join(lowered[i:i + 2])
+      if following and pair in abbreviations and len(abbreviations[pair]) == 1:
+        keywords.append(next(iter(abbreviations[pair])))
+        (known, content) = (known + 1, content + 1)
+        i += 2
+        continue
+
+      # Instructors by full name, longest first (up to five words, each part of a hyphenated name counting as one)
+      n = next((n for n in range(min(len(tokens) - i, 5), 1, -1) if " ".join(lowered[i:i + n]) in full_names), None)
+      if n:
+        keywords.append(full_names[" ".join(lowered[i:i + n])])
+        (known, content) = (known + 1, content + 1)
+        i += n
+        continue
+
+      if word in STOPWORDS or word in common:
+        i += 1
+        continue
+      content += 1
+
+      # Instructors by last name, when it's written like one or can't be anything else (a hyphenated one can't)
+      n = 2 if following and " ".join(lowered[i:i + 2]) in last_names else 1
+      if n == 2 or (word in last_names and (token[0].isupper() or word not in vocabulary)):
+        names = last_names[" ".join(lowered[i:i + n])]
+        if len(names) == 1:
+          keywords.append(next(iter(names)))
+        else:
+          keywords.append(" ".join(tokens[i:i + n]))
+          ambiguous += 1
+        known += 1
+        i += n
+        continue
+
+      if word in abbreviations and word not in subject_names:
+        names = abbreviations[word]
+        if len(names) == 1:
+          # A code that's also a word ("art") might have meant the word
+          keywords.extend([token, next(iter(names))] if word in vocabulary else [next(iter(names))])
+        else:
+          keywords.append(token)
+          ambiguous += 1
+        known += 1
+      else:
+        keywords.append(token)
+        known += word in vocabulary or word in subject_names or word.isdigit()
+      i += 1
+
+    keywords = list(dict.fromkeys(keywords))
+    if not keywords:
+      return self.__result(None, num_results, 0.0, "no keywords")
+
+    confidence = known / max(content, 1) * 0.5 ** ambiguous
+    reason = ", ".join(filter(None, [
+      f"{content - known} unknown word(s)" if known < content else "",
+      f"{ambiguous} ambiguous abbreviation(s) or name(s)" if ambiguous else "",
+    ]))
+    return self.__result(" ".join(keywords), num_results, confidence, reason)
+
+  def __result(self, keywords, num_results, confidence, reason) -> dict:
+    return {"keywords": keywords, "num_results": num_results, "confidence": round(confidence, 3), "reason": reason}
@@ -1,10 +1,15 @@
 from fastapi import FastAPI, APIRouter
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from AnswerCache import AnswerCache
 from Bot import Bot
 from Common import ArtifactContent, ClientMessage
+from HybridRetriever import HybridRetriever
+from KeywordExtractor import KeywordExtractor
 from VectorDatabase import VectorDatabase
 import os
+import json
 
 app = FastAPI()
 
@@ -30,20 +35,38 @@ class Server:
     self.bot = bot
     self.router = APIRouter()
     self.router.add_api_route("/recommend", self.recommend, methods=["POST"])
+    self.router.add_api_route("/recommend/stream", self.recommend_stream, methods=["POST"])
+    self.router.add_api_route("/reload-index", self.reload_index, methods=["POST"])
+    self.router.add_api_route("/metrics", self.metrics, methods=["GET"])
 
-  def recommend(self, query : ClientMessage) -> ArtifactContent:
+  def metrics(self) -> dict:
+    # How often query embeddings came from the cache rather than the API, and which index version is served
+    return {
+      "version": self.bot.vector_db.version,
+      "query_embedding_cache": self.bot.vector_db.query_cache_stats(),
+      # What became of speculative searches on the raw query (SPECULATIVE_RETRIEVAL=1), and each stage's latency
+      "speculative_retrieval": self.bot.speculation_stats(),
+      # How many queries had their keywords found locally (LOCAL_KEYWORDS=1), rather than by gpt-3.5-turbo
+      "keyword_extraction": self.bot.keyword_stats(),
+      # Answers reused for first turn queries like ones already answered from the same courses (ANSWER_CACHE=1)
+      "answer_cache": self.bot.answer_cache.stats() if self.bot.answer_cache else {}
+    }
+
+  def reload_index(self) -> dict:
+    # Switch to the newest published vector index now, rather than on the watcher's next check.
+    # Runs in FastAPI's threadpool, so requests keep being answered from the old index while the new one warms up.
+    reloaded = self.bot.vector_db.reload()
+    return {"reloaded": reloaded, "version": self.bot.vector_db.version}
+
+  async def recommend(self, query : ClientMessage) -> ArtifactContent:
     # CODE POINTER: Notice how the ClientMessage includes an ArtifactContent attribute - the backend receives ArtifactContent,
     # and will return an updated ArtifactContent object, constantly maintaining this object to maintain a `Session`.
+    # Async all the way down: a conversation waiting on OpenAI doesn't hold one of the (few dozen) threadpool threads
+    # sync routes run on, so one worker can keep hundreds of them in flight.
 
     artifact = query.artifact
 
-    # Reconstruct messages from what was sent
-    prev_messages = []
-    for prompt, resp in zip(artifact.prompts, artifact.response_contents):
-      prev_messages.append(bot.user_message(prompt))
-      prev_messages.append(bot.assistant_message(resp))
-
-    artifact = self.bot.answer_query(query=artifact.query_message, prev_messages=prev_messages, filters={
+    artifact = await self.bot.aanswer_query(query=artifact.query_message, prev_messages=self.prev_messages(artifact), filters={
       "num_embeds": 3,
       "catalogSubject": "",
       "termDescription": ""
@@ -51,12 +74,101 @@ class Server:
     # Returning an ArtifactContent object (contains all of the content from Artifact, just no methods etc, don't want to send useless stuff)
     return artifact.to_artifact_content()
 
+  async def recommend_stream(self, query : ClientMessage) -> StreamingResponse:
+    # `recommend` as server-sent events, so the answer shows up as it's written instead of after all of it is:
+    #   event: references  the course info the answer is based on, as soon as retrieval finishes
+    #   event: token       {"token": ...}, each piece of the answer as it arrives
+    #   event: artifact    the ArtifactContent `recommend` would have returned, to carry on the session with
+    #   event: error       {"detail": ...}, if the pipeline failed part way through (the stream ends there)
+    artifact = query.artifact
+
+    async def events():
+      try:
+        async for (event, data) in self.bot.astream_answer_query(
+          query=artifact.query_message, prev_messages=self.prev_messages(artifact), filters={
+            "num_embeds": 3,
+            "catalogSubject": "",
+            "termDescription": ""
+          }
+        ):
+          if event == "artifact":
+            yield sse(event, data.to_artifact_content().model_dump_json())
+          elif event == "token":
+            yield sse(event, json.dumps({"token": data}))
+          else:
+            yield sse(event, json.dumps(data))
+      except Exception as e:
+        # The 200 and the first events are already out by now, so the client has to hear about it in band
+        yield sse("error", json.dumps({"detail": str(e)}))
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+      "Cache-Control": "no-cache",
+      # Stop proxies (nginx) buffering the stream until it's done
+      "X-Accel-Buffering": "no"
+    })
+
+  def prev_messages(self, artifact: ArtifactContent) -> list[dict[str, str]]:
+    # Reconstruct messages from what was sent
+    prev_messages = []
+    for prompt, resp in zip(artifact.prompts, artifact.response_contents):
+      prev_messages.append(self.bot.user_message(prompt))
+      prev_messages.append(self.bot.assistant_message(resp))
+    return prev_messages
+
+def sse(event: str, data: str) -> str:
+  # One server-sent event. `data` is JSON, which never has a raw newline in it, so it fits on one data line.
+  return f"event: {event}\ndata: {data}\n\n"
+
 # Setup our vector database wrapper, needed to create a Bot, which relies on helper functions
 # from the VectorDatabase class
-vec_db = VectorDatabase(db_path=os.path.join(os.path.dirname(__file__), "vector_db"))
+# VECTOR_DB_BACKEND=numpy serves queries from the exact in-memory index instead of Chroma's HNSW,
+# VECTOR_DB_QUANTIZED=1 keeps only its int8 codes in memory (rescoring from the full vectors on disk), and
+# VECTOR_DB_SHORTLIST=n searches the coarse 256 dimension view first, reranking the best n at full dimension
+vec_db = VectorDatabase(
+  db_path=os.path.join(os.path.dirname(__file__), "vector_db"),
+  backend=os.getenv("VECTOR_DB_BACKEND", "chroma"),
+  quantized=os.getenv("VECTOR_DB_QUANTIZED", "") not in ("", "0"),
+  shortlist=int(os.getenv("VECTOR_DB_SHORTLIST", "0")) or None,
+  # Query embeddings are cached in memory, and in this SQLite file too if it's set (shared by every worker)
+  query_cache_path=os.getenv("QUERY_CACHE_PATH") or None
+)
 
+# Pick up new index versions published by `create_vector_db.py --mode build` without restarting
+vec_db.watch(interval=30)
+
+# HYBRID_RETRIEVAL=1 also searches courses.db's full text index, and ranks courses by both scores
+# (HYBRID_LEXICAL_WEIGHT, 0.5 by default, is the lexical share)
+retriever = None
+if os.getenv("HYBRID_RETRIEVAL", "") not in ("", "0"):
+  retriever = HybridRetriever(vec_db, lexical_weight=float(os.getenv("HYBRID_LEXICAL_WEIGHT", "0.5")))
+
+# LOCAL_KEYWORDS=1 finds the keywords of simple queries from courses.db's subjects, instructors and vocabulary, and
+# only asks gpt-3.5-turbo when that's less than KEYWORD_MIN_CONFIDENCE (0.75 by default) confident
+keyword_extractor = None
+if os.getenv("LOCAL_KEYWORDS", "") not in ("", "0"):
+  keyword_extractor = KeywordExtractor(min_confidence=float(os.getenv("KEYWORD_MIN_CONFIDENCE", "0.75")))
+
+# ANSWER_CACHE=1 reuses the answer to a first turn query for later ones at least ANSWER_CACHE_SIMILARITY (0.92) similar,
+# answered from the same course info, for ANSWER_CACHE_TTL seconds (an hour), keeping ANSWER_CACHE_SIZE (1024) at most
+answer_cache = None
+if os.getenv("ANSWER_CACHE", "") not in ("", "0"):
+  answer_cache = AnswerCache(
+    max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    similarity=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.92"))
+  )
+
+# SPECULATIVE_RETRIEVAL=1 searches on the raw query while the keywords are being extracted, instead of after
+# (SPECULATIVE_REUSE_SIMILARITY, 0.9 by default, is how close the keywords must be to use that search as it is)
 # CODE POINTER: Instantiate the Bot! Our AI Assistant is alive!
-bot = Bot(vector_db=vec_db)
+bot = Bot(
+  vector_db=vec_db,
+  retriever=retriever,
+  speculative=os.getenv("SPECULATIVE_RETRIEVAL", "") not in ("", "0"),
+  reuse_similarity=float(os.getenv("SPECULATIVE_REUSE_SIMILARITY", "0.9")),
+  keyword_extractor=keyword_extractor,
+  answer_cache=answer_cache
+)
 
 # Create the Server, using the bot to answer questions :)
 server = Server(bot=bot)
@@ -1,6 +1,14 @@
 import os
+import asyncio
+import threading
+import time
 import chromadb
+import numpy as np
+import openai
 from chromadb.utils import embedding_functions
+from scripts.index_versions import current_version, read_manifest, resolve, version_path
+from scripts.embedding_cache import QueryEmbeddingCache
+from scripts.exact_index import ExactIndex, collection_space, exact_index_path, export_collection, group_hits, read_stamp
 
 class VectorDatabase:
     """
@@ -8,25 +16,204 @@ class VectorDatabase:
     providing a simple interface for interacting with the database.
     """
 
-    def __init__(self, db_path=None):
+    def __init__(self, db_path=None, retire_after=60.0, backend="chroma", quantized=False, shortlist=None,
+        query_cache_size=4096, query_cache_ttl=7 * 24 * 3600, query_cache_path=None
+    ):
         """
         Initialize a VectorDatabase instance.
 
         Args:
             db_path (str, optional): the path to the database. Defaults to None.
+                If it holds versions (see scripts/index_versions.py), the current one is served.
+            retire_after (float, optional): seconds an old version stays open after `reload` swaps it out,
+                so queries already running on it can finish. Defaults to 60.
+            backend (str, optional): what `query` searches with. "chroma" queries the Chroma collection (HNSW),
+                "numpy" searches an export of it exactly, in memory (see scripts/exact_index.py). Defaults to "chroma".
+            quantized (bool, optional): for the numpy backend, hold only int8 codes of the vectors in memory (a quarter
+                of the size), and rescore their shortlist from the full vectors on disk. Defaults to False.
+            shortlist (int, optional): the default `shortlist` of `query`. Defaults to None.
+            query_cache_size (int, optional): query embeddings kept in memory (see scripts/embedding_cache.py),
+                0 to embed every query afresh. Defaults to 4096.
+            query_cache_ttl (float, optional): seconds a cached query embedding is used for. Defaults to a week.
+            query_cache_path (str, optional): a SQLite file to also keep query embeddings in, across restarts and
+                workers. Defaults to None (memory only).
         """
+        if backend not in ("chroma", "numpy"):
+            raise ValueError(f"Unknown vector database backend {backend}")
+        self.backend = backend
+        self.quantized = quantized
+        self.shortlist = shortlist
 
         # OpenAI Embedding Function
+        self.embedding_model = "text-embedding-3-small"
         self.embedding_function = embedding_functions.OpenAIEmbeddingFunction(
             api_key=os.getenv("OPENAI_API_KEY"),
-            model_name="text-embedding-3-small",
+            model_name=self.embedding_model,
         )
+        # Created on first use of `aembed_queries`, inside the event loop that awaits it
+        self.async_client = None
+
+        # Query embeddings we've already paid for, so repeated keyword strings skip the API round trip
+        self.query_cache = QueryEmbeddingCache(
+            "text-embedding-3-small", max_entries=query_cache_size, ttl=query_cache_ttl, path=query_cache_path
+        ) if query_cache_size else None
 
         # Store ChromaDB persistent path
         self.db_path = db_path
 
-        # Setup ChromaDB vector database
-        self.client = chromadb.PersistentClient(path=db_path)
+        # Setup ChromaDB vector database, at the version of the index being served
+        self.retire_after = retire_after
+        self.reload_lock = threading.Lock()
+        self.version = current_version(db_path) if db_path else None
+        self.served_path = resolve(db_path) if db_path else "."
+        self.client = chromadb.PersistentClient(path=self.served_path if db_path else db_path)
+
+        # Exact indexes by collection name, for the numpy backend. Exported from Chroma if there isn't one yet.
+        self.exact_indexes = self.__load_exact_indexes(self.client, self.served_path) if backend == "numpy" else {}
+
+
+    def manifest(self) -> dict:
+        """The manifest of the version being served ({} for an unversioned database)."""
+        return read_manifest(self.served_path) if self.version else {}
+
+
+    def reload(self) -> bool:
+        """
+        Switches to the version the database's CURRENT pointer now names, if it changed.
+
+        The new version is opened and warmed up (its index loaded into memory) before the swap, so no query
+        waits on it. The swap is a single assignment, so queries already running finish on the old version,
+        which is closed `retire_after` seconds later.
+
+        Returns:
+            bool: whether a new version was swapped in.
+        """
+        with self.reload_lock:
+            version = current_version(self.db_path) if self.db_path else None
+            if version is None or version == self.version:
+                # Same version, but its exact indexes may have been re-exported after an in place update
+                if self.__exact_indexes_stale():
+                    self.exact_indexes = self.__load_exact_indexes(self.client, self.served_path)
+                    print(f"Vector database: reloaded exact indexes of version {self.version}")
+                    return True
+                return False
+
+            served_path = version_path(self.db_path, version)
+            client = chromadb.PersistentClient(path=served_path)
+            for name in self.__collection_names(client):
+                self.__warm_up(client.get_collection(name))
+            exact_indexes = self.__load_exact_indexes(client, served_path) if self.backend == "numpy" else {}
+
+            (old_client, self.client) = (self.client, client)
+            (old_version, self.version) = (self.version, version)
+            (self.served_path, self.exact_indexes) = (served_path, exact_indexes)
+
+        print(f"Vector database: switched from version {old_version} to {version}")
+        timer = threading.Timer(self.retire_after, self.__retire, args=(old_client,))
+        timer.daemon = True
+        timer.start()
+        return True
+
+
+    def watch(self, interval=30.0) -> threading.Thread:
+        """
+        Starts a background thread calling `reload` every `interval` seconds, so a running server picks up
+        newly published versions by itself.
+
+        Args:
+            interval (float, optional): seconds between checks of the pointer. Defaults to 30.
+
+        Returns:
+            threading.Thread: the (daemon) watcher thread.
+        """
+        def watcher():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except Exception as e:
+                    # Keep serving the old version, and try again next time
+                    print(f"Vector database: reload failed, still serving version {self.version}: {e}")
+
+        thread = threading.Thread(target=watcher, daemon=True)
+        thread.start()
+        return thread
+
+
+    def __warm_up(self, collection):
+        """Runs one query against `collection`, which makes Chroma load its index from disk."""
+        sample = collection.peek(limit=1)
+        if len(sample["ids"]):
+            collection.query(query_embeddings=[sample["embeddings"][0]], n_results=1)
+
+
+    def __collection_names(self, client) -> list[str]:
+        # Older Chroma versions list Collection objects, newer ones just the names
+        return [getattr(collection, "name", collection) for collection in client.list_collections()]
+
+
+    def __load_exact_indexes(self, client, served_path: str) -> dict:
+        """Loads the exact index of every collection of `client` (served from `served_path`), exporting any that are missing."""
+        indexes = {}
+        for name in self.__collection_names(client):
+            path = exact_index_path(served_path, name)
+            if read_stamp(path) is None:
+                export_collection(client.get_collection(name), path)
+            indexes[name] = ExactIndex(path, quantized=self.quantized)
+        return indexes
+
+
+    def __exact_indexes_stale(self) -> bool:
+        return any(index.stamp != read_stamp(index.path) for index in self.exact_indexes.values())
+
+
+    def __retire(self, client):
+        # Clients of the same path are shared, `close` only stops it once nothing else has it open
+        close = getattr(client, "close", None)
+        if close is not None:
+            close()
+
+
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+        """
+        Embed query strings, from the query cache where possible, and the rest in one call.
+
+        Args:
+            queries (list[str]): the queries to embed.
+
+        Returns:
+            np.ndarray: one float32 embedding per query.
+        """
+        if self.query_cache is None:
+            return np.asarray(self.embedding_function(list(queries)), dtype=np.float32)
+        return self.query_cache.embed(queries, self.embedding_function)
+
+
+    async def aembed_queries(self, queries: list[str]) -> np.ndarray:
+        """
+        Async `embed_queries`: the embedding call for whatever the query cache misses is awaited, on AsyncOpenAI.
+
+        Args:
+            queries (list[str]): the queries to embed.
+
+        Returns:
+            np.ndarray: one float32 embedding per query.
+        """
+        if self.query_cache is None:
+            return np.asarray(await self.__aembed(list(queries)), dtype=np.float32)
+        return await self.query_cache.aembed(queries, self.__aembed)
+
+
+    async def __aembed(self, texts: list[str]) -> list[list[float]]:
+        if self.async_client is None:
+            self.async_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        response = await self.async_client.embeddings.create(input=texts, model=self.embedding_model)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+    def query_cache_stats(self) -> dict:
+        """Hit rate and size of the query embedding cache ({} when it's off)."""
+        return self.query_cache.stats() if self.query_cache else {}
 
 
     def get(self, source: str, ids: list[str]):
@@ -37,43 +224,159 @@ class VectorDatabase:
         return collection.get(ids=ids, include=["documents", "metadatas"])
 
 
-    def query(self, source: str, query: str, n_results=2, filters={}) -> list[dict]:
+    def query(
+        self, source: str, query: str = None, n_results=2, filters={}, group_by=None, aggregate="max", overfetch=4,
+        shortlist=None, query_embedding=None
+    ) -> list[dict]:
         """
         Query a collection/namespace in the vector database.
 
         Args:
             source (str): the name of the collection/namespace to query.
-            query (str): the query to use.
+            query (str): the query to use. Embedded through the query cache.
             n_results (int, optional): the number of results to return. Defaults to 2.
             filters (dict, optional): a dictionary of filters to apply. Defaults to an empty dictionary.
+            group_by (str, optional): a metadata field (e.g. "courseID") to return `n_results` distinct values of,
+                instead of `n_results` chunks. Each result is the group's closest chunk, with a "group_score"
+                and all of its "chunks". Defaults to None.
+            aggregate (str, optional): how a group is scored from its chunks' similarities, "max" or "sum".
+                Defaults to "max".
+            overfetch (int, optional): chunks fetched per wanted group, so a single query finds enough distinct
+                groups. Defaults to 4.
+            shortlist (int, optional): for the numpy backend, search in two stages: rank every row by the coarse
+                (first 256 dimensions) view of its embedding, then rerank the best `shortlist` with every dimension.
+                Chroma's HNSW search doesn't scan every row to begin with, so it ignores this.
+                Defaults to the database's `shortlist`, and None for a single full search.
+            query_embedding (list[float], optional): an embedding to search with instead of embedding `query`.
+                Defaults to None.
 
         Returns:
             dict: a dictionary containing the results of the query.
         """
 
+        # Embed the query ourselves (or take the cached embedding), so neither backend calls the API for it
+        if query_embedding is None:
+            query_embedding = self.embed_queries([query])[0]
+        query_embeddings = np.asarray(query_embedding, dtype=np.float32)[None]
+
+        return self.__search(source, query_embeddings, n_results, filters, group_by, aggregate, overfetch, shortlist)[0]
+
+
+    async def aquery(self, source: str, query: str = None, query_embedding=None, **kwargs) -> list[dict]:
+        """
+        Async `query`, taking the same arguments. The query is embedded with `aembed_queries`, and the search itself
+        (CPU bound, or Chroma's local files) runs on a worker thread, off the event loop.
+        """
+        if query_embedding is None:
+            query_embedding = (await self.aembed_queries([query]))[0]
+        return await asyncio.to_thread(
+            self.query, source, query=query, query_embedding=query_embedding, **kwargs
+        )
+
+
+    def query_many(
+        self, source: str, queries: list[str], n_results=2, filters={}, fuse=False, rrf_k=60, group_by=None,
+        aggregate="max", overfetch=4, shortlist=None
+    ) -> dict:
+        """
+        Query a collection/namespace with several queries (e.g. rephrasings of one question) at once: every query
+        is embedded in a single call (less any the query cache has), and searched in a single batched search.
+
+        Args:
+            source (str): the name of the collection/namespace to query.
+            queries (list[str]): the queries to use.
+            n_results (int, optional): the number of results to return, per query and fused. Defaults to 2.
+            filters (dict, optional): a dictionary of filters to apply to every query. Defaults to an empty dictionary.
+            fuse (bool, optional): also rank everything found by reciprocal rank fusion, the sum of
+                1 / (`rrf_k` + rank) over the queries that found it. Defaults to False.
+            rrf_k (int, optional): how much the top few ranks of any one query dominate the fusion, lower is more.
+                Defaults to 60.
+            group_by, aggregate, overfetch, shortlist: as in `query`. With `group_by`, groups are what's fused.
+
+        Returns:
+            dict: "results", the results of each query (as `query` returns them), and "fused", the best `n_results`
+                by reciprocal rank fusion, each with its "rrf_score" and the indexes of the "queries" that found it
+                (None unless `fuse`).
+        """
+        if not queries:
+            return {"results": [], "fused": [] if fuse else None}
+
+        query_embeddings = self.embed_queries(queries)
+        results = self.__search(source, query_embeddings, n_results, filters, group_by, aggregate, overfetch, shortlist)
+        return {"results": results, "fused": self.__fuse(results, n_results, rrf_k, group_by) if fuse else None}
+
+
+    def __fuse(self, results: list[list[dict]], n_results: int, rrf_k: int, group_by=None) -> list[dict]:
+        """Reciprocal rank fusion of several queries' results, keyed by id (or group)."""
+        fused = {}
+        for (index, query_results) in enumerate(results):
+            for (rank, result) in enumerate(query_results, start=1):
+                key = result["metadata"].get(group_by) if group_by else result["id"]
+                if key not in fused:
+                    fused[key] = {**result, "rrf_score": 0.0, "queries": []}
+                elif result["score"] < fused[key]["score"]:
+                    # Keep whichever query got closest as the representative
+                    fused[key].update({**result, "rrf_score": fused[key]["rrf_score"], "queries": fused[key]["queries"]})
+                fused[key]["rrf_score"] += 1 / (rrf_k + rank)
+                fused[key]["queries"].append(index)
+        return sorted(fused.values(), key=lambda result: -result["rrf_score"])[:n_results]
+
+
+    def __search(
+        self, source: str, query_embeddings: np.ndarray, n_results: int, filters: dict, group_by, aggregate: str,
+        overfetch: int, shortlist
+    ) -> list[list[dict]]:
+        """Results of every row of `query_embeddings`, from one batched search of the backend."""
+        if self.backend == "numpy":
+            # Score them against every (filtered) row
+            index = self.exact_indexes[source]
+            shortlist = shortlist or self.shortlist
+            if group_by:
+                return index.query_grouped(
+                    query_embeddings, n_results, group_by, aggregate, overfetch, where=filters, shortlist=shortlist
+                )
+            return index.query(query_embeddings, n_results, where=filters, shortlist=shortlist)
+
         # Get ChromaDB collection
         collection = self.client.get_collection(
             source, embedding_function=self.embedding_function
         )
 
-        # Perform query
+        # Perform query (over-fetching chunks when grouping, since several can belong to the same group)
+        fetched = n_results * overfetch if group_by else n_results
         results = collection.query(
-            query_texts=query,
-            where=filters,
-            n_results=n_results,
+            query_embeddings=query_embeddings,
+            where=filters or None,
+            n_results=fetched,
         )
+        all_results = [self.__format_hits(results, q) for q in range(len(results["ids"]))]
+        if not group_by:
+            return all_results
 
-        # Format results
-        formatted_results = []
-        for i in range(len(results["ids"][0])):
-            formatted_results.append(
-                {
-                    "id": results["ids"][0][i],
-                    "metadata": results["metadatas"][0][i],
-                    "score": results["distances"][0][i],
-                }
-            )
+        # A query whose chunks come from too few groups is fetched again, four times wider each time, until it has
+        # `n_results` groups or the collection runs out of matching chunks (HNSW has no cheap "every row" like the
+        # exact index, so it's widened in steps rather than all at once)
+        space = collection_space(collection)
+        for (q, hits) in enumerate(all_results):
+            wanted = fetched
+            while len(hits) == wanted and len({hit["metadata"].get(group_by) for hit in hits}) < n_results:
+                wanted *= 4
+                hits = self.__format_hits(collection.query(
+                    query_embeddings=query_embeddings[q:q + 1],
+                    where=filters or None,
+                    n_results=wanted,
+                ), 0)
+            all_results[q] = group_hits(hits, n_results, group_by, aggregate, space)
+        return all_results
 
-            # Should add metadata here
 
-        return formatted_results
\ No newline at end of file
+    def __format_hits(self, results: dict, q: int) -> list[dict]:
+        """The hits of the `q`th query of a Chroma query result, as {id, metadata, score} dicts."""
+        return [
+            {
+                "id": results["ids"][q][i],
+                "metadata": results["metadatas"][q][i],
+                "score": results["distances"][q][i],
+            }
+            for i in range(len(results["ids"][q]))
+        ]
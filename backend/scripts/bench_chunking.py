@@ -0,0 +1,83 @@
+"""
+Throughput benchmark for chunk preparation (HTML stripping + building the v3 chunks), without any embedding.
+
+Streams the same synthetic (or real, with --catalog) term file through `prepare_chunks` three ways: parsing every
+description with BeautifulSoup in this process like we used to, the regex fast path in this process, and the fast
+path over a pool of `--processes` workers. Reports courses and chunks per second, and checks every way built
+exactly the same chunk texts.
+
+  python bench_chunking.py --catalog ../data/2248.json --processes 8
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from bs4 import BeautifulSoup
+
+# bench_embeddings -> create_embeddings sets up an OpenAI client on import, which wants a key
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+import chunking
+from bench_embeddings import synthetic_catalog
+from catalog import iter_courses
+from chunking import prepare_chunks, prepare_course_v3
+
+
+def beautifulsoup_text(markup: str) -> str:
+  return BeautifulSoup(markup, "html.parser").get_text()
+
+
+def html_catalog(num_courses: int) -> dict:
+  """The synthetic catalog from bench_embeddings, with descriptions marked up the way real ones are."""
+  rng = random.Random(1)
+  catalog = synthetic_catalog(num_courses)
+  for course in catalog["courses"]:
+    sentences = course["courseDescription"][len("<p>"):-len("</p>")].split(" seminar ")
+    course["courseDescription"] = "".join(
+      rng.choice(["<p>{}</p>", "<p><strong>{}</strong></p>\n", "{}<br />", "<em>{}</em> &amp; ", "{}&nbsp;"]).format(s)
+      for s in sentences
+    )
+  return catalog
+
+
+def run(catalog_path: str, processes: int) -> tuple[float, int, int, list[str]]:
+  """Returns (seconds, courses, chunks, texts) for preparing every course in `catalog_path`."""
+  start = time.perf_counter()
+  (courses, texts) = (0, [])
+  for (_, prepared) in prepare_chunks(iter_courses(catalog_path), prepare_course_v3, processes=processes):
+    courses += 1
+    texts.extend(text for (_, text, _) in prepared)
+  return (time.perf_counter() - start, courses, len(texts), texts)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--courses", type=int, default=5000, help="number of synthetic courses")
+  parser.add_argument("--catalog", help="use a real term file (e.g. ../data/2248.json) instead of synthetic courses")
+  parser.add_argument("--processes", type=int, default=os.cpu_count(), help="workers in the pool mode")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmp:
+    catalog_path = args.catalog
+    if catalog_path is None:
+      catalog_path = os.path.join(tmp, "bench.json")
+      with open(catalog_path, "w") as f:
+        json.dump(html_catalog(args.courses), f)
+
+    results = {}
+    fast_text = chunking.html_to_text
+    try:
+      chunking.html_to_text = beautifulsoup_text
+      results["beautifulsoup, 1 process"] = run(catalog_path, processes=1)
+    finally:
+      chunking.html_to_text = fast_text
+    results["fast path, 1 process"] = run(catalog_path, processes=1)
+    results[f"fast path, {args.processes} processes"] = run(catalog_path, processes=args.processes)
+
+  baseline = next(iter(results.values()))
+  print(f"{'mode':<28}{'seconds':>10}{'courses/s':>12}{'chunks/s':>12}{'speedup':>10}")
+  for (mode, (seconds, courses, chunks, texts)) in results.items():
+    assert texts == baseline[3], f"{mode} built different chunks"
+    print(f"{mode:<28}{seconds:>10.2f}{courses / seconds:>12.0f}{chunks / seconds:>12.0f}{baseline[0] / seconds:>9.1f}x")
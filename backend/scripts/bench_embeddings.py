@@ -0,0 +1,175 @@
+"""
+Throughput benchmark for the Embedder against a local stub of the OpenAI embeddings endpoint.
+
+Runs the same synthetic (or real, with --catalog) term file through the Embedder three times: sending one chunk
+per request like we used to, batching sequentially, and batching with `--in-flight` concurrent requests. Reports
+requests made and chunks embedded per second. The stub sleeps `--latency` seconds per request to stand in for the
+network round trip, and can answer every Nth request with a 429 (`--rate-limit-every`) to exercise the retries,
+so nothing here needs an API key or costs anything.
+
+  python bench_embeddings.py --courses 500 --latency 0.05 --in-flight 8
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# create_embeddings loads the .env on import and bails if there's no key, the stub doesn't care what it is
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+from openai import OpenAI
+from create_embeddings import Embedder
+
+
+def stub_vector(text: str, dim: int) -> list[float]:
+  """Deterministic fake embedding, so the same text always gets the same vector."""
+  rng = random.Random(hashlib.sha256(text.encode()).digest())
+  return [rng.uniform(-1, 1) for _ in range(dim)]
+
+
+class StubEmbeddingHandler(BaseHTTPRequestHandler):
+  """Answers POST .../embeddings the way the OpenAI API does (float or base64 encodings)."""
+  dim = 1536
+  latency = 0.0
+  rate_limit_every = 0
+  requests_seen = 0
+  requests_served = 0
+  lock = threading.Lock()
+
+  def do_POST(self):
+    body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    time.sleep(self.latency)
+
+    with self.lock:
+      StubEmbeddingHandler.requests_seen += 1
+      rate_limited = self.rate_limit_every and StubEmbeddingHandler.requests_seen % self.rate_limit_every == 0
+    if rate_limited:
+      payload = json.dumps({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}).encode()
+      self.send_response(429)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(payload)))
+      self.send_header("retry-after", "0.05")
+      self.end_headers()
+      self.wfile.write(payload)
+      return
+
+    data = []
+    for (i, text) in enumerate(texts):
+      vector = stub_vector(text, self.dim)
+      if body.get("encoding_format") == "base64":
+        vector = base64.b64encode(struct.pack(f"<{self.dim}f", *vector)).decode()
+      data.append({"object": "embedding", "index": i, "embedding": vector})
+
+    # Send them back shuffled, like the real API is allowed to
+    random.shuffle(data)
+    tokens = sum(len(text) // 4 for text in texts)
+    payload = json.dumps({
+      "object": "list",
+      "data": data,
+      "model": body["model"],
+      "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+    }).encode()
+
+    with self.lock:
+      StubEmbeddingHandler.requests_served += 1
+
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(payload)))
+    self.send_header("x-ratelimit-limit-requests", "10000")
+    self.send_header("x-ratelimit-limit-tokens", "10000000")
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def log_message(self, *args):
+    pass
+
+
+def synthetic_catalog(num_courses: int) -> dict:
+  """A term file shaped like data/<term>.json, with descriptions long enough to need a few chunks."""
+  rng = random.Random(0)
+  words = "algorithms data structures biology economics chemistry history writing seminar theory lab".split()
+  courses = []
+  for i in range(num_courses):
+    description = " ".join(rng.choice(words) for _ in range(rng.randint(40, 300)))
+    courses.append({
+      "courseID": str(100000 + i),
+      "courseDescription": f"<p>{description}</p>",
+      "courseNumber": str(i),
+      "courseTitle": f"Course {i}",
+      "termDescription": "2024 Fall",
+      "catalogSubject": "BENCH",
+      "catalogSubjectDescription": "Benchmarking",
+      "classLevelAttributeDescription": "Undergraduate",
+      "crossRegistrationEligibleAttribute": None,
+      "divisionalDistribution": None,
+      "quantitativeReasoning": None,
+      "publishedInstructors": [{"instructorName": "Ada Lovelace"}],
+      "meetings": [{"daysOfWeek": ["Monday", "Wednesday"]}]
+    })
+  return {"courses": courses}
+
+
+def run(embedder: Embedder, semester: str) -> tuple[float, int, int]:
+  """Embeds `semester`, returning (seconds, requests sent, chunks embedded)."""
+  StubEmbeddingHandler.requests_served = 0
+  start = time.perf_counter()
+  embedder.embed_semester_v3(semester)
+  elapsed = time.perf_counter() - start
+  return elapsed, StubEmbeddingHandler.requests_served, embedder.batcher.texts_embedded
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--courses", type=int, default=300, help="number of synthetic courses")
+  parser.add_argument("--catalog", help="use a real term file (e.g. ../data/2248.json) instead of synthetic courses")
+  parser.add_argument("--latency", type=float, default=0.05, help="seconds the stub waits per request")
+  parser.add_argument("--dim", type=int, default=1536)
+  parser.add_argument("--batch-size", type=int, default=256, help="max inputs per request in the batched modes")
+  parser.add_argument("--in-flight", type=int, default=8, help="concurrent requests in the concurrent mode")
+  parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every Nth request with a 429")
+  args = parser.parse_args()
+
+  StubEmbeddingHandler.dim = args.dim
+  StubEmbeddingHandler.latency = args.latency
+  StubEmbeddingHandler.rate_limit_every = args.rate_limit_every
+  server = ThreadingHTTPServer(("127.0.0.1", 0), StubEmbeddingHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  client = OpenAI(api_key="stub", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+
+  with tempfile.TemporaryDirectory() as tmp:
+    catalog = args.catalog
+    if catalog is None:
+      catalog = os.path.join(tmp, "bench.json")
+      with open(catalog, "w") as f:
+        json.dump(synthetic_catalog(args.courses), f)
+
+    results = {}
+    modes = [("unbatched", 1, 1), ("batched", args.batch_size, 1), ("concurrent", args.batch_size, args.in_flight)]
+    for (label, max_inputs, in_flight) in modes:
+      embedder = Embedder(
+        input_data={"bench": catalog},
+        output_path=tmp,
+        sample_output_path=tmp,
+        client=client,
+        max_inputs_per_request=max_inputs,
+        max_in_flight=in_flight
+      )
+      results[label] = run(embedder, "bench")
+      print()
+
+  server.shutdown()
+
+  print(f"{'mode':<12}{'seconds':>10}{'requests':>10}{'chunks':>10}{'chunks/s':>12}")
+  for (label, (elapsed, requests, chunks)) in results.items():
+    print(f"{label:<12}{elapsed:>10.2f}{requests:>10}{chunks:>10}{chunks / elapsed:>12.1f}")
+  for label in ["batched", "concurrent"]:
+    print(f"{label} speedup: {results['unbatched'][0] / results[label][0]:.1f}x")
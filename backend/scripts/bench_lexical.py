@@ -0,0 +1,96 @@
+"""
+Latency of finding courses by instructor name and course number: the `LIKE`/`OR` scans the agent writes against
+the courses table, against the courses_fts full text index `to_sql.py` builds (what `HybridRetriever` searches).
+
+Loads a synthetic catalog (or real term files, with --catalog) into a courses.db in a temporary directory, then
+times the same lookups both ways and checks they find the same courses.
+
+  python bench_lexical.py --courses 20000
+  python bench_lexical.py --catalog ../data/2248.json ../data/2252.json
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import numpy as np
+
+# bench_chunking -> bench_embeddings -> create_embeddings sets up an OpenAI client on import, which wants a key
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+from bench_chunking import html_catalog
+from catalog import iter_courses
+from to_sql import create_fts_index, create_table, insert_courses
+
+FIRST_NAMES = ["Ada", "Alan", "Grace", "Edsger", "Barbara", "Donald", "Frances", "John", "Radia", "Leslie"]
+LAST_NAMES = ["Lovelace", "Turing", "Hopper", "Dijkstra", "Liskov", "Knuth", "Allen", "McCarthy", "Perlman", "Lamport"]
+
+
+def synthetic_courses(num_courses: int) -> list[dict]:
+  """bench_chunking's catalog, with every course getting its own pair of instructors and the other fields to_sql needs."""
+  rng = random.Random(2)
+  courses = html_catalog(num_courses)["courses"]
+  for course in courses:
+    course["publishedInstructors"] = [
+      {"instructorName": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}{rng.randint(0, 99)}"} for _ in range(2)
+    ]
+    for field in ["sessionDescription", "catalogSchoolDescription", "courseNotes", "classCapacity",
+                  "subjectDescription", "courseComponent", "gradingBasisDescription"]:
+      course.setdefault(field, None)
+  return courses
+
+
+def timed(con, sql: str, params: list, repeat: int) -> tuple[float, set]:
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    rows = con.execute(sql, params).fetchall()
+    times.append(time.perf_counter() - start)
+  return np.median(times), {row[0] for row in rows}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--courses", type=int, default=20000, help="number of synthetic courses")
+  parser.add_argument("--catalog", nargs="+", help="real term files to load instead")
+  parser.add_argument("--lookups", type=int, default=50)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmp:
+    con = sqlite3.connect(os.path.join(tmp, "courses.db"))
+    cursor = con.cursor()
+    create_table(cursor)
+    create_fts_index(cursor)
+    if args.catalog:
+      for path in args.catalog:
+        insert_courses(cursor, iter_courses(path))
+    else:
+      insert_courses(cursor, synthetic_courses(args.courses))
+    con.commit()
+
+    rows = con.execute("SELECT courseNumber, publishedInstructors FROM courses").fetchall()
+    rng = random.Random(3)
+    picked = [rows[i] for i in rng.sample(range(len(rows)), min(args.lookups, len(rows)))]
+    print(f"{len(rows)} courses, {len(picked)} lookups of each kind")
+
+    lookups = {
+      "instructor": [(sql_names.split('"')[1].split()[-1]) for (_, sql_names) in picked if '"' in sql_names],
+      "course number": [number for (number, _) in picked if number],
+    }
+    columns = ["courseTitle", "courseDescription", "publishedInstructors", "courseNumber"]
+    for (kind, terms) in lookups.items():
+      (like_times, fts_times, agree) = ([], [], 0)
+      for term in terms:
+        # What the agent writes: a case insensitive substring match over every column a course might mention it in
+        like_sql = f"SELECT courseID FROM courses WHERE {' OR '.join(f'{column} LIKE ?' for column in columns)}"
+        (like_time, like_ids) = timed(con, like_sql, [f"%{term}%"] * len(columns), 3)
+        fts_sql = "SELECT c.courseID FROM courses_fts JOIN courses c ON c.rowid = courses_fts.rowid WHERE courses_fts MATCH ?"
+        (fts_time, fts_ids) = timed(con, fts_sql, [f'"{term}"'], 3)
+        like_times.append(like_time)
+        fts_times.append(fts_time)
+        agree += fts_ids <= like_ids and bool(fts_ids)
+      print(
+        f"{kind:<14} LIKE scan p50 {np.median(like_times) * 1000:8.3f} ms   FTS5 p50 {np.median(fts_times) * 1000:8.3f} ms"
+        f"   ({np.median(like_times) / np.median(fts_times):.0f}x, FTS5 found a subset of LIKE's courses {agree}/{len(terms)} times)"
+      )
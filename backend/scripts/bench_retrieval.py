@@ -0,0 +1,268 @@
+"""
+Offline recall/latency benchmark of course retrieval: how Chroma's HNSW settings (M, ef_construction, ef_search),
+the other backends (exact numpy, int8, two stage) and n_results trade recall against latency, on our own data.
+
+Every query in a labelled set names the courseIDs it should find. Chunks are searched and grouped by course, like
+`VectorDatabase.query(group_by="courseID")` does, and for each setting and k this reports recall@k (the fraction of a
+query's courses in its top k), MRR (1 / rank of its first course, 0 outside the top k) and p50/p99 latency.
+
+Nothing calls an API, with either kind of embedding:
+  --embedding stored  searches the collection's own vectors, with queries' stored "embedding"s. Without a labelled
+                      set, the queries are noisy copies of stored chunk vectors, labelled with their course.
+  --embedding local   re-embeds every chunk's text, and the queries, with `HashingEmbedding`, a deterministic local
+                      stand-in. Without a labelled set, the queries are course titles and snippets of chunk text.
+A labelled set is JSON lines of {"query": "...", "courseIDs": ["..."]}, plus "embedding" for --embedding stored
+(`--embed-queries` fills those in, the one time this needs the OpenAI API). `--save-queries` keeps a generated set.
+
+HNSW settings each get a copy of the collection in a temporary directory (building one takes a while).
+
+  python bench_retrieval.py --embedding local --M 8 16 32 --ef-search 10 50 100 -k 1 3 10
+  python bench_retrieval.py --db ../vector_db --queries ../benchmarks/queries.jsonl --embedding stored
+"""
+import argparse
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import zlib
+import chromadb
+import numpy as np
+from chromadb.api.client import SharedSystemClient
+from config import CONFIG
+from exact_index import ExactIndex, collection_space, export_collection, group_hits, normalise
+from index_versions import resolve
+
+
+class HashingEmbedding:
+  """
+    Deterministic local embedding: words and pairs of words hashed (crc32) into `dim` signed buckets, with sublinear
+    counts, L2 normalised. Crude next to a real model, but texts sharing words land near each other, which is all an
+    offline benchmark of the search itself needs.
+  """
+
+  def __init__(self, dim=512):
+    self.dim = dim
+
+  def __call__(self, texts: list[str]) -> np.ndarray:
+    vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+    for (row, text) in enumerate(texts):
+      words = re.findall(r"\w+", (text or "").lower())
+      counts = {}
+      for feature in words + [f"{a} {b}" for (a, b) in zip(words, words[1:])]:
+        counts[feature] = counts.get(feature, 0) + 1
+      for (feature, count) in counts.items():
+        h = zlib.crc32(feature.encode("utf-8"))
+        vectors[row, h % self.dim] += (1 if h & 0x80000000 else -1) * (1 + np.log(count))
+    return normalise(vectors)
+
+
+def read_collection(collection, page_size=5000) -> tuple[list[str], np.ndarray, list[dict]]:
+  """Every (id, embedding, metadata) of `collection`."""
+  (ids, vectors, metadatas) = ([], [], [])
+  while True:
+    page = collection.get(include=["embeddings", "metadatas"], limit=page_size, offset=len(ids))
+    ids.extend(page["ids"])
+    if len(page["ids"]):
+      vectors.append(np.asarray(page["embeddings"], dtype=np.float32))
+    metadatas.extend(page["metadatas"])
+    if len(page["ids"]) < page_size:
+      break
+  return ids, np.concatenate(vectors), metadatas
+
+
+def load_queries(path: str) -> list[dict]:
+  with open(path, "r") as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def save_queries(path: str, queries: list[dict]):
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(path, "w") as f:
+    for query in queries:
+      f.write(json.dumps({k: (v.tolist() if isinstance(v, np.ndarray) else v) for (k, v) in query.items()}) + "\n")
+
+
+def make_queries(vectors: np.ndarray, metadatas: list[dict], num_queries: int, embedding: str, seed=0) -> list[dict]:
+  """A labelled set drawn from the collection itself (see the top of this file), the same one for the same `seed`."""
+  rng = random.Random(seed)
+  noise = np.random.default_rng(seed)
+  rows = rng.sample(range(len(metadatas)), min(num_queries, len(metadatas)))
+
+  # Courses that share a title are all right answers to it
+  by_title = {}
+  for metadata in metadatas:
+    by_title.setdefault(metadata.get("courseTitle"), set()).add(str(metadata["courseID"]))
+
+  queries = []
+  for (i, row) in enumerate(rows):
+    metadata = metadatas[row]
+    course_id = str(metadata["courseID"])
+    if embedding == "stored":
+      vector = vectors[row] + 0.5 * noise.standard_normal(vectors.shape[1]) * np.linalg.norm(vectors[row]) / np.sqrt(vectors.shape[1])
+      queries.append({"query": f"noisy copy of chunk {row}", "courseIDs": [course_id], "embedding": vector.astype(np.float32)})
+    elif i % 2 == 0 and metadata.get("courseTitle"):
+      queries.append({"query": metadata["courseTitle"], "courseIDs": sorted(by_title[metadata["courseTitle"]])})
+    else:
+      words = (metadata.get("text") or "").split()
+      start = rng.randrange(max(len(words) - 8, 1))
+      queries.append({"query": " ".join(words[start:start + 8]), "courseIDs": [course_id]})
+  return queries
+
+
+def embed_queries(queries: list[dict]):
+  """Fills in the "embedding" of every query with the real embedding model (online, once per labelled set)."""
+  from openai import OpenAI
+  from utils import load_env
+  load_env()
+  client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+  for start in range(0, len(queries), 512):
+    batch = queries[start:start + 512]
+    response = client.embeddings.create(input=[query["query"] for query in batch], model=CONFIG.embedding_model)
+    for (query, item) in zip(batch, response.data):
+      query["embedding"] = item.embedding
+
+
+def build_collection(path: str, name: str, ids, vectors, metadatas, space: str, M: int, ef_construction: int):
+  """A copy of the collection with the given HNSW settings, in its own Chroma database at `path`."""
+  client = chromadb.PersistentClient(path=path)
+  collection = client.create_collection(name, configuration={
+    "hnsw": {"space": space, "max_neighbors": M, "ef_construction": ef_construction}
+  })
+  batch_size = client.get_max_batch_size()
+  for start in range(0, len(ids), batch_size):
+    collection.add(
+      ids=ids[start:start + batch_size],
+      embeddings=vectors[start:start + batch_size],
+      metadatas=metadatas[start:start + batch_size]
+    )
+    print(f"\rBuilding M={M} ef_construction={ef_construction}: {min(start + batch_size, len(ids))}/{len(ids)}", end="")
+  print()
+  return client
+
+
+def with_ef_search(path: str, name: str, ef_search: int):
+  """The collection at `path`, reopened so a new ef_search applies (Chroma only reads it when loading the index)."""
+  chromadb.PersistentClient(path=path).get_collection(name).modify(configuration={"hnsw": {"ef_search": ef_search}})
+  SharedSystemClient.clear_system_cache()
+  return chromadb.PersistentClient(path=path).get_collection(name)
+
+
+def chroma_search(collection, space: str, overfetch: int):
+  def search(vector: np.ndarray, k: int) -> list[str]:
+    results = collection.query(query_embeddings=[vector], n_results=k * overfetch, include=["metadatas", "distances"])
+    hits = [
+      {"id": id, "metadata": metadata, "score": distance}
+      for (id, metadata, distance) in zip(results["ids"][0], results["metadatas"][0], results["distances"][0])
+    ]
+    return [str(hit["metadata"]["courseID"]) for hit in group_hits(hits, k, "courseID", "max", space)]
+  return search
+
+
+def exact_search(index: ExactIndex, overfetch: int, shortlist=None):
+  def search(vector: np.ndarray, k: int) -> list[str]:
+    hits = index.query_grouped(vector, k, "courseID", overfetch=overfetch, shortlist=shortlist)[0]
+    return [str(hit["metadata"]["courseID"]) for hit in hits]
+  return search
+
+
+def evaluate(search, queries: list[dict], vectors: np.ndarray, k: int) -> dict:
+  """recall@k, MRR and latency percentiles of `search` (vector, k -> courseIDs, best first) over the labelled set."""
+  (recalls, reciprocal_ranks, times) = ([], [], [])
+  search(vectors[0], k)   # warm up (loads an HNSW index, pages in vectors)
+  for (query, vector) in zip(queries, vectors):
+    start = time.perf_counter()
+    found = search(vector, k)
+    times.append(time.perf_counter() - start)
+
+    expected = set(query["courseIDs"])
+    recalls.append(len(expected & set(found)) / len(expected))
+    rank = next((rank for (rank, course_id) in enumerate(found, start=1) if course_id in expected), None)
+    reciprocal_ranks.append(1 / rank if rank else 0.0)
+  return {
+    "recall": np.mean(recalls),
+    "mrr": np.mean(reciprocal_ranks),
+    "p50": np.percentile(times, 50) * 1000,
+    "p99": np.percentile(times, 99) * 1000,
+  }
+
+
+def print_row(backend: str, setting: str, k: int, result: dict):
+  print(
+    f"{backend:<8}{setting:<36}{k:>4}{result['recall']:>11.3f}{result['mrr']:>8.3f}"
+    f"{result['p50']:>10.2f}{result['p99']:>10.2f}", flush=True
+  )
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--db", default=CONFIG.vector_db_path, help="vector_db to benchmark (the version it serves)")
+  parser.add_argument("--collection", default=CONFIG.collection_name)
+  parser.add_argument("--queries", help="labelled query set (JSON lines), generated from the collection if not given")
+  parser.add_argument("--num-queries", type=int, default=200, help="size of a generated query set")
+  parser.add_argument("--save-queries", help="write the (generated or embedded) query set here")
+  parser.add_argument("--embed-queries", action="store_true", help="embed the labelled set with the real model first")
+  parser.add_argument("--embedding", default="stored", choices=["stored", "local"])
+  parser.add_argument("--local-dim", type=int, default=512, help="dimensions of the local hashing embedding")
+  parser.add_argument("-k", type=int, nargs="+", default=[1, 3, 5, 10], help="courses retrieved (n_results)")
+  parser.add_argument("--M", type=int, nargs="+", default=[16], help="HNSW max_neighbors to build with")
+  parser.add_argument("--ef-construction", type=int, nargs="+", default=[100])
+  parser.add_argument("--ef-search", type=int, nargs="+", default=[10, 50, 100, 200])
+  parser.add_argument("--overfetch", type=int, default=4, help="chunks searched per course wanted")
+  parser.add_argument("--rescore", type=int, default=4, help="int8 shortlist, times the chunks wanted")
+  parser.add_argument("--shortlist", type=int, nargs="+", default=[100, 400], help="two stage shortlist sizes")
+  args = parser.parse_args()
+
+  served = chromadb.PersistentClient(path=resolve(args.db)).get_collection(args.collection)
+  space = collection_space(served)
+  (ids, vectors, metadatas) = read_collection(served)
+  print(f"{len(ids)} chunks of {len({str(m['courseID']) for m in metadatas})} courses in {args.collection}, {space} space")
+
+  queries = load_queries(args.queries) if args.queries else make_queries(vectors, metadatas, args.num_queries, args.embedding)
+  if args.embed_queries:
+    embed_queries(queries)
+  if args.save_queries:
+    save_queries(args.save_queries, queries)
+
+  if args.embedding == "local":
+    embedding_function = HashingEmbedding(args.local_dim)
+    vectors = embedding_function([metadata.get("text") for metadata in metadatas])
+    query_vectors = embedding_function([query["query"] for query in queries])
+  else:
+    if any(query.get("embedding") is None for query in queries):
+      parser.error("--embedding stored needs an embedding for every query (see --embed-queries)")
+    query_vectors = np.asarray([query["embedding"] for query in queries], dtype=np.float32)
+  print(f"{len(queries)} labelled queries, {args.embedding} embeddings of dimension {vectors.shape[1]}")
+
+  print(f"{'backend':<8}{'setting':<36}{'k':>4}{'recall@k':>11}{'MRR':>8}{'p50 ms':>10}{'p99 ms':>10}")
+  with tempfile.TemporaryDirectory() as tmp:
+    built = []
+    if args.embedding == "stored":
+      for k in args.k:
+        print_row("chroma", "served collection, as configured", k, evaluate(chroma_search(served, space, args.overfetch), queries, query_vectors, k))
+
+    for M in args.M:
+      for ef_construction in args.ef_construction:
+        path = os.path.join(tmp, f"hnsw_{M}_{ef_construction}")
+        build_collection(path, args.collection, ids, vectors, metadatas, space, M, ef_construction)
+        built.append(path)
+        for ef_search in args.ef_search:
+          collection = with_ef_search(path, args.collection, ef_search)
+          for k in args.k:
+            setting = f"M={M} ef_construction={ef_construction} ef={ef_search}"
+            print_row("chroma", setting, k, evaluate(chroma_search(collection, space, args.overfetch), queries, query_vectors, k))
+
+    # The numpy backends search an export of the same vectors
+    export_path = os.path.join(tmp, "exact")
+    export_collection(
+      chromadb.PersistentClient(path=built[0]).get_collection(args.collection), export_path, coarse_dims=CONFIG.coarse_dims
+    )
+    (exact, quantized) = (ExactIndex(export_path), ExactIndex(export_path, quantized=True, rescore=args.rescore))
+    for k in args.k:
+      print_row("numpy", "exact", k, evaluate(exact_search(exact, args.overfetch), queries, query_vectors, k))
+      print_row("numpy", f"int8, rescore {args.rescore}x", k, evaluate(exact_search(quantized, args.overfetch), queries, query_vectors, k))
+      if exact.coarse is not None and exact.coarse.shape[1] < vectors.shape[1]:
+        for shortlist in args.shortlist:
+          setting = f"two stage, {exact.coarse.shape[1]} dims, shortlist {shortlist}"
+          print_row("numpy", setting, k, evaluate(exact_search(exact, args.overfetch, shortlist), queries, query_vectors, k))
@@ -0,0 +1,180 @@
+"""
+Latency and recall of the two VectorDatabase backends: Chroma (HNSW + SQLite metadata) against the exact NumPy index.
+
+Runs the same query vectors through `collection.query` and `ExactIndex.search`, one at a time like the server does,
+with and without metadata filters, and reports p50/p99 latency and Chroma's recall@k against the exact results
+(which are the ground truth). Also times the exact index answering every query in one batched call, and the int8
+quantized index (`ExactIndex(quantized=True)`) at each `--rescore` shortlist size: its latency, recall@k and how
+much memory it holds against the float32 vectors. Last, two stage search (`shortlist=`) at each `--shortlist` size:
+the coarse view of the first `--coarse-dims` dimensions ranks every row, and only the shortlist is reranked.
+
+Synthetic vectors have their variance concentrated in the leading dimensions, like the Matryoshka embeddings of
+text-embedding-3-*. Two stage recall is only meaningful on an index of such embeddings (a real --db is best).
+
+Uses a real database (--db, e.g. ../vector_db, the version it currently serves) or builds a synthetic clustered one,
+and queries with noisy copies of stored vectors, so nothing needs an API key.
+
+  python bench_vector_search.py --rows 20000 --queries 200
+  python bench_vector_search.py --db ../vector_db --rescore 1 2 4 8 --shortlist 50 100 200
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import chromadb
+from exact_index import ExactIndex, exact_index_path, export_collection, normalise, read_stamp
+from index_versions import resolve
+
+TERMS = ["2024 Fall", "2025 Spring"]
+
+
+def synthetic_collection(chroma_client, rows: int, dim: int, batch_size: int):
+  """
+    Clustered unit vectors (like real embeddings, unlike uniform noise) with a term and subject each. Every
+    dimension carries less than the one before it, so a prefix is a coarse version of the vector, as in Matryoshka
+    embeddings.
+  """
+  rng = np.random.default_rng(0)
+  falloff = 1 / np.sqrt(1 + np.arange(dim) / 64)
+  centres = normalise(rng.standard_normal((max(rows // 100, 1), dim)) * falloff)
+  collection = chroma_client.create_collection("bench_chunks")
+  for start in range(0, rows, batch_size):
+    count = min(batch_size, rows - start)
+    vectors = normalise(centres[rng.integers(len(centres), size=count)] + 0.6 * rng.standard_normal((count, dim)) / np.sqrt(dim))
+    collection.add(
+      ids=[str(start + i) for i in range(count)],
+      embeddings=vectors,
+      metadatas=[{"termDescription": TERMS[(start + i) % 2], "catalogSubject": f"SUBJ{(start + i) % 40}"} for i in range(count)]
+    )
+    print(f"\rBuilding synthetic collection: {start + count}/{rows}", end="")
+  print()
+  return collection
+
+
+def percentiles(seconds: list[float]) -> str:
+  return f"p50 {np.percentile(seconds, 50) * 1000:7.2f} ms  p99 {np.percentile(seconds, 99) * 1000:7.2f} ms"
+
+
+def bench(collection, index: ExactIndex, queries: np.ndarray, k: int, where=None):
+  (chroma_times, exact_times, recalls) = ([], [], [])
+  for query in queries:
+    start = time.perf_counter()
+    chroma_ids = collection.query(query_embeddings=[query], n_results=k, where=where)["ids"][0]
+    chroma_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    exact = index.search(query, k, index.where_rows(where))[0]
+    exact_times.append(time.perf_counter() - start)
+
+    exact_ids = {index.ids[row] for (row, _) in exact}
+    recalls.append(len(exact_ids & set(chroma_ids)) / max(len(exact_ids), 1))
+
+  start = time.perf_counter()
+  index.search(queries, k, index.where_rows(where))
+  batched = (time.perf_counter() - start) / len(queries)
+
+  label = f"filter {where}" if where else "no filter"
+  print(f"{label}")
+  print(f"  chroma  {percentiles(chroma_times)}  recall@{k} {np.mean(recalls):.3f}")
+  print(f"  numpy   {percentiles(exact_times)}  recall@{k} 1.000 (exact)")
+  print(f"  numpy, all {len(queries)} queries in one batch: {batched * 1000:.2f} ms/query")
+
+
+def bench_quantized(index: ExactIndex, path: str, queries: np.ndarray, k: int, rescores: list[int], where=None):
+  rows = index.where_rows(where)
+  exact = [{row for (row, _) in hits} for hits in index.search(queries, k, rows)]
+  float_bytes = index.vectors.nbytes
+  label = f"filter {where}" if where else "no filter"
+  print(f"int8, {label}")
+  for rescore in rescores:
+    quantized = ExactIndex(path, quantized=True, rescore=rescore)
+    (times, recalls) = ([], [])
+    for (query, exact_rows) in zip(queries, exact):
+      start = time.perf_counter()
+      hits = quantized.search(query, k, rows)[0]
+      times.append(time.perf_counter() - start)
+      recalls.append(len(exact_rows & {row for (row, _) in hits}) / max(len(exact_rows), 1))
+    resident = quantized.codes.nbytes + quantized.scales.nbytes
+    print(
+      f"  rescore {rescore:>2}x  {percentiles(times)}  recall@{k} {np.mean(recalls):.3f}"
+      f"  in memory {resident / 2 ** 20:.1f} MiB vs {float_bytes / 2 ** 20:.1f} MiB float32 ({resident / float_bytes:.0%})"
+    )
+
+
+def bench_two_stage(index: ExactIndex, queries: np.ndarray, k: int, shortlists: list[int], where=None):
+  rows = index.where_rows(where)
+  exact = [{row for (row, _) in hits} for hits in index.search(queries, k, rows)]
+  (dims, coarse_dims) = (index.vectors.shape[1], index.coarse.shape[1])
+  label = f"filter {where}" if where else "no filter"
+  print(f"two stage, {coarse_dims} then {dims} dimensions, {label}")
+  for shortlist in shortlists:
+    (times, recalls) = ([], [])
+    for (query, exact_rows) in zip(queries, exact):
+      start = time.perf_counter()
+      hits = index.search(query, k, rows, shortlist=shortlist)[0]
+      times.append(time.perf_counter() - start)
+      recalls.append(len(exact_rows & {row for (row, _) in hits}) / max(len(exact_rows), 1))
+    scanned = len(rows) if rows is not None else index.rows
+    work = (scanned * dims) / (scanned * coarse_dims + min(shortlist, scanned) * dims)
+    print(f"  shortlist {shortlist:>4}  {percentiles(times)}  recall@{k} {np.mean(recalls):.3f}  {work:.1f}x fewer multiply-adds")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--db", help="an existing vector_db to benchmark, instead of a synthetic one")
+  parser.add_argument("--collection", default="course_chunks", help="collection in --db")
+  parser.add_argument("--rows", type=int, default=20000, help="synthetic collection size")
+  parser.add_argument("--dim", type=int, default=1536)
+  parser.add_argument("--queries", type=int, default=200)
+  parser.add_argument("-k", type=int, default=10, help="results per query")
+  parser.add_argument("--rescore", type=int, nargs="+", default=[1, 2, 4, 8], help="int8 shortlist sizes, times k")
+  parser.add_argument("--shortlist", type=int, nargs="+", default=[50, 100, 200, 400], help="two stage shortlist sizes")
+  parser.add_argument("--coarse-dims", type=int, default=256, help="dimensions of the coarse view, if exported here")
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmp:
+    if args.db:
+      db_path = resolve(args.db)
+      chroma_client = chromadb.PersistentClient(path=db_path)
+      collection = chroma_client.get_collection(args.collection)
+      index_path = exact_index_path(db_path, args.collection)
+      if read_stamp(index_path) is None:
+        index_path = os.path.join(tmp, "exact")
+        export_collection(collection, index_path, coarse_dims=args.coarse_dims)
+      wheres = [{"termDescription": TERMS[0]}]
+    else:
+      chroma_client = chromadb.PersistentClient(path=os.path.join(tmp, "chroma"))
+      collection = synthetic_collection(chroma_client, args.rows, args.dim, chroma_client.get_max_batch_size())
+      index_path = os.path.join(tmp, "exact")
+      export_collection(collection, index_path, coarse_dims=args.coarse_dims)
+      wheres = [
+        {"termDescription": TERMS[0]},
+        {"$and": [{"termDescription": TERMS[0]}, {"catalogSubject": "SUBJ2"}]},
+        {"$and": [{"termDescription": TERMS[0]}, {"$or": [{"catalogSubject": "SUBJ2"}, {"catalogSubject": "SUBJ4"}]}]},
+      ]
+
+    index = ExactIndex(index_path)
+    print(f"{index.rows} vectors of dimension {index.vectors.shape[1]}")
+
+    # Noisy copies of stored vectors, so every query has genuine near neighbours
+    rng = np.random.default_rng(1)
+    picked = index.vectors[rng.choice(index.rows, size=args.queries, replace=False)]
+    queries = normalise(picked + 0.5 * rng.standard_normal(picked.shape) / np.sqrt(picked.shape[1]))
+
+    # Warm both up (Chroma loads the HNSW index into memory on the first query)
+    collection.query(query_embeddings=[queries[0]], n_results=args.k)
+    index.search(queries[0], args.k)
+
+    bench(collection, index, queries, args.k)
+    for where in wheres:
+      bench(collection, index, queries, args.k, where)
+
+    bench_quantized(index, index_path, queries, args.k, args.rescore)
+    bench_quantized(index, index_path, queries, args.k, args.rescore, wheres[0])
+
+    if index.coarse is None:
+      print("No coarse view in this export, skipping two stage search")
+    else:
+      bench_two_stage(index, queries, args.k, args.shortlist)
+      bench_two_stage(index, queries, args.k, args.shortlist, wheres[0])
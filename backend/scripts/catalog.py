@@ -0,0 +1,132 @@
+"""
+Streaming reader for the raw course catalogs (data/<term>.json).
+
+The catalogs are one big object with the courses in a "courses" array. Rather than `json.load` the whole thing,
+`iter_courses` reads the file in fixed size blocks and decodes one course at a time, so memory stays flat however
+large the catalog (or however many terms/schools are in it), and stopping early stops reading.
+"""
+import codecs
+import json
+import os
+
+BLOCK_SIZE = 1 << 16
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class CatalogReader:
+  """
+    Incremental JSON reader over a catalog file. Holds at most the value being decoded plus one block of text.
+    `fraction_read` says how far through the file we are, for progress bars.
+  """
+
+  def __init__(self, f, size: int):
+    self.file = f
+    self.size = size
+    self.bytes_read = 0
+    self.utf8 = codecs.getincrementaldecoder("utf-8")()
+    self.buffer = ""
+    self.pos = 0
+    self.eof = False
+
+  @property
+  def fraction_read(self) -> float:
+    return self.bytes_read / self.size if self.size else 1.0
+
+  def __fill(self, block_size=BLOCK_SIZE) -> bool:
+    """Appends the next block to the buffer (dropping what's been consumed). False once the file is exhausted."""
+    if self.eof:
+      return False
+
+    data = self.file.read(block_size)
+    self.bytes_read += len(data)
+    self.eof = not data
+    self.buffer = self.buffer[self.pos:] + self.utf8.decode(data, final=self.eof)
+    self.pos = 0
+    return not self.eof
+
+  def __skip_whitespace(self):
+    while True:
+      while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+        self.pos += 1
+      if self.pos < len(self.buffer) or not self.__fill():
+        return
+
+  def peek(self) -> str:
+    """The next non-whitespace character, without consuming it ("" at the end of the file)."""
+    self.__skip_whitespace()
+    return self.buffer[self.pos] if self.pos < len(self.buffer) else ""
+
+  def expect(self, char: str):
+    if self.peek() != char:
+      raise ValueError(f"Malformed catalog: expected {char!r} at byte ~{self.bytes_read}, got {self.peek()!r}")
+    self.pos += 1
+
+  def value(self):
+    """Decodes the next JSON value, reading more of the file until it is complete."""
+    self.__skip_whitespace()
+    block_size = BLOCK_SIZE
+    while True:
+      try:
+        (value, end) = _decoder.raw_decode(self.buffer, self.pos)
+
+        # A number (or literal) running into the end of the buffer might carry on in the next block
+        if end < len(self.buffer) or self.eof:
+          self.pos = end
+          return value
+      except json.JSONDecodeError:
+        if self.eof:
+          raise
+      # Values bigger than a block get read in ever bigger blocks, so they're not re-decoded too many times
+      self.__fill(block_size)
+      block_size *= 2
+
+
+def iter_courses(path: str, course_ids=None, limit=None, reader_callback=None):
+  """
+    Yields the course dicts of a catalog one at a time, in file order.
+
+    Args:
+        path (str): the catalog file, e.g. data/2248.json.
+        course_ids (iterable, optional): only yield courses with these courseIDs, stopping once all are found.
+        limit (int, optional): stop after yielding this many courses.
+        reader_callback (callable, optional): called with the `CatalogReader` before anything is read,
+            e.g. to keep hold of it for `fraction_read`.
+  """
+  wanted = {str(course_id) for course_id in course_ids} if course_ids is not None else None
+  if limit is not None and limit <= 0:
+    return
+
+  with open(path, "rb") as f:
+    reader = CatalogReader(f, os.path.getsize(path))
+    if reader_callback is not None:
+      reader_callback(reader)
+
+    # Walk the top level object, skipping every value until we reach "courses"
+    reader.expect("{")
+    while reader.peek() != "}":
+      key = reader.value()
+      reader.expect(":")
+      if key != "courses":
+        reader.value()
+      else:
+        reader.expect("[")
+        yielded = 0
+        while reader.peek() != "]":
+          course = reader.value()
+          if wanted is None or str(course["courseID"]) in wanted:
+            yield course
+            yielded += 1
+            if wanted is not None:
+              wanted.discard(str(course["courseID"]))
+              if not wanted:
+                return
+            if limit is not None and yielded >= limit:
+              return
+          if reader.peek() == ",":
+            reader.expect(",")
+        reader.expect("]")
+
+      if reader.peek() == ",":
+        reader.expect(",")
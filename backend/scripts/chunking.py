@@ -0,0 +1,217 @@
+"""
+Chunk preparation, split out of the Embedder so it can run as its own stage.
+
+Each `prepare_course_vN` turns one course into the chunks the `embed_course_vN` spec embeds, as a list of
+(entry, text, key) triples: `entry` is the dict that ends up in the embeddings output, `text` is what gets embedded,
+and `key` is where in `entry` the embedding goes. They are plain module level functions of the course alone,
+so `prepare_chunks` can fan them out over a process pool and stream the results back in catalog order, while the
+main process is busy with the network.
+
+  python bench_chunking.py --catalog ../data/2248.json
+"""
+import html
+import os
+import re
+from html.entities import html5
+from collections import deque
+from functools import partial
+from itertools import islice
+import multiprocessing
+from textwrap import dedent
+from bs4 import BeautifulSoup
+
+CHUNK_SIZE = 500
+
+LINEAR_TAGS_V2 = [
+  "termDescription",
+  "catalogSubjectDescription",
+  "courseNumber",
+  "courseTitle",
+  "classLevelAttributeDescription",
+  "divisionalDistribution"
+]
+
+# The formatting tags course descriptions are actually written with. A tag is matched with its attributes,
+# including quoted ones that contain '>'.
+_SIMPLE_TAG = re.compile(
+  r"</?(?:p|br|b|i|u|em|strong|span|div|a|ul|ol|li|h[1-6]|sup|sub|blockquote|font|center|hr)"
+  r"(?:\s(?:[^<>\"']|\"[^\"]*\"|'[^']*')*)?/?>",
+  re.IGNORECASE
+)
+# Well formed character references. Any other '&' is left to BeautifulSoup, which has its own ideas about them.
+_ENTITY = re.compile(r"&(?:#[0-9]{1,7};|#[xX][0-9a-fA-F]{1,6};|([a-zA-Z][a-zA-Z0-9]*;))")
+_ASCII_SPACES = " \n\t\f\r"
+
+
+def _known_entities(text: str) -> int:
+  return sum(1 for entity in _ENTITY.finditer(text) if entity.group(1) is None or entity.group(1) in html5)
+
+
+def _text_node(text: str) -> str:
+  """BeautifulSoup collapses text between two tags that is only (ASCII) whitespace to a single newline or space."""
+  text = _ENTITY.sub(lambda entity: html.unescape(entity.group()), text)
+  if text and not text.strip(_ASCII_SPACES):
+    return "\n" if "\n" in text else " "
+  return text
+
+
+def html_to_text(markup: str) -> str:
+  """
+    Same text as `BeautifulSoup(markup, "html.parser").get_text()`, without building a parse tree when we don't
+    have to. Descriptions without markup are returned as is, and ones that only use simple formatting tags and
+    well formed entities are handled with a couple of regexes. Anything else (comments, scripts, stray '<'...)
+    goes to BeautifulSoup.
+  """
+  if not markup:
+    return ""
+  if "<" not in markup and "&" not in markup and markup.strip(_ASCII_SPACES):
+    return markup
+
+  nodes = _SIMPLE_TAG.split(markup)
+  if any("<" in node or node.count("&") != _known_entities(node) for node in nodes):
+    return BeautifulSoup(markup, "html.parser").get_text()
+  return "".join(map(_text_node, nodes))
+
+
+def split_text(text: str, size=CHUNK_SIZE) -> list[str]:
+  return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def create_chunks_v2(course, linear_tags=LINEAR_TAGS_V2) -> list[str]:
+  """
+    Creates what I've called `enchancedDescriptionChunks` from a `courseDescription`.
+    Again, split by 500 chars, but the enchaned chunk is that chunk, but with added
+    info about the course.
+     -> Everything in `linear_tags` is included after the chunk, comma separated.
+     -> Then the name of the instructors are added on the next line.
+     -> Finally, any meeting days are put on the final line.
+
+    The aim is to tackle queries that provide info on multiple axes and provide better results,
+    e.g. the query 'I want a Computer Science course that meets on Mondays', now
+    `Computer Science` and `Monday` should both appear in the same chunk, hence the same embedding,
+    and hopefully will more reliably find relevant courses.
+  """
+  chunks = split_text(html_to_text(course["courseDescription"]))
+
+  tags = ','.join([course[tag] if course[tag] else "" for tag in linear_tags])
+  instructors = ','.join(map(lambda instr: instr['instructorName'], course['publishedInstructors']))
+
+  # some meetings are just like 'TBA' - this aims to ignore these, otherwise this keeps
+  # all unique days the class meets upon (ignores times for now), in the order they first appear
+  # so the text (and so its embedding cache key) is the same on every run
+  days = ','.join(dict.fromkeys(
+    day for pattern in course['meetings'] if not isinstance(pattern, str) for day in pattern['daysOfWeek']
+  ))
+
+  # NOTE: the indentation inside this literal is part of the chunk text whenever a description chunk has
+  # unindented lines of its own (`dedent` can't strip it then), so it has to stay exactly as it is.
+  return [
+    dedent(f"""\
+          {chunk}
+
+          {tags},
+          {instructors},
+          {days}
+          """)
+    for chunk in chunks
+  ]
+
+
+def prepare_course_v1(course, linear_attributes) -> list[tuple[dict, str, str]]:
+  """Chunks for `embed_course_v1`: 500 char description chunks, then one per attribute in `linear_attributes`."""
+  prepared = []
+  for chunk in split_text(html_to_text(course["courseDescription"])):
+    prepared.append(({
+      "embedding": None,
+      "text": chunk,
+      "type": "descriptionChunk"
+    }, chunk, "embedding"))
+
+  # Create embeddings for a number of other things that linearly map to a courseID
+  for attribute in linear_attributes:
+    try:
+      if (course[attribute]):
+        prepared.append(({
+          "embeddings": None,
+          "text": course[attribute],
+          "type": attribute,
+          "courseNumber": course["courseNumber"],   # Putting these two in the metadata directly so that
+          "courseTitle": course["courseTitle"]      # it's easy to send to client for explainability
+        }, str(course[attribute]), "embeddings"))
+    except Exception as e:
+      print(f"Issue with courseID: {course['courseID']}, {course['courseTitle']}, attribute: {attribute}, value: {course.get(attribute)}")
+      print(e)
+
+  return prepared
+
+
+def prepare_course_v2(course) -> list[tuple[dict, str, str]]:
+  """Chunks for `embed_course_v2`: one per enhanced description chunk."""
+  return [({
+    "embedding": None,
+    "text": chunk,
+    "type": "enhancedDescriptionChunk",
+    "courseNumber": course["courseNumber"],   # Putting these two in the metadata directly so that
+    "courseTitle": course["courseTitle"]      # it's easy to send to client for explainability
+  }, chunk, "embedding") for chunk in create_chunks_v2(course)]
+
+
+def prepare_course_v3(course) -> list[tuple[dict, str, str]]:
+  """Chunks for `embed_course_v3`: the v2 chunks, with the metadata needed for filtering."""
+  return [({
+    "embedding": None,                        # Need the embedding! Filled in by the batcher
+    "text": chunk,                            # The actual text used to generate the embedding (mostly for debugging)
+    "type": "enhancedDescriptionChunk",       # Type, for embedding systems with more than one embedding type, or if we add systems
+                                              # to be able to search only via one type (e.g. you can toggle to only search courseTitles etc.)
+
+    "courseNumber": course["courseNumber"],   # Used for explainability of results -> AI guidelines
+    "courseTitle": course["courseTitle"],      # Used for explainability of results -> AI guidelines
+
+    # Providing data to be used for FILTERING
+    "termDescription": course["termDescription"],
+    "catalogSubject": course["catalogSubject"],
+    "classLevelAttributeDescription": course["classLevelAttributeDescription"],
+    "crossRegistrationEligibleAttribute": course["crossRegistrationEligibleAttribute"],
+    "divisionalDistribution": course["divisionalDistribution"],
+    "quantitativeReasoning": course["quantitativeReasoning"],
+    "meetings": course["meetings"]
+  }, chunk, "embedding") for chunk in create_chunks_v2(course)]
+
+
+def _prepare_many(course_preparer, kwargs, courses):
+  return [(course["courseID"], course_preparer(course, **kwargs)) for course in courses]
+
+
+def prepare_chunks(courses, course_preparer, processes=None, batch_size=64, **kwargs):
+  """
+    Yields (courseID, prepared chunks) for every course in `courses`, in order, running `course_preparer`
+    across a pool of `processes` worker processes (all CPUs by default, or in this process with 1).
+
+    Courses are sent to the pool `batch_size` at a time, with only a few batches per worker outstanding, so
+    `courses` can be a stream (see catalog.py) and memory stays bounded.
+  """
+  courses = iter(courses)
+  if processes == 1:
+    for course in courses:
+      yield (course["courseID"], course_preparer(course, **kwargs))
+    return
+
+  prepare_many = partial(_prepare_many, course_preparer, kwargs)
+  processes = processes or os.cpu_count() or 1
+  # Not forked from this process: by now it may have threads running (the embedding scheduler's pool) and locks held
+  # (the embedding cache's), which a forked child would inherit mid-use and could deadlock on. Workers start clean,
+  # from a fork server where there is one, at the cost of importing the calling script again (once per pool).
+  start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+  with multiprocessing.get_context(start_method).Pool(processes) as pool:
+    max_outstanding = 4 * processes
+    outstanding = deque()
+    while True:
+      while len(outstanding) < max_outstanding:
+        batch = list(islice(courses, batch_size))
+        if not batch:
+          break
+        outstanding.append(pool.apply_async(prepare_many, (batch,)))
+
+      if not outstanding:
+        return
+      yield from outstanding.popleft().get()
@@ -4,16 +4,24 @@ class Config:
   def __init__(self):
     self.vector_db_path = os.path.join(os.path.dirname(__file__), '..', 'vector_db')
     self.embeddings_files = [
-      os.path.join(os.path.dirname(__file__), '..', 'embeddings', 'fall24_v3.json'),
-      os.path.join(os.path.dirname(__file__), '..', 'embeddings', 'spring25_v3.json')
+      os.path.join(os.path.dirname(__file__), '..', 'embeddings', 'fall24_v3'),
+      os.path.join(os.path.dirname(__file__), '..', 'embeddings', 'spring25_v3')
     ]
     self.raw_input_files = [
       os.path.join(os.path.dirname(__file__), '..', 'data', '2248.json'),
       os.path.join(os.path.dirname(__file__), '..', 'data', '2252.json'),
     ]
     self.embedding_model = "text-embedding-3-small"
+    # Leading dimensions of an embedding that make a usable (Matryoshka) embedding by themselves, for two stage search
+    self.coarse_dims = 256
+    # One cache for every term/spec run, so courses that repeat across terms aren't embedded twice
+    self.embedding_cache_path = os.path.join(os.path.dirname(__file__), '..', 'embeddings', 'cache.sqlite')
+    # What each term's catalog looked like when it was last ingested, for incremental updates
+    self.snapshot_path = os.path.join(os.path.dirname(__file__), '..', 'embeddings', 'snapshots')
+    self.sql_db_path = os.path.join(os.path.dirname(__file__), '..', 'courses.db')
     self.env_path = os.path.join(os.path.dirname(__file__), '..', '.env')
-    self.reset_db = True
+    # Drop the collection before every load. Loads upsert by stable ids now, so this is only needed to start over.
+    self.reset_db = False
     self.collection_name = "course_chunks"
 
 CONFIG = Config()
\ No newline at end of file
@@ -1,11 +1,16 @@
-import json
+import argparse
 from openai import OpenAI
 import sys
 import os
-from bs4 import BeautifulSoup
-from collections import defaultdict
+from collections import defaultdict, deque
 from utils import progbar, load_env
-from textwrap import dedent
+from config import CONFIG
+from embedding_batcher import EmbeddingBatcher, MAX_INPUTS_PER_REQUEST, MAX_TOKENS_PER_REQUEST
+from embedding_scheduler import EmbeddingScheduler, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+from embedding_cache import EmbeddingCache
+from embedding_store import EmbeddingWriter, BinaryEmbeddingWriter
+from catalog import iter_courses
+from chunking import prepare_chunks, prepare_course_v1, prepare_course_v2, prepare_course_v3
 
 # Load backend .env, needed for OpenAI API key.
 # NOTE: Might need to remove in Docker environment, or might just be redundant.
@@ -42,37 +47,146 @@ def get_embedding(text, model="text-embedding-3-small"):
 
 
 class Embedder():
-  def __init__(self, input_data : dict[str, str], output_path : str, sample_output_path : str, client):
+  def __init__(
+    self,
+    input_data : dict[str, str],
+    output_path : str,
+    sample_output_path : str,
+    client,
+    model="text-embedding-3-small",
+    max_inputs_per_request=MAX_INPUTS_PER_REQUEST,
+    max_tokens_per_request=MAX_TOKENS_PER_REQUEST,
+    max_in_flight=1,
+    requests_per_minute=REQUESTS_PER_MINUTE,
+    tokens_per_minute=TOKENS_PER_MINUTE,
+    cache_path=None,
+    cache_max_size_mb=2048,
+    resume=False,
+    checkpoint_every=100,
+    output_format="binary",
+    vector_dtype="float32",
+    chunk_processes=None,
+    coarse_dims=None
+  ):
     self.input_data = input_data
     self.client = client
     self.output_path = output_path
     self.sample_output_path = sample_output_path
 
-  def __embed_sample(self, course_embedder, version_num: str, **kwargs):
+    # Output is streamed to disk a course at a time, fsynced every `checkpoint_every` courses.
+    # With `resume`, courses already in a semester's output file are skipped.
+    self.resume = resume
+    self.checkpoint_every = checkpoint_every
+
+    # "binary" writes a float32/float16 matrix plus metadata columns (see embedding_store.py), "jsonl" one
+    # JSON line per course. The samples are always JSON lines, so they stay readable.
+    self.model = model
+    self.output_format = output_format
+    self.vector_dtype = vector_dtype
+
+    # Binary stores record how many leading dimensions of `model`'s embeddings are an embedding by themselves
+    # (text-embedding-3-* are trained that way), which is the coarse view two stage search ranks by
+    self.coarse_dims = coarse_dims
+
+    # HTML stripping and chunk construction run in a pool of this many processes (all CPUs by default, 1 to
+    # keep it in this process), streaming chunks back in catalog order while the batcher sends them off.
+    self.chunk_processes = chunk_processes
+
+    # With more than one request in flight, batches are sent from a rate limited thread pool
+    # while we carry on chunking the rest of the courses.
+    self.scheduler = None
+    if max_in_flight > 1:
+      self.scheduler = EmbeddingScheduler(
+        client,
+        model=model,
+        max_in_flight=max_in_flight,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute
+      )
+
+    # Embeddings we've paid for before, shared between every semester and spec version that points at the same file
+    self.cache = EmbeddingCache(cache_path, max_size_mb=cache_max_size_mb) if cache_path else None
+
+    # Chunks from every course are queued here and embedded many-at-a-time, rather than one request per chunk.
+    self.batcher = EmbeddingBatcher(
+      client,
+      model=model,
+      max_inputs=max_inputs_per_request,
+      max_tokens=max_tokens_per_request,
+      scheduler=self.scheduler,
+      on_progress=(lambda done, queued, error: progbar(done, queued, 20, error)) if self.scheduler else None,
+      cache=self.cache,
+      max_queued_batches=2 * max_in_flight
+    )
+
+  def __queue_embedding(self, embeddings, course_id, entry: dict, text: str, key="embedding"):
+    """
+      Adds `entry` to the list for `course_id`, and queues `text` so that its embedding is written to `entry[key]`
+      once the batch it ends up in is sent. Call `self.batcher.wait()` before reading the embeddings, or check
+      `self.batcher.done(course_id)`.
+    """
+    embeddings[course_id].append(entry)
+    self.batcher.add(text, entry, key, group=course_id)
+
+  def __queue_prepared(self, embeddings, course_id, prepared):
+    """Queues every (entry, text, key) a `prepare_course_vN` made for `course_id`."""
+    for (entry, text, key) in prepared:
+      self.__queue_embedding(embeddings, course_id, entry, text, key)
+
+  def __open_writer(self, semester: str, version_num: str):
+    """The writer for a semester's output, in `self.output_format`. Returns (path, writer)."""
+    if self.output_format == "binary":
+      output_path = os.path.join(self.output_path, f"{semester}_{version_num}")
+      return output_path, BinaryEmbeddingWriter(
+        output_path,
+        resume=self.resume,
+        checkpoint_every=self.checkpoint_every,
+        dtype=self.vector_dtype,
+        model=self.model,
+        coarse_dims=self.coarse_dims
+      )
+
+    output_path = os.path.join(self.output_path, f"{semester}_{version_num}.jsonl")
+    return output_path, EmbeddingWriter(output_path, resume=self.resume, checkpoint_every=self.checkpoint_every)
+
+  def __write_finished(self, embeddings, waiting: deque, writer):
+    """
+      Writes out the courses at the front of `waiting` whose embeddings are all back, in catalog order,
+      and drops them from `embeddings` so memory only holds what's still in flight.
+    """
+    while waiting and self.batcher.done(waiting[0]):
+      course_id = waiting.popleft()
+      chunks = embeddings.pop(course_id, None)
+
+      # A courseID listed twice in a catalog has all of its chunks written with its first appearance
+      if chunks is None and str(course_id) in writer.written_ids:
+        continue
+      writer.write_course(course_id, chunks or [])
+
+  def __embed_sample(self, course_preparer, version_num: str, **kwargs):
     """
       Creates a sample of the embedding system, with one example per input file.
-      Embeds each course using `course_embedder`, and outputs a file named using `version_num`.
-      `kwargs` must contain any attributes that the `course_embedder` needs, else will fail.
+      Chunks each course using `course_preparer`, and outputs a file named using `version_num`.
+      `kwargs` must contain any attributes that the `course_preparer` needs, else will fail.
     """
     for (outname, input_file) in self.input_data.items():
       embeddings = defaultdict(list)
-      with open(input_file, "r") as f:
-        # All data from file
-        data = json.load(f)
 
-        # Only want one course as a sample
-        course = data["courses"][0]
+      # Only want one course as a sample, so only read as far as the first one (not worth a process pool)
+      for (course_id, prepared) in prepare_chunks(iter_courses(input_file, limit=1), course_preparer, processes=1, **kwargs):
+        self.__queue_prepared(embeddings, course_id, prepared)
+      self.batcher.wait()
 
-        course_embedder(course, embeddings, kwargs)
+      writer = EmbeddingWriter(os.path.join(self.sample_output_path, f"{outname}_{version_num}_sample.jsonl"))
+      for (course_id, chunks) in embeddings.items():
+        writer.write_course(course_id, chunks)
+      writer.close()
 
-      with open(os.path.join(self.sample_output_path, f"{outname}_{version_num}_sample.jsonl"), "w") as outfile:
-        json.dump(embeddings, outfile)
-
-  def __embed_semester(self, course_embedder, semester: str, version_num: str, **kwargs):
+  def __embed_semester(self, course_preparer, semester: str, version_num: str, **kwargs):
     """
-      Embeds a semester's worth of data (i.e. an entire input file),
-      making a new `embeddings` variable and dumping it all to a json file
-      with the name `{semester}_v1.json`.
+      Embeds a semester's worth of data (i.e. an entire input file), streaming each course to
+      `{semester}_{version_num}` (a binary store, or `.jsonl` file) as soon as its embeddings are back.
+      With `self.resume`, courses already written there are skipped.
     """
     embeddings = defaultdict(list)
 
@@ -80,36 +194,73 @@ class Embedder():
       print("Invalid semester key in embed_semester_v1")
       return
 
-    input_file = self.input_data[semester]
-    with open(input_file, "r") as f:
-      processed = 0
-      data = json.load(f)
-      courses_in_file = len(data["courses"])
-      print(f"There are {courses_in_file} courses for {semester}.")
-
-      for course in data["courses"]:
-        course_embedder(course, embeddings, kwargs)
-        processed += 1
-        progbar(processed, courses_in_file, 20, False)
+    (output_path, writer) = self.__open_writer(semester, version_num)
+    if writer.written_ids:
+      print(f"Resuming, {len(writer.written_ids)} courses are already in {output_path}")
 
-      print(f"Finished processing {semester} semester")
+    # Courses that have been chunked but not written yet, in catalog order
+    waiting = deque()
 
-    # Open a new file 'embeddings.jsonl' in write mode
-    output_path = os.path.join(self.output_path, f"{semester}_{version_num}.json")
-    print("Writing embeddings to file...")
-    with open(output_path, "w") as f:
-      json.dump(embeddings, f)
+    # Courses are streamed from the catalog, so we don't know how many there are up front.
+    # Progress is how far through the file we've read instead.
+    input_file = self.input_data[semester]
+    readers = []
+    processed = 0
+    print(f"Embedding {semester} from {input_file} ({os.path.getsize(input_file) / 1e6:.1f} MB).")
+
+    def unwritten_courses():
+      nonlocal processed
+      for course in iter_courses(input_file, reader_callback=readers.append):
+        processed += 1
+        if str(course["courseID"]) not in writer.written_ids:
+          yield course
+
+    # Whatever fails along the way (a batch sent from `add` in the loop, or one still in flight at the end),
+    # every course that did finish is still written, so `resume` can pick up after them
+    try:
+      # Chunks are built in worker processes, a little ahead of us, and come back in catalog order
+      for (course_id, prepared) in prepare_chunks(unwritten_courses(), course_preparer, processes=self.chunk_processes, **kwargs):
+        self.__queue_prepared(embeddings, course_id, prepared)
+        waiting.append(course_id)
+        self.__write_finished(embeddings, waiting, writer)
+
+        # When requests are concurrent the batcher reports progress as embeddings come back instead
+        if self.scheduler is None:
+          progbar(readers[0].fraction_read, 1, 20, False)
+
+      # Send off whatever didn't fill up a whole batch, and wait for anything still in flight
+      self.batcher.wait(then=lambda: self.__write_finished(embeddings, waiting, writer))
+    finally:
+      self.__write_finished(embeddings, waiting, writer)
+      writer.close()
+
+    print(f"Finished processing {processed} courses for {semester} semester ({self.batcher.requests_sent} embedding requests so far)")
+    if self.cache is not None:
+      self.cache.commit()
+      print(f"Embedding cache: {self.cache.stats()}")
 
     print(f"Embeddings written to file {output_path}")
     return
 
-  def __embed_all(self, course_embedder, version_num: str, **kwargs):
+  def __embed_courses(self, course_preparer, courses, **kwargs):
+    """
+      Embeds only the given `courses` (any iterable of course dicts) and returns the embeddings keyed by courseID,
+      rather than writing out a whole semester. Used to re-embed just the courses that changed.
+    """
+    embeddings = defaultdict(list)
+    for (course_id, prepared) in prepare_chunks(courses, course_preparer, processes=self.chunk_processes, **kwargs):
+      self.__queue_prepared(embeddings, course_id, prepared)
+
+    self.batcher.wait()
+    return embeddings
+
+  def __embed_all(self, course_preparer, version_num: str, **kwargs):
     """
       Creates embeddings for all semesters in `input_data`.
-      Calls `course_embedder` to embed each course via `embed_semester`.
+      Calls `course_preparer` to chunk each course via `embed_semester`.
     """
     for (semester) in self.input_data.keys():
-      self.__embed_semester(course_embedder, semester, version_num, **kwargs)
+      self.__embed_semester(course_preparer, semester, version_num, **kwargs)
 
   def embed_course_v1(self, course, embeddings, kwargs) -> bool:
     """
@@ -124,51 +275,21 @@ class Embedder():
       print("Need to pass `linear_attributes` to `embed_course_v1`.")
       return False
 
-    linear_attributes = kwargs['linear_attributes']
-
-    soup = BeautifulSoup(course["courseDescription"], "html.parser")
-    text = soup.get_text()
-
-    # Split the text into chunks of 500 characters and store them in a list called 'chunks'
-    chunks = [text[i:i+500] for i in range(0, len(text), 500)]
-
-    # Create embeddings for all chunks of course description
-    for chunk in chunks:
-      embeddings[course["courseID"]].append({
-        "embedding": get_embedding(chunk),
-        "text": chunk,
-        "type": "descriptionChunk"
-      })
-
-    # Create embeddings for a number of other things that linearly map to a courseID
-    for attribute in linear_attributes:
-      try:
-        if (course[attribute]):
-          embeddings[course["courseID"]].append({
-            "embeddings": get_embedding(str(course[attribute])),
-            "text": course[attribute],
-            "type": attribute,
-            "courseNumber": course["courseNumber"],   # Putting these two in the metadata directly so that
-            "courseTitle": course["courseTitle"]      # it's easy to send to client for explainability
-          })
-      except Exception as e:
-        print(f"Issue with courseID: {course['courseID']}, {course['courseTitle']}, attribute: {attribute}, value: {course[attribute]}")
-        print(e)
-
+    self.__queue_prepared(embeddings, course["courseID"], prepare_course_v1(course, kwargs['linear_attributes']))
     return True
 
   def embed_semester_v1(self, semester: str, linear_attributes):
-    self.__embed_semester(self.embed_course_v1, semester, "v1", linear_attributes=linear_attributes)
+    self.__embed_semester(prepare_course_v1, semester, "v1", linear_attributes=linear_attributes)
 
   def embed_sample_v1(self, linear_attributes):
-    self.__embed_sample(self.embed_course_v1, "v1", linear_attributes=linear_attributes)
+    self.__embed_sample(prepare_course_v1, "v1", linear_attributes=linear_attributes)
 
   def embed_v1(self, linear_attributes):
     """
       Creates embeddings for all semesters in `input_data`.
       Calls `__embed_all` to embed each semester.
     """
-    self.__embed_all(self.embed_course_v1, "v1", linear_attributes=linear_attributes)
+    self.__embed_all(prepare_course_v1, "v1", linear_attributes=linear_attributes)
 
   def embed_course_v2(self, course, embeddings, kwargs) -> bool:
     """
@@ -181,62 +302,8 @@ class Embedder():
           -> `meetings` and `publishedInstructors` requires a little more work.
       and adds it to the dictionary `embeddings` in the list corresponding to the `courseID`.
     """
-
-    linear_tags = [
-      "termDescription",
-      "catalogSubjectDescription",
-      "courseNumber",
-      "courseTitle",
-      "classLevelAttributeDescription",
-      "divisionalDistribution"
-    ]
-
-    def create_chunks_v2(course, linear_tags):
-      """
-        Creates what I've called `enchancedDescriptionChunks` from a `courseDescription`.
-        Again, split by 500 chars, but the enchaned chunk is that chunk, but with added
-        info about the course.
-         -> Everything in `linear_tags` is included after the chunk, comma separated.
-         -> Then the name of the instructors are added on the next line.
-         -> Finally, any meeting days are put on the final line.
-
-        The aim is to tackle queries that provide info on multiple axes and provide better results,
-        e.g. the query 'I want a Computer Science course that meets on Mondays', now
-        `Computer Science` and `Monday` should both appear in the same chunk, hence the same embedding,
-        and hopefully will more reliably find relevant courses.
-      """
-      soup = BeautifulSoup(course["courseDescription"], "html.parser")
-      text = soup.get_text()
-
-      chunks = [text[i:i + 500] for i in range(0, len(text), 500)]
-
-      # some meetings are just like 'TBA' - this aims to ignore these, otherwise this keeps
-      # all unique days the class meets upon (ignores times for now)
-      chunks = list(map(
-        lambda chunk: dedent(f"""\
-          {chunk}
-
-          {','.join([course[tag] if course[tag] else "" for tag in linear_tags])},
-          {','.join(map(lambda instr: instr['instructorName'], course['publishedInstructors']))},
-          {','.join(set().union(
-            *map(lambda pattern: [] if isinstance(pattern, str) else pattern['daysOfWeek'], course['meetings'])
-            ))}
-          """),
-        chunks
-      ))
-      return chunks
-
-    chunks = create_chunks_v2(course, linear_tags=linear_tags)
-
-    # Create embeddings for all (enhanced) chunks
-    for chunk in chunks:
-      embeddings[course["courseID"]].append({
-        "embedding": get_embedding(chunk),
-        "text": chunk,
-        "type": "enhancedDescriptionChunk",
-        "courseNumber": course["courseNumber"],   # Putting these two in the metadata directly so that
-        "courseTitle": course["courseTitle"]      # it's easy to send to client for explainability
-      })
+    # See `create_chunks_v2` in chunking.py
+    self.__queue_prepared(embeddings, course["courseID"], prepare_course_v2(course))
 
     return True
 
@@ -255,85 +322,50 @@ class Embedder():
           -> `meetings` and `publishedInstructors` requires a little more work.
       and adds it to the dictionary `embeddings` in the list corresponding to the `courseID`.
     """
-
-
-    linear_tags = [
-      "termDescription",
-      "catalogSubjectDescription",
-      "courseNumber",
-      "courseTitle",
-      "classLevelAttributeDescription",
-      "divisionalDistribution"
-    ]
-
-    def create_chunks_v2(course, linear_tags):
-      """Same chunking system as `embed_course_v2`."""
-      soup = BeautifulSoup(course["courseDescription"], "html.parser")
-      text = soup.get_text()
-
-      chunks = [text[i:i + 500] for i in range(0, len(text), 500)]
-
-      # some meetings are just like 'TBA' - this aims to ignore these, otherwise this keeps
-      # all unique days the class meets upon (ignores times for now)
-      chunks = list(map(
-        lambda chunk: dedent(f"""\
-          {chunk}
-
-          {','.join([course[tag] if course[tag] else "" for tag in linear_tags])},
-          {','.join(map(lambda instr: instr['instructorName'], course['publishedInstructors']))},
-          {','.join(set().union(
-            *map(lambda pattern: [] if isinstance(pattern, str) else pattern['daysOfWeek'], course['meetings'])
-            ))}
-          """),
-        chunks
-      ))
-      return chunks
-
-    chunks = create_chunks_v2(course, linear_tags=linear_tags)
-
-    # Create embeddings for all (enhanced) chunks
-    for chunk in chunks:
-      embeddings[course["courseID"]].append({
-        "embedding": get_embedding(chunk),        # Need the embedding!
-        "text": chunk,                            # The actual text used to generate the embedding (mostly for debugging)
-        "type": "enhancedDescriptionChunk",       # Type, for embedding systems with more than one embedding type, or if we add systems
-                                                  # to be able to search only via one type (e.g. you can toggle to only search courseTitles etc.)
-
-        "courseNumber": course["courseNumber"],   # Used for explainability of results -> AI guidelines
-        "courseTitle": course["courseTitle"],      # Used for explainability of results -> AI guidelines
-
-        # Providing data to be used for FILTERING
-        "termDescription": course["termDescription"],
-        "catalogSubject": course["catalogSubject"],
-        "classLevelAttributeDescription": course["classLevelAttributeDescription"],
-        "crossRegistrationEligibleAttribute": course["crossRegistrationEligibleAttribute"],
-        "divisionalDistribution": course["divisionalDistribution"],
-        "quantitativeReasoning": course["quantitativeReasoning"],
-        "meetings": course["meetings"]
-      })
+    # Same chunks as v2, see `prepare_course_v3` in chunking.py for the metadata
+    self.__queue_prepared(embeddings, course["courseID"], prepare_course_v3(course))
 
     return True
 
   def embed_sample_v3(self):
-    self.__embed_sample(self.embed_course_v3, "v3")
+    self.__embed_sample(prepare_course_v3, "v3")
 
   def embed_semester_v3(self, semester: str):
-    self.__embed_semester(self.embed_course_v3, semester, "v3")
+    self.__embed_semester(prepare_course_v3, semester, "v3")
 
   def embed_v3(self):
-    self.__embed_all(self.embed_course_v3, "v3")
+    self.__embed_all(prepare_course_v3, "v3")
+
+  def embed_courses_v3(self, courses):
+    return self.__embed_courses(prepare_course_v3, courses)
 
   def embed_sample_v2(self):
-    self.__embed_sample(self.embed_course_v2, "v2")
+    self.__embed_sample(prepare_course_v2, "v2")
 
   def embed_semester_v2(self, semester: str):
-    self.__embed_semester(self.embed_course_v2, semester, "v2")
-
-embedder = Embedder(
-  input_data=DATA,
-  output_path=os.path.join(os.path.dirname(__file__), "..", "embeddings"),
-  sample_output_path=os.path.join(os.path.dirname(__file__), "..", "embeddings", "samples"),
-  client=client
-)
-
-embedder.embed_v3()
\ No newline at end of file
+    self.__embed_semester(prepare_course_v2, semester, "v2")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Embeds every course of every semester in `DATA` (v3 spec).")
+  parser.add_argument("--resume", action="store_true", help="skip courses already written by a previous run")
+  parser.add_argument("--checkpoint-every", type=int, default=100, help="courses between fsyncs of the output")
+  parser.add_argument("--format", default="binary", choices=["binary", "jsonl"], help="output format")
+  parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="binary vector precision")
+  args = parser.parse_args()
+
+  embedder = Embedder(
+    input_data=DATA,
+    output_path=os.path.join(os.path.dirname(__file__), "..", "embeddings"),
+    sample_output_path=os.path.join(os.path.dirname(__file__), "..", "embeddings", "samples"),
+    client=client,
+    max_inputs_per_request=512,
+    max_in_flight=8,
+    cache_path=CONFIG.embedding_cache_path,
+    resume=args.resume,
+    checkpoint_every=args.checkpoint_every,
+    output_format=args.format,
+    vector_dtype=args.dtype,
+    coarse_dims=CONFIG.coarse_dims
+  )
+
+  embedder.embed_v3()
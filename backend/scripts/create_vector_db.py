@@ -1,10 +1,14 @@
-import pandas as pd
+import argparse
 import os
+import time
+import numpy as np
 import chromadb
 from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
-from utils import load_env, progbar
+from utils import load_env
 from config import CONFIG
-import sys
+from embedding_store import iter_embeddings
+from index_versions import new_version, publish, remove_old_versions, resolve, write_manifest
+from exact_index import exact_index_path, export_collection, read_stamp
 
 '''
 Configuration
@@ -13,61 +17,251 @@ Configuration
 # Loading .env for OpenAI API key
 load_env()
 
-# Setup embedding function and chroma client
+# Setup embedding function
 embedding_function = OpenAIEmbeddingFunction(api_key=os.environ.get('OPENAI_API_KEY'), model_name=CONFIG.embedding_model)
-chroma_client = chromadb.PersistentClient(path=CONFIG.vector_db_path)
-
-# Reset db if required
-if (CONFIG.reset_db):
-  if (input("Enter exactly CONFIRM if you wish to reset the database: ") == "CONFIRM"):
-    if chroma_client.reset():
-      print("Reset vector database successfully")
-    else:
-      print("Vector database failed to reset properly")
-      sys.exit(1)
 
 def safe_str(maybe_str):
   return maybe_str if maybe_str else ""
 
-embedding_id = 0
-# Bringing in the data
-for file in CONFIG.embeddings_files:
-  df = pd.read_json(file, lines=True).T
+def get_collection(chroma_client):
+  """Gets the course collection, creating it if this is a fresh database."""
+  return chroma_client.get_or_create_collection(name=CONFIG.collection_name, embedding_function=embedding_function)
+
+def chunk_id(courseID, term, index: int) -> str:
+  """
+    Stable Chroma id of the `index`th chunk of `courseID` in `term` (its termDescription, as the same courseID
+    can be offered in both terms). Loading the same embeddings twice writes to the same ids, so upserts are idempotent.
+  """
+  return f"{safe_str(term)}:{courseID}:{index}"
+
+def course_wheres(course_id: str, term_description: str) -> list[dict]:
+  """
+    Chroma filters for every vector of one course in one term.
+    create_vector_db.py used to take courseIDs from a pandas index, which turned numeric ones into ints, so
+    databases built back then need matching both ways.
+  """
+  ids = [course_id, int(course_id)] if course_id.isdigit() else [course_id]
+  return [{"$and": [{"courseID": id}, {"termDescription": term_description or ""}]} for id in ids]
+
+def matching_ids(collection, where: dict, page_size: int) -> list[str]:
+  """Every id in `collection` matching `where`, fetched a page at a time (ids only)."""
+  ids = []
+  while True:
+    page = collection.get(where=where, include=[], limit=page_size, offset=len(ids))["ids"]
+    ids.extend(page)
+    if len(page) < page_size:
+      return ids
+
+def delete_ids(collection, ids: list[str], batch_size: int):
+  for i in range(0, len(ids), batch_size):
+    collection.delete(ids=ids[i:i + batch_size])
+
+def unchanged(collection, ids: list[str], embeddings, metadatas: list[dict]) -> np.ndarray:
+  """
+    Which of the rows of a batch are already stored as they are (up to float rounding on the way in and out),
+    so re-upserting them can be skipped. An update in place costs Chroma far more than reading the row back.
+  """
+  stored = collection.get(ids=ids, include=["embeddings", "metadatas"])
+  rows = {id: (embedding, metadata) for (id, embedding, metadata) in zip(stored["ids"], stored["embeddings"], stored["metadatas"])}
+  same = np.zeros(len(ids), dtype=bool)
+  for (i, id) in enumerate(ids):
+    if id in rows:
+      (embedding, metadata) = rows[id]
+      same[i] = metadata == metadatas[i] and np.allclose(embedding, embeddings[i], rtol=0, atol=1e-6)
+  return same
+
+# Metadata the app filters on (see `chunk_metadata`), which get precomputed row sets in the exact index
+FILTER_FIELDS = [
+  "courseID",
+  "termDescription",
+  "catalogSubject",
+  "classLevelAttributeDescription",
+  "crossRegistrationEligibleAttribute",
+  "divisionalDistribution",
+  "quantitativeReasoning",
+]
+
+def chunk_metadata(courseID, chunk) -> dict:
+  """The metadata stored in Chroma alongside the embedding of `chunk`, one of the chunks of `courseID`."""
+  return {
+    "text": chunk["text"],
+    "type": chunk["type"],
+
+    # To identify course, to be able to find other data via SQL
+    "courseID": courseID,
+
+    # To quickly have these for explainability without needing SQL query
+    "courseNumber": chunk["courseNumber"],
+    "courseTitle":  chunk["courseTitle"],
+
+    # For filtering
+    "termDescription":                      safe_str(chunk["termDescription"]),
+    "catalogSubject":                       safe_str(chunk["catalogSubject"]),
+    "classLevelAttributeDescription":       safe_str(chunk["classLevelAttributeDescription"]),
+    "crossRegistrationEligibleAttribute":   safe_str(chunk["crossRegistrationEligibleAttribute"]),
+    "divisionalDistribution":               safe_str(chunk["divisionalDistribution"]),
+    "quantitativeReasoning":                safe_str(chunk["quantitativeReasoning"]),
+
+    # TODO: Handle formatting the meetings in a better way to be able to filter by these effectively
+    # "meetings": chunk["meetings"]
+  }
+
+def iter_batches(courses, batch_size: int):
+  """
+    Yields (ids, embeddings, metadatas) for every chunk of `courses`, an iterable of (courseID, chunks) like
+    `iter_embeddings` gives, `batch_size` chunks at a time, ready to pass straight to `collection.upsert`.
+    Embeddings come as one float32 matrix per batch.
+  """
+  (ids, embeddings, metadatas) = ([], [], [])
+  for courseID, embedding_data in courses:
+    for (index, chunk) in enumerate(embedding_data):
+      ids.append(chunk_id(courseID, chunk["termDescription"], index))
+      embeddings.append(chunk["embedding"])
+      metadatas.append(chunk_metadata(str(courseID), chunk))
+
+      if len(ids) == batch_size:
+        yield (ids, np.asarray(embeddings, dtype=np.float32), metadatas)
+        (ids, embeddings, metadatas) = ([], [], [])
+
+  if ids:
+    yield (ids, np.asarray(embeddings, dtype=np.float32), metadatas)
+
+
+def refresh_exact_index(collection, db_path: str, always=False):
+  """
+    Re-exports `collection` for the numpy backend (see exact_index.py) after it changed, if it has an export at all
+    (or `always`). Servers pick it up on their next `VectorDatabase.reload`.
+  """
+  path = exact_index_path(db_path, collection.name)
+  if always or read_stamp(path) is not None:
+    rows = export_collection(collection, path, filter_fields=FILTER_FIELDS, coarse_dims=CONFIG.coarse_dims)
+    print(f"Exported {rows} vectors to the exact index at {path}")
+
+def upsert_files(collection, files: list[str], batch_size: int, wanted=None, skip_unchanged=True) -> tuple[set, set, int]:
+  """
+    Upserts every chunk in `files` (only those of the courseIDs in `wanted`, if given), reading a course at a time
+    so only one batch is ever in memory. With `skip_unchanged`, rows already stored as they are aren't rewritten.
+    Returns the ids written, the termDescriptions seen, and the embedding dimension.
+  """
+  (written, terms, dim) = (set(), set(), 0)
+  for file in files:
+    start = time.perf_counter()
+    added = 0
+    courses = ((course_id, chunks) for (course_id, chunks) in iter_embeddings(file) if wanted is None or str(course_id) in wanted)
+    skipped = 0
+    for (ids, embeddings, metadatas) in iter_batches(courses, batch_size):
+      written.update(ids)
+      terms.update(metadata["termDescription"] for metadata in metadatas)
+      added += len(ids)
+      dim = embeddings.shape[1]
+
+      # Re-running over the same embeddings (e.g. after a partial failed load) only writes what's missing or changed
+      keep = ~unchanged(collection, ids, embeddings, metadatas) if skip_unchanged else np.ones(len(ids), dtype=bool)
+      skipped += len(ids) - int(keep.sum())
+      if keep.any():
+        collection.upsert(
+          ids=[id for (id, k) in zip(ids, keep) if k],
+          embeddings=embeddings[keep],
+          metadatas=[metadata for (metadata, k) in zip(metadatas, keep) if k]
+        )
+      print(f"\r{file}: {added} vectors ({added / (time.perf_counter() - start):.0f} vectors/s)", end="")
+
+    elapsed = time.perf_counter() - start
+    print(
+      f"\r{file}: upserted {added} vectors in {elapsed:.1f}s ({added / max(elapsed, 1e-9):.0f} vectors/s, "
+      f"batches of {batch_size}), {skipped} already up to date"
+    )
+  return (written, terms, dim)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description="Loads embeddings into the vector database. Chunks have stable ids (term:courseID:chunk), so re-running "
+                "only overwrites them in place, and it needs no input, so it can run unattended."
+  )
+  parser.add_argument("--mode", default="upsert", choices=["build", "upsert", "delete", "publish"],
+                      help="build: load the embeddings files into a new index version and publish it (blue/green). "
+                           "upsert/delete: change the chunks of the live version in place. publish: serve --version")
+  parser.add_argument("--files", nargs="+", default=CONFIG.embeddings_files, help="embeddings files/stores to load")
+  parser.add_argument("--course-ids", nargs="+", help="only upsert/delete these courses")
+  parser.add_argument("--term", help="termDescription of the courses to delete, e.g. '2024 Fall'")
+  parser.add_argument("--prune", action="store_true",
+                      help="after upserting, delete anything else stored for the same terms (or --course-ids): removed "
+                           "courses, chunks a course no longer has, ids left by older loads")
+  parser.add_argument("--reset", action="store_true", help="drop the whole collection first (the app has no data until reloaded)")
+  parser.add_argument("--no-publish", action="store_true", help="build a version without serving it yet")
+  parser.add_argument("--version", help="version to publish (see vector_db/versions), e.g. to roll back")
+  parser.add_argument("--keep", type=int, default=2, help="finished versions to keep after a build")
+  args = parser.parse_args()
+  if args.mode == "delete" and (args.course_ids is None or args.term is None):
+    parser.error("--mode delete needs --course-ids and --term")
+  if args.mode == "publish" and args.version is None:
+    parser.error("--mode publish needs --version")
+
+  if args.mode == "publish":
+    publish(CONFIG.vector_db_path, args.version)
+    print(f"Now serving version {args.version}, running servers switch over on their next reload")
+    raise SystemExit(0)
+
+  # A build goes into a fresh directory nobody is reading, everything else changes the live version in place
+  if args.mode == "build":
+    (version, db_path) = new_version(CONFIG.vector_db_path)
+    print(f"Building version {version} in {db_path}")
+  else:
+    db_path = resolve(CONFIG.vector_db_path)
+  chroma_client = chromadb.PersistentClient(path=db_path)
+
+  # Reset db if required. Only the collection is dropped, so this doesn't need the client's allow_reset setting.
+  if (args.mode != "build" and (CONFIG.reset_db or args.reset)):
+    get_collection(chroma_client)   # so there's always one to drop
+    chroma_client.delete_collection(CONFIG.collection_name)
+    print(f"Dropped collection {CONFIG.collection_name}")
 
   # Collections
-  try:
-    course_collection = chroma_client.get_collection(name=CONFIG.collection_name, embedding_function=embedding_function)
-  except ValueError:
-    course_collection = chroma_client.create_collection(name=CONFIG.collection_name, embedding_function=embedding_function)
-
-  # Add all the embeddings!
-  for courseID, course_data in df.iterrows():
-    embedding_data = course_data[0]
-    for chunk in embedding_data:
-      course_collection.add(
-        ids = [str(embedding_id)],
-        embeddings = chunk["embedding"],
-        metadatas = [{
-          "text": chunk["text"],
-          "type": chunk["type"],
-
-          # To identify course, to be able to find other data via SQL
-          "courseID": courseID,
-
-          # To quickly have these for explainability without needing SQL query
-          "courseNumber": chunk["courseNumber"],
-          "courseTitle":  chunk["courseTitle"],
-
-          # For filtering
-          "termDescription":                      safe_str(chunk["termDescription"]),
-          "catalogSubject":                       safe_str(chunk["catalogSubject"]),
-          "classLevelAttributeDescription":       safe_str(chunk["classLevelAttributeDescription"]),
-          "crossRegistrationEligibleAttribute":   safe_str(chunk["crossRegistrationEligibleAttribute"]),
-          "divisionalDistribution":               safe_str(chunk["divisionalDistribution"]),
-          "quantitativeReasoning":                safe_str(chunk["quantitativeReasoning"]),
-
-          # TODO: Handle formatting the meetings in a better way to be able to filter by these effectively
-          # "meetings": chunk["meetings"]
-        }]
-      )
-      embedding_id += 1
\ No newline at end of file
+  course_collection = get_collection(chroma_client)
+
+  # As many per call as the backend takes (one call per chunk meant one SQLite transaction and HNSW insert each)
+  batch_size = chroma_client.get_max_batch_size()
+
+  if args.mode == "delete":
+    stale = [id for course_id in args.course_ids for where in course_wheres(course_id, args.term)
+             for id in matching_ids(course_collection, where, batch_size)]
+    delete_ids(course_collection, stale, batch_size)
+    print(f"Deleted {len(stale)} vectors of {len(args.course_ids)} courses in {args.term}")
+    refresh_exact_index(course_collection, db_path)
+    raise SystemExit(0)
+
+  # Upsert all the embeddings (into an empty collection, for a build, so there's nothing to compare against)
+  wanted = set(args.course_ids) if args.course_ids else None
+  (written, terms, dim) = upsert_files(course_collection, args.files, batch_size, wanted, skip_unchanged=args.mode != "build")
+
+  # Only once everything new is in, so queries never see a course missing
+  if args.prune and args.mode != "build":
+    if wanted is None:
+      wheres = [{"termDescription": term} for term in terms]
+    else:
+      wheres = [where for course_id in wanted for term in terms for where in course_wheres(course_id, term)]
+    stale = [id for where in wheres for id in matching_ids(course_collection, where, batch_size) if id not in written]
+    delete_ids(course_collection, stale, batch_size)
+    print(f"Pruned {len(stale)} stale vectors")
+
+  # Every build gets an exact index, so the version can be served by either backend straight away
+  refresh_exact_index(course_collection, db_path, always=args.mode == "build")
+
+  if args.mode == "build":
+    write_manifest(
+      db_path,
+      collection=CONFIG.collection_name,
+      embedding_model=CONFIG.embedding_model,
+      files=[os.path.abspath(file) for file in args.files],
+      course_ids=sorted(wanted) if wanted else None,
+      terms=sorted(terms),
+      vectors=course_collection.count(),
+      dim=dim,
+      coarse_dims=CONFIG.coarse_dims
+    )
+    if not args.no_publish:
+      publish(CONFIG.vector_db_path, version)
+      print(f"Published version {version}, running servers switch over on their next reload")
+    for old in remove_old_versions(CONFIG.vector_db_path, keep=args.keep):
+      print(f"Removed old version {old}")
@@ -0,0 +1,206 @@
+import threading
+from collections import Counter, deque
+
+try:
+  import tiktoken
+except ImportError:
+  tiktoken = None
+
+# Limits of the OpenAI embeddings endpoint. A single request can carry at most 2048 inputs,
+# and at most 300k tokens summed over all of those inputs.
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300_000
+
+
+def clean_text(text: str) -> str:
+  """Same cleanup `get_embedding` has always done: newlines are replaced with spaces."""
+  return text.replace("\n", " ")
+
+
+def embed_texts(client, texts: list[str], model="text-embedding-3-small") -> list[list[float]]:
+  """
+    Embeds a list of texts with a single API call.
+    The API doesn't promise to return the vectors in order, so they are sorted back by `index`.
+  """
+  response = client.embeddings.create(input=texts, model=model)
+  return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class TokenCounter:
+  """
+    Counts tokens the same way the embedding model does when `tiktoken` is installed,
+    otherwise falls back to a (deliberately pessimistic) characters-per-token estimate.
+  """
+
+  def __init__(self, model: str):
+    self.encoding = None
+    if tiktoken is not None:
+      try:
+        self.encoding = tiktoken.encoding_for_model(model)
+      except KeyError:
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+
+  def count(self, text: str) -> int:
+    if self.encoding is not None:
+      return len(self.encoding.encode(text, disallowed_special=()))
+
+    # English averages ~4 chars per token, so 3 over-counts a little and keeps us under the limits
+    return len(text) // 3 + 1
+
+
+class EmbeddingBatcher:
+  """
+    Collects texts from many courses and sends them to the embeddings endpoint in as few requests as possible.
+
+    Every text is queued along with a `target` dict and a `key`. Once the request containing the text comes back,
+    the vector is written to `target[key]`. The `embed_course_vN` specs queue the same entry dicts they store
+    under `embeddings[courseID]`, so each vector lands back on the chunk (and courseID) that asked for it,
+    whichever spec produced the chunk.
+
+    Given a `scheduler` (see embedding_scheduler.py), full batches are handed to its thread pool instead of being
+    sent inline, and `wait` has to be called before reading any vectors. At most `max_queued_batches` are handed
+    over at once, after that `add` blocks on the oldest, so memory stays bounded however big the catalog is.
+    `on_progress(done, queued, error)` is called whenever a batch finishes.
+
+    Given a `cache` (see embedding_cache.py), texts that have been embedded before are filled in straight from it
+    and never sent, and every new vector is saved to it.
+
+    Texts can be tagged with a `group` (the Embedder uses the courseID), and `done(group)` tells whether every
+    text in that group has its vector yet, so finished courses can be written out while others are in flight.
+  """
+
+  def __init__(
+    self,
+    client,
+    model="text-embedding-3-small",
+    max_inputs=MAX_INPUTS_PER_REQUEST,
+    max_tokens=MAX_TOKENS_PER_REQUEST,
+    scheduler=None,
+    on_progress=None,
+    cache=None,
+    max_queued_batches=16,
+  ):
+    self.client = client
+    self.model = model
+    self.max_inputs = max_inputs
+    self.max_tokens = max_tokens
+    self.counter = TokenCounter(model)
+    self.scheduler = scheduler
+    self.on_progress = on_progress
+    self.cache = cache
+
+    # Queued (text, target, key, group) tuples and the token count of the queued texts
+    self.pending = []
+    self.pending_tokens = 0
+
+    # Number of texts in each group still waiting for their vector
+    self.outstanding = Counter()
+
+    # Batches handed to the scheduler that haven't been waited on yet, oldest first
+    self.in_flight = deque()
+    self.max_queued_batches = max_queued_batches
+    self.lock = threading.Lock()
+
+    # Totals for reporting
+    self.requests_sent = 0
+    self.texts_queued = 0
+    self.texts_embedded = 0
+    self.failed = False
+
+  def add(self, text: str, target: dict, key="embedding", group=None):
+    """
+      Queues `text` to be embedded into `target[key]`, as part of `group` if given.
+      Sends the current batch first if adding `text` would take it past either limit.
+    """
+    text = clean_text(text)
+    with self.lock:
+      self.texts_queued += 1
+
+    if self.cache is not None:
+      vector = self.cache.get(self.model, text)
+      if vector is not None:
+        target[key] = vector
+        with self.lock:
+          self.texts_embedded += 1
+        return
+
+    tokens = self.counter.count(text)
+
+    if self.pending and (
+      len(self.pending) + 1 > self.max_inputs or self.pending_tokens + tokens > self.max_tokens
+    ):
+      self.flush()
+
+    if group is not None:
+      with self.lock:
+        self.outstanding[group] += 1
+
+    self.pending.append((text, target, key, group))
+    self.pending_tokens += tokens
+
+  def flush(self):
+    """
+      Sends whatever is queued as a single request and writes the vectors back to their targets.
+      With a scheduler this only submits the request, `wait` for it before using the vectors.
+    """
+    if not self.pending:
+      return
+
+    batch = self.pending
+    tokens = self.pending_tokens
+    self.pending = []
+    self.pending_tokens = 0
+    texts = [text for (text, _, _, _) in batch]
+
+    if self.scheduler is None:
+      self.__store(batch, embed_texts(self.client, texts, model=self.model))
+      return
+
+    while len(self.in_flight) >= self.max_queued_batches:
+      self.in_flight.popleft().result()
+
+    future = self.scheduler.submit(texts, tokens, then=lambda vectors: self.__store(batch, vectors))
+    future.add_done_callback(lambda done: done.exception() and self.__fail())
+    self.in_flight.append(future)
+
+  def wait(self, then=None):
+    """
+      Sends anything still queued, then blocks until every batch is back, calling `then()` as each one arrives.
+      Re-raises the first failure.
+    """
+    self.flush()
+    while self.in_flight:
+      self.in_flight.popleft().result()
+      if then is not None:
+        then()
+
+  def done(self, group) -> bool:
+    """Whether every text queued under `group` has been embedded."""
+    with self.lock:
+      return self.outstanding[group] == 0
+
+  def __store(self, batch, vectors):
+    for ((_, target, key, _), vector) in zip(batch, vectors):
+      target[key] = vector
+
+    if self.cache is not None:
+      self.cache.put_many(self.model, [(text, vector) for ((text, _, _, _), vector) in zip(batch, vectors)])
+
+    with self.lock:
+      for (_, _, _, group) in batch:
+        if group is not None:
+          self.outstanding[group] -= 1
+          if self.outstanding[group] == 0:
+            del self.outstanding[group]
+      self.requests_sent += 1
+      self.texts_embedded += len(batch)
+      self.__report()
+
+  def __fail(self):
+    with self.lock:
+      self.failed = True
+      self.__report()
+
+  def __report(self):
+    if self.on_progress is not None:
+      self.on_progress(self.texts_embedded, self.texts_queued, self.failed)
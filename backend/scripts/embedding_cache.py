@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+import numpy as np
+
+
+def cache_key(model: str, text: str) -> str:
+  """Content address of an embedding: the model name plus the exact text that was embedded."""
+  return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+  """
+    Disk-backed (SQLite) cache of embeddings, keyed by `cache_key(model, text)`.
+
+    Vectors are stored as float32 blobs, which is what the API sends us anyway. When the file grows past
+    `max_size_mb`, the least recently used embeddings are evicted. The same file can be shared by every run
+    (fall, spring, v2, v3...), so text that has been embedded once is never paid for again.
+  """
+
+  def __init__(self, path: str, max_size_mb=2048):
+    self.path = path
+    self.max_bytes = int(max_size_mb * 1024 * 1024)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    # Shared with the embedding scheduler's worker threads, hence the lock
+    self.lock = threading.Lock()
+    self.con = sqlite3.connect(path, check_same_thread=False)
+    self.con.execute("PRAGMA journal_mode=WAL")
+    self.con.execute("""
+      CREATE TABLE IF NOT EXISTS embeddings (
+        key TEXT PRIMARY KEY,
+        model TEXT,
+        vector BLOB,
+        created_at REAL,
+        last_used REAL
+      )
+    """)
+    self.con.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+    self.con.commit()
+    self.size_bytes = self.con.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    # Hits only bump `last_used` in memory, they're written out with the next put/commit
+    self.touched = {}
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, model: str, text: str, max_age=None):
+    """Returns the cached embedding of `text` under `model`, or None. Entries older than `max_age` seconds miss."""
+    entry = self.get_entry(model, text, max_age=max_age)
+    return entry[0] if entry is not None else None
+
+  def get_entry(self, model: str, text: str, max_age=None):
+    """`get`, as (embedding, when it was stored), so a copy kept elsewhere can expire when this one would."""
+    key = cache_key(model, text)
+    with self.lock:
+      row = self.con.execute("SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+      if row is None or (max_age is not None and time.time() - row[1] > max_age):
+        self.misses += 1
+        return None
+
+      self.hits += 1
+      self.touched[key] = time.time()
+      return (array("f", row[0]).tolist(), row[1])
+
+  def put_many(self, model: str, items: list[tuple[str, list[float]]]):
+    """Stores (text, embedding) pairs, then evicts down to the size cap if needed."""
+    now = time.time()
+    # One row per key (the last copy wins, as INSERT OR REPLACE would have it), so repeats aren't counted twice
+    rows = list({
+      key: (key, model, array("f", vector).tobytes(), now, now)
+      for (key, vector) in ((cache_key(model, text), vector) for (text, vector) in items)
+    }.values())
+    with self.lock:
+      for (key, _, blob, _, _) in rows:
+        old = self.con.execute("SELECT LENGTH(vector) FROM embeddings WHERE key = ?", (key,)).fetchone()
+        self.size_bytes += len(blob) - (old[0] if old else 0)
+      self.con.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+      self.__evict()
+      self.__commit()
+
+  def put(self, model: str, text: str, vector: list[float]):
+    self.put_many(model, [(text, vector)])
+
+  def __evict(self):
+    """Drops least recently used embeddings until we're back under the cap (with a bit of headroom)."""
+    if self.size_bytes <= self.max_bytes:
+      return
+
+    self.__write_touched()
+    target = self.max_bytes * 0.9
+    while self.size_bytes > target:
+      victims = self.con.execute(
+        "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000"
+      ).fetchall()
+      if not victims:
+        break
+      self.con.executemany("DELETE FROM embeddings WHERE key = ?", [(key,) for (key, _) in victims])
+      self.size_bytes -= sum(size for (_, size) in victims)
+      self.evictions += len(victims)
+
+  def __write_touched(self):
+    if self.touched:
+      self.con.executemany(
+        "UPDATE embeddings SET last_used = ? WHERE key = ?",
+        [(used, key) for (key, used) in self.touched.items()]
+      )
+      self.touched = {}
+
+  def __commit(self):
+    self.__write_touched()
+    self.con.commit()
+
+  def commit(self):
+    with self.lock:
+      self.__commit()
+
+  def close(self):
+    self.commit()
+    self.con.close()
+
+  def stats(self) -> dict:
+    """Hit/miss counts for this session, plus the current size of the cache."""
+    with self.lock:
+      entries = self.con.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    lookups = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / lookups if lookups else 0.0,
+      "evictions": self.evictions,
+      "entries": entries,
+      "size_mb": self.size_bytes / (1024 * 1024),
+    }
+
+
+def normalise_query(text: str) -> str:
+  """The form queries are cached under: case folded, with whitespace collapsed, so trivial variants share one."""
+  return " ".join(text.casefold().split())
+
+
+class QueryEmbeddingCache:
+  """
+    Embeddings of search queries, for `VectorDatabase`. The same keyword strings ("Computer Science", "biology")
+    come up again and again, and each would otherwise be an embedding API round trip on the request path.
+
+    Queries are keyed by `normalise_query`. An in-memory LRU of up to `max_entries` sits in front of an optional
+    `EmbeddingCache` at `path`, which outlives restarts and can be shared by every worker. Entries older than `ttl`
+    seconds miss in both, so the cache can't keep serving embeddings from a model that has since changed.
+  """
+
+  def __init__(self, model: str, max_entries=4096, ttl=7 * 24 * 3600, path=None, max_size_mb=64):
+    self.model = model
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.persistent = EmbeddingCache(path, max_size_mb=max_size_mb) if path else None
+
+    # normalised query -> (float32 vector, when it was embedded, here or by whoever put it on disk)
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+    self.memory_hits = 0
+    self.persistent_hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __get(self, key: str):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and time.time() - entry[1] <= self.ttl:
+        self.entries.move_to_end(key)
+        self.memory_hits += 1
+        return entry[0]
+      if entry is not None:
+        del self.entries[key]
+
+    entry = self.persistent.get_entry(self.model, key, max_age=self.ttl) if self.persistent else None
+    if entry is None:
+      with self.lock:
+        self.misses += 1
+      return None
+
+    # Kept in memory only until the disk copy would have expired, not for another `ttl` from now
+    (vector, created_at) = (np.asarray(entry[0], dtype=np.float32), entry[1])
+    with self.lock:
+      self.persistent_hits += 1
+      self.__remember(key, vector, created_at)
+    return vector
+
+  def __remember(self, key: str, vector: np.ndarray, created_at=None):
+    self.entries[key] = (vector, time.time() if created_at is None else created_at)
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+      self.evictions += 1
+
+  def embed(self, queries: list[str], embedding_function) -> np.ndarray:
+    """
+      Embeddings of `queries` (one row each), from the cache where possible. Everything that misses is embedded
+      with a single call of `embedding_function`, each distinct query once, as first written.
+    """
+    (keys, originals, vectors, missing) = self.__lookup(queries)
+    if missing:
+      self.__store(vectors, missing, embedding_function([originals[key] for key in missing]))
+    return np.stack([vectors[key] for key in keys])
+
+  async def aembed(self, queries: list[str], aembedding_function) -> np.ndarray:
+    """
+      `embed`, for an async `aembedding_function` (awaited once, for everything that misses). The persistent
+      cache's reads and writes are blocking SQLite calls, so with one they run in a thread, off the event loop.
+    """
+    (keys, originals, vectors, missing) = await self.__off_loop(self.__lookup, queries)
+    if missing:
+      embedded = await aembedding_function([originals[key] for key in missing])
+      await self.__off_loop(self.__store, vectors, missing, embedded)
+    return np.stack([vectors[key] for key in keys])
+
+  async def __off_loop(self, function, *args):
+    # Only the persistent cache blocks; the in-memory one alone isn't worth the hop to a thread
+    return await asyncio.to_thread(function, *args) if self.persistent else function(*args)
+
+  def __lookup(self, queries: list[str]):
+    """The cache keys of `queries`, the query each distinct key was first written as, what's cached and what missed."""
+    keys = [normalise_query(query) for query in queries]
+    originals = dict(zip(reversed(keys), reversed(queries)))
+    vectors = {key: self.__get(key) for key in dict.fromkeys(keys)}
+    missing = [key for (key, vector) in vectors.items() if vector is None]
+    return keys, originals, vectors, missing
+
+  def __store(self, vectors: dict, missing: list[str], embedded):
+    embedded = np.asarray(embedded, dtype=np.float32)
+    with self.lock:
+      for (key, vector) in zip(missing, embedded):
+        self.__remember(key, vector)
+    if self.persistent:
+      self.persistent.put_many(self.model, list(zip(missing, embedded.tolist())))
+    vectors.update(zip(missing, embedded))
+
+  def stats(self) -> dict:
+    """Hit rate and size. Persistent hits also count as hits, since they still save the API call."""
+    with self.lock:
+      hits = self.memory_hits + self.persistent_hits
+      lookups = hits + self.misses
+      return {
+        "memory_hits": self.memory_hits,
+        "persistent_hits": self.persistent_hits,
+        "misses": self.misses,
+        "hit_rate": hits / lookups if lookups else 0.0,
+        "evictions": self.evictions,
+        "entries": len(self.entries),
+        "persistent": self.persistent.stats() if self.persistent else None,
+      }
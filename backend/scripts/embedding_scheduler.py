@@ -0,0 +1,178 @@
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import openai
+
+# Default limits for text-embedding-3-small on a tier 1 key. Both adapt at runtime to what the API reports.
+REQUESTS_PER_MINUTE = 3_000
+TOKENS_PER_MINUTE = 1_000_000
+
+# Errors that are worth retrying, anything else (bad request, auth, ...) fails the request straight away
+RETRYABLE_ERRORS = (
+  openai.RateLimitError,
+  openai.APIConnectionError,
+  openai.APITimeoutError,
+  openai.InternalServerError,
+)
+
+
+def parse_reset(value):
+  """Parses the `x-ratelimit-reset-*` duration format ('20ms', '1s', '6m0s', '1h2m3.5s') into seconds."""
+  if not value:
+    return None
+
+  units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+  parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+  if not parts:
+    try:
+      return float(value)
+    except ValueError:
+      return None
+  return sum(float(amount) * units[unit] for (amount, unit) in parts)
+
+
+class TokenBucket:
+  """
+    Rate limiter shared by every worker, holding a bucket for requests and one for tokens.
+    Both refill continuously at their per-minute rate, and `acquire` blocks until a request's share is available.
+
+    The rates adapt to the API: a 429 cuts them (and pauses everyone for the `retry-after` time), while the
+    `x-ratelimit-*` headers on each response correct the bucket levels and ceilings to what the server sees.
+    Successful responses slowly grow the rates back up to the configured ceiling.
+  """
+
+  def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+    self.lock = threading.Condition()
+    self.max_rates = {"requests": float(requests_per_minute), "tokens": float(tokens_per_minute)}
+    self.rates = dict(self.max_rates)
+    self.levels = dict(self.max_rates)
+    self.last_refill = time.monotonic()
+    self.paused_until = 0.0
+
+    # For reporting
+    self.rate_limited = 0
+
+  def __refill(self):
+    now = time.monotonic()
+    elapsed = now - self.last_refill
+    self.last_refill = now
+    for kind in self.levels:
+      self.levels[kind] = min(self.rates[kind], self.levels[kind] + elapsed * self.rates[kind] / 60)
+
+  def acquire(self, tokens: int):
+    """Blocks until there is room for one request of `tokens` tokens, then takes it."""
+    with self.lock:
+      while True:
+        self.__refill()
+        # A batch bigger than a whole minute's worth of tokens would never fit, let it through on a full bucket
+        needed = {"requests": 1, "tokens": min(tokens, self.rates["tokens"])}
+        wait = self.paused_until - time.monotonic()
+
+        if wait <= 0 and all(self.levels[kind] >= needed[kind] for kind in needed):
+          for kind in needed:
+            self.levels[kind] -= needed[kind]
+          return
+
+        if wait <= 0:
+          wait = max(
+            (needed[kind] - self.levels[kind]) * 60 / self.rates[kind]
+            for kind in needed
+            if self.levels[kind] < needed[kind]
+          )
+        self.lock.wait(timeout=wait)
+
+  def on_success(self, headers):
+    """Syncs the buckets to the `x-ratelimit-*` headers of a successful response, and creeps the rates back up."""
+    with self.lock:
+      self.__refill()
+      for kind in self.rates:
+        limit = headers.get(f"x-ratelimit-limit-{kind}")
+        remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+        if limit:
+          self.max_rates[kind] = min(self.max_rates[kind], float(limit))
+        if remaining:
+          self.levels[kind] = min(self.levels[kind], float(remaining))
+        self.rates[kind] = min(self.max_rates[kind], self.rates[kind] * 1.05)
+      self.lock.notify_all()
+
+  def on_rate_limited(self, headers):
+    """Backs off after a 429: pauses every worker until the server says to come back, and cuts the rates."""
+    with self.lock:
+      self.rate_limited += 1
+      retry_after = parse_reset(headers.get("retry-after")) or max(
+        parse_reset(headers.get("x-ratelimit-reset-requests")) or 0,
+        parse_reset(headers.get("x-ratelimit-reset-tokens")) or 0,
+        1.0
+      )
+      self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+      for kind in self.rates:
+        self.rates[kind] = max(1.0, self.rates[kind] * 0.75)
+        self.levels[kind] = min(self.levels[kind], self.rates[kind])
+
+
+class EmbeddingScheduler:
+  """
+    Runs embedding requests on a thread pool, with at most `max_in_flight` requests out at once.
+    Every request goes through the shared `TokenBucket` first, and retries on its own with jittered exponential
+    backoff, so one batch backing off only holds up its own worker rather than the whole run.
+  """
+
+  def __init__(
+    self,
+    client,
+    model="text-embedding-3-small",
+    max_in_flight=8,
+    requests_per_minute=REQUESTS_PER_MINUTE,
+    tokens_per_minute=TOKENS_PER_MINUTE,
+    max_attempts=6,
+  ):
+    # We do the retrying (and rate limiting) ourselves, so the client shouldn't retry behind our back
+    self.client = client.with_options(max_retries=0)
+    self.model = model
+    self.max_attempts = max_attempts
+    self.bucket = TokenBucket(requests_per_minute, tokens_per_minute)
+    self.pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="embedder")
+    # Every worker counts its retries here
+    self.lock = threading.Lock()
+    self.retries = 0
+
+  def submit(self, texts: list[str], tokens: int, then=None) -> Future:
+    """
+      Schedules `texts` (`tokens` tokens in total) to be embedded, the future resolves to their vectors in order.
+      `then(vectors)` runs on the worker before the future resolves, so its effects are visible to anyone waiting on it.
+    """
+    return self.pool.submit(self.__run, texts, tokens, then)
+
+  def __run(self, texts: list[str], tokens: int, then) -> list[list[float]]:
+    vectors = self.__embed(texts, tokens)
+    if then is not None:
+      then(vectors)
+    return vectors
+
+  def __embed(self, texts: list[str], tokens: int) -> list[list[float]]:
+    for attempt in range(self.max_attempts):
+      self.bucket.acquire(tokens)
+      try:
+        raw = self.client.embeddings.with_raw_response.create(input=texts, model=self.model)
+      except RETRYABLE_ERRORS as e:
+        if attempt == self.max_attempts - 1:
+          raise
+
+        with self.lock:
+          self.retries += 1
+        if isinstance(e, openai.RateLimitError):
+          # The bucket holds every worker back until the server's reset time, `acquire` does the waiting
+          self.bucket.on_rate_limited(e.response.headers)
+        else:
+          # Only this request sleeps, every other worker carries on
+          time.sleep(min(60, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+        continue
+
+      self.bucket.on_success(raw.headers)
+      response = raw.parse()
+      return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+  def shutdown(self):
+    self.pool.shutdown(wait=True)
@@ -0,0 +1,386 @@
+"""
+Reading and writing embedding files one course at a time.
+
+There are two formats, and both are written a course at a time as soon as its embeddings are all back, so memory
+doesn't grow with the catalog, a crash only loses the course being written, and `--resume` can pick up from the
+courses already on disk.
+
+  - Binary stores (the default): a directory holding
+      vectors.npy        every chunk's embedding, one row per chunk, as a float32 (or float16) matrix.
+                         Loaded with `np.load(..., mmap_mode="r")`, so readers never copy or parse it.
+      columns/<name>.jsonl
+                         the rest of each chunk (courseID, text, filter fields...), one file per field with one
+                         line per row, so a reader can load just the fields it needs.
+      courses.jsonl      [courseID, first row, number of rows] for every course, in the order they were written.
+      manifest.json      dtype, dimensions, row count, column names, and the Matryoshka prefix the model supports
+                         (`coarse_dims`, whose view `EmbeddingStore.coarse_vectors` gives).
+  - JSON lines, one course per line: {"<courseID>": [chunk, chunk, ...]}. Used for the samples, which are meant
+    to be read by people.
+
+`iter_embeddings` reads either, as well as the older single-object files (including the pretty printed samples),
+without the caller having to know which is which.
+
+  python embedding_store.py ../embeddings/samples/fall24_v3_sample.jsonl
+  python embedding_store.py --convert ../embeddings/fall24_v3.json ../embeddings/fall24_v3
+"""
+import argparse
+import json
+import os
+import struct
+import time
+import numpy as np
+
+# vectors.npy always has a header this long, so the row count in it can be rewritten in place as rows are appended
+NPY_HEADER_BYTES = 128
+
+# Chunk keys the embedding itself is stored under (v1 linear attributes used "embeddings")
+EMBEDDING_KEYS = ("embedding", "embeddings")
+
+
+def is_binary_store(path: str) -> bool:
+  return os.path.isdir(path) and os.path.exists(os.path.join(path, "manifest.json"))
+
+
+def iter_embeddings(path: str):
+  """
+    Yields (courseID, chunks) for every course in an embedding file or binary store, one course at a time.
+    From a binary store each chunk's "embedding" is a read-only view into the memory mapped matrix, not a copy.
+  """
+  if is_binary_store(path):
+    yield from EmbeddingStore(path).iter_courses()
+    return
+
+  with open(path, "r") as f:
+    first = f.readline()
+    try:
+      line = json.loads(first)
+    except json.JSONDecodeError:
+      line = None
+
+    if not isinstance(line, dict):
+      # Old format: one (possibly pretty printed) object holding every course
+      f.seek(0)
+      yield from json.load(f).items()
+      return
+
+    yield from line.items()
+    for line in f:
+      if line.strip():
+        yield from json.loads(line).items()
+
+
+class EmbeddingWriter:
+  """
+    Appends courses to a JSON lines embedding file as they are finished.
+
+    Every `checkpoint_every` courses the file is flushed and fsynced, so everything before the last checkpoint
+    survives a crash. With `resume`, the file is kept: a trailing partial line (from a crash mid-write) is cut off,
+    and the courseIDs already written are available in `written_ids` to be skipped.
+  """
+
+  def __init__(self, path: str, resume=False, checkpoint_every=100):
+    self.path = path
+    self.checkpoint_every = checkpoint_every
+    self.written_ids = set()
+    self.since_checkpoint = 0
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if resume and os.path.exists(path):
+      self.__recover()
+      self.file = open(path, "a")
+    else:
+      self.file = open(path, "w")
+
+  def __recover(self):
+    """Collects the courseIDs already written, truncating the file after the last complete line."""
+    good_bytes = 0
+    with open(self.path, "rb") as f:
+      for line in f:
+        try:
+          course = json.loads(line)
+        except json.JSONDecodeError:
+          break
+        self.written_ids.update(course.keys())
+        good_bytes += len(line)
+
+    with open(self.path, "r+b") as f:
+      f.truncate(good_bytes)
+
+  def write_course(self, course_id, chunks: list[dict]):
+    self.file.write(json.dumps({str(course_id): chunks}) + "\n")
+    self.written_ids.add(str(course_id))
+
+    self.since_checkpoint += 1
+    if self.since_checkpoint >= self.checkpoint_every:
+      self.checkpoint()
+
+  def checkpoint(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.since_checkpoint = 0
+
+  def close(self):
+    self.checkpoint()
+    self.file.close()
+
+
+def npy_header(dtype, rows: int, dim: int) -> bytes:
+  """A version 1.0 .npy header for a C-ordered (rows, dim) matrix, padded to exactly `NPY_HEADER_BYTES`."""
+  header = f"{{'descr': '{np.dtype(dtype).str}', 'fortran_order': False, 'shape': ({rows}, {dim}), }}"
+  header = header.ljust(NPY_HEADER_BYTES - 11) + "\n"
+  return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class BinaryEmbeddingWriter:
+  """
+    Appends courses to a binary embedding store (see the top of this file) as they are finished.
+    Same interface, checkpointing and resume behaviour as `EmbeddingWriter`.
+
+    Rows are appended to vectors.npy and the column files first, and the course is only recorded in courses.jsonl
+    after, so on resume anything past the last recorded course is cut off everywhere.
+  """
+
+  def __init__(self, path: str, resume=False, checkpoint_every=100, dtype="float32", model=None, coarse_dims=None):
+    self.path = path
+    self.checkpoint_every = checkpoint_every
+    self.dtype = np.dtype(dtype)
+    self.model = model
+    self.coarse_dims = coarse_dims
+    self.written_ids = set()
+    self.since_checkpoint = 0
+    self.rows = 0
+    self.dim = None
+    self.columns = {}
+
+    os.makedirs(os.path.join(path, "columns"), exist_ok=True)
+    if resume and is_binary_store(path):
+      self.__recover()
+      self.vectors = open(self.__file("vectors.npy"), "r+b")
+      self.vectors.seek(0, os.SEEK_END)
+      self.courses = open(self.__file("courses.jsonl"), "a")
+    else:
+      for name in os.listdir(self.__file("columns")):
+        os.remove(os.path.join(self.__file("columns"), name))
+      self.vectors = open(self.__file("vectors.npy"), "w+b")
+      self.vectors.write(npy_header(self.dtype, 0, 0))
+      self.courses = open(self.__file("courses.jsonl"), "w")
+      self.__write_manifest()
+
+  def __file(self, name: str) -> str:
+    return os.path.join(self.path, name)
+
+  def __recover(self):
+    """
+      Finds the last course whose rows all made it to disk (file buffers don't reach it in the order they were
+      written to), and truncates every file back to the end of that course.
+    """
+    with open(self.__file("manifest.json"), "r") as f:
+      manifest = json.load(f)
+    self.dtype = np.dtype(manifest["dtype"])
+    self.dim = manifest["dim"] or None
+
+    column_paths = [os.path.join(self.__file("columns"), name) for name in sorted(os.listdir(self.__file("columns")))]
+    available = [
+      (os.path.getsize(self.__file("vectors.npy")) - NPY_HEADER_BYTES) // (self.dim * self.dtype.itemsize)
+      if self.dim else 0
+    ]
+    for column_path in column_paths:
+      with open(column_path, "rb") as f:
+        available.append(sum(1 for line in f if line.endswith(b"\n")))
+    available = min(available)
+
+    good_bytes = 0
+    with open(self.__file("courses.jsonl"), "rb") as f:
+      for line in f:
+        try:
+          (course_id, start, count) = json.loads(line)
+        except json.JSONDecodeError:
+          break
+        if start + count > available:
+          break
+        self.written_ids.add(course_id)
+        self.rows = start + count
+        good_bytes += len(line)
+
+    with open(self.__file("courses.jsonl"), "r+b") as f:
+      f.truncate(good_bytes)
+    with open(self.__file("vectors.npy"), "r+b") as f:
+      f.truncate(NPY_HEADER_BYTES + self.rows * (self.dim or 0) * self.dtype.itemsize)
+
+    for column_path in column_paths:
+      with open(column_path, "rb") as f:
+        kept = b"".join(line for (_, line) in zip(range(self.rows), f))
+      with open(column_path, "wb") as f:
+        f.write(kept)
+      self.columns[os.path.basename(column_path)[:-len(".jsonl")]] = open(column_path, "a")
+
+  def __column(self, name: str):
+    """The file of column `name`, created (back-filled with nulls for earlier rows) the first time it's seen."""
+    if name not in self.columns:
+      column = open(os.path.join(self.__file("columns"), f"{name}.jsonl"), "w")
+      column.write("null\n" * self.rows)
+      self.columns[name] = column
+    return self.columns[name]
+
+  def write_course(self, course_id, chunks: list[dict]):
+    for chunk in chunks:
+      vector = next((chunk[key] for key in EMBEDDING_KEYS if chunk.get(key) is not None), None)
+      row = np.asarray(vector, dtype=self.dtype)
+      if self.dim is None:
+        # Recovery needs the row size to make sense of vectors.npy, so record it straight away
+        self.dim = len(row)
+        self.__write_manifest()
+      self.vectors.write(row.tobytes())
+
+      fields = {"courseID": str(course_id), **{k: v for (k, v) in chunk.items() if k not in EMBEDDING_KEYS}}
+      for name in set(fields) | set(self.columns):
+        self.__column(name).write(json.dumps(fields.get(name)) + "\n")
+      self.rows += 1
+
+    self.courses.write(json.dumps([str(course_id), self.rows - len(chunks), len(chunks)]) + "\n")
+    self.written_ids.add(str(course_id))
+
+    self.since_checkpoint += 1
+    if self.since_checkpoint >= self.checkpoint_every:
+      self.checkpoint()
+
+  def __write_manifest(self):
+    manifest = {
+      "dtype": self.dtype.name,
+      "dim": self.dim or 0,
+      "rows": self.rows,
+      "model": self.model,
+      "coarse_dims": self.coarse_dims,
+      "columns": sorted(self.columns),
+    }
+    with open(self.__file("manifest.json.tmp"), "w") as f:
+      json.dump(manifest, f)
+    os.replace(self.__file("manifest.json.tmp"), self.__file("manifest.json"))
+
+  def checkpoint(self):
+    """Syncs rows and columns to disk, then records them in the .npy header, courses.jsonl and the manifest."""
+    for f in [self.vectors, *self.columns.values()]:
+      f.flush()
+      os.fsync(f.fileno())
+
+    position = self.vectors.tell()
+    self.vectors.seek(0)
+    self.vectors.write(npy_header(self.dtype, self.rows, self.dim or 0))
+    self.vectors.seek(position)
+    self.vectors.flush()
+
+    self.courses.flush()
+    os.fsync(self.courses.fileno())
+    self.__write_manifest()
+    self.since_checkpoint = 0
+
+  def close(self):
+    self.checkpoint()
+    for f in [self.vectors, self.courses, *self.columns.values()]:
+      f.close()
+
+
+class EmbeddingStore:
+  """
+    Read side of a binary embedding store. `vectors` is memory mapped, so opening a store costs the same whatever
+    its size, and rows are only paged in when they are used.
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+      self.manifest = json.load(f)
+    self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+    self.rows = self.manifest["rows"]
+    self.column_names = self.manifest["columns"]
+    self.coarse_dims = self.manifest.get("coarse_dims")
+
+  def coarse_vectors(self, dims=None) -> np.ndarray:
+    """
+      The coarse view of every row: its first `dims` (by default `coarse_dims`) dimensions, renormalised. It's
+      derived rather than stored, since for a Matryoshka model it's exactly what asking for fewer dimensions returns.
+    """
+    dims = dims or self.coarse_dims
+    if not dims:
+      raise ValueError(f"{self.path} wasn't embedded by a model with a coarse view, pass the dimensions to use")
+    coarse = np.asarray(self.vectors[:self.rows, :dims], dtype=np.float32)
+    norms = np.linalg.norm(coarse, axis=1, keepdims=True)
+    return coarse / np.where(norms == 0, 1, norms)
+
+  def column(self, name: str) -> list:
+    """Every row's value of one field, read without touching the other columns."""
+    with open(os.path.join(self.path, "columns", f"{name}.jsonl"), "r") as f:
+      return [json.loads(line) for (_, line) in zip(range(self.rows), f)]
+
+  def courses(self):
+    """Yields (courseID, first row, number of rows) for every course in the store."""
+    with open(os.path.join(self.path, "courses.jsonl"), "r") as f:
+      for line in f:
+        (course_id, start, count) = json.loads(line)
+        if start + count > self.rows:
+          break
+        yield (course_id, start, count)
+
+  def iter_courses(self):
+    """Yields (courseID, chunks) like the JSON formats do, with chunk embeddings as views into `vectors`."""
+    files = [open(os.path.join(self.path, "columns", f"{name}.jsonl"), "r") for name in self.column_names]
+    try:
+      for (course_id, start, count) in self.courses():
+        chunks = []
+        for row in range(start, start + count):
+          chunk = {name: json.loads(f.readline()) for (name, f) in zip(self.column_names, files)}
+          chunk["embedding"] = self.vectors[row]
+          chunks.append(chunk)
+        yield (course_id, chunks)
+    finally:
+      for f in files:
+        f.close()
+
+
+def convert(source: str, destination: str, dtype="float32"):
+  """Converts any embedding file `iter_embeddings` can read into a binary store at `destination`."""
+  writer = BinaryEmbeddingWriter(destination, dtype=dtype, checkpoint_every=1000)
+  for (course_id, chunks) in iter_embeddings(source):
+    writer.write_course(course_id, chunks)
+  writer.close()
+
+
+def size_on_disk(path: str) -> int:
+  if os.path.isfile(path):
+    return os.path.getsize(path)
+  return sum(os.path.getsize(os.path.join(root, name)) for (root, _, names) in os.walk(path) for name in names)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Summarises embedding files/stores without loading them whole.")
+  parser.add_argument("paths", nargs="+")
+  parser.add_argument("--convert", action="store_true", help="convert the first path into a binary store at the second")
+  parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+  args = parser.parse_args()
+
+  if args.convert:
+    (source, destination) = args.paths
+    convert(source, destination, dtype=args.dtype)
+
+    # Compare what it takes to get every vector into memory from each format
+    start = time.perf_counter()
+    json_vectors = [chunk.get("embedding") or chunk.get("embeddings") for (_, chunks) in iter_embeddings(source) for chunk in chunks]
+    json_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    # A copy, so every page of the memmap is actually read (asarray would only map the file)
+    binary_vectors = np.array(EmbeddingStore(destination).vectors)
+    binary_seconds = time.perf_counter() - start
+
+    print(f"{'':<8}{'MB':>10}{'load s':>10}")
+    print(f"{'json':<8}{size_on_disk(source) / 1e6:>10.1f}{json_seconds:>10.3f}")
+    print(f"{'binary':<8}{size_on_disk(destination) / 1e6:>10.1f}{binary_seconds:>10.3f}")
+    print(f"{len(json_vectors)} vectors of dim {binary_vectors.shape[1] if binary_vectors.size else 0}")
+  else:
+    for path in args.paths:
+      courses = chunks = 0
+      dims = set()
+      for (course_id, course_chunks) in iter_embeddings(path):
+        courses += 1
+        chunks += len(course_chunks)
+        dims.update(len(chunk["embedding"] if chunk.get("embedding") is not None else chunk.get("embeddings") or []) for chunk in course_chunks)
+      print(f"{path}: {courses} courses, {chunks} chunks, embedding dims {sorted(dims)}")
@@ -0,0 +1,433 @@
+"""
+Exact (brute force) vector search over an export of a Chroma collection, for `VectorDatabase(backend="numpy")`.
+
+At a few tens of thousands of chunks, one matrix multiply over every vector is both faster than Chroma's HNSW + SQLite
+round trips and exact. An export lives next to the Chroma database it came from:
+
+  <db>/exact/<collection>/
+    vectors.npy       float32 (rows, dim), L2 normalised, memory mapped when loaded
+    norms.npy         the original length of every row
+    ids.json          Chroma id of every row
+    metadatas.jsonl   metadata of every row, one JSON object per line
+    filters.json      for each filter field, every value -> where its rows are in filter_rows.npy
+    filter_rows.npy   int32 row numbers, sorted, one run per (field, value)
+    codes.npy         int8 (rows, dim), the normalised vectors scalar quantized, for `ExactIndex(quantized=True)`
+    scales.npy        float32 (dim), the step of every dimension's codes
+    coarse.npy        float32 (rows, coarse_dims), the first dimensions of every vector, renormalised
+    manifest.json     rows, dim, distance space, when it was exported
+
+Scores are the same distances Chroma reports for the collection's space (lower is closer): squared L2 (Chroma's
+default), cosine distance (what collections made with an OpenAI embedding function use), or inner product.
+
+Filters are resolved against the precomputed row sets: a field condition is a lookup, `$and` an intersection
+(smallest set first) and `$or` a union, so only the rows that match are scored, and every extra filter makes a
+search cheaper rather than dearer. (A filter matching most of the index is applied as a mask over a full scan.)
+
+A quantized index keeps only the int8 codes in memory, a quarter of the float32 vectors, and scores them first:
+the top `n_results * rescore` rows of that approximate pass are then rescored exactly from the full precision
+vectors, which stay memory mapped on disk, so a query only pages in its shortlist. `bench_vector_search.py` measures
+what that costs in recall.
+
+Two stage search (`shortlist=`) is the same idea for Matryoshka embeddings like text-embedding-3-small, whose
+leading dimensions are a usable embedding by themselves (the API's shortened `dimensions` are exactly a prefix,
+renormalised): the coarse 256 dimension view ranks every row at a sixth of the cost, and only the shortlist is
+reranked with all the dimensions.
+
+Doesn't import config/utils, so the backend can use it too (`from scripts.exact_index import ExactIndex`).
+"""
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict, defaultdict
+import numpy as np
+
+EXACT_DIR = "exact"
+
+# Filters matching more than this fraction of rows are applied by masking a full scan instead of gathering rows
+DENSE_FILTER_FRACTION = 0.3
+
+# Rows of int8 codes widened to float32 at a time while scoring. Small enough for the block to stay in cache
+# (256 x 1536 floats is 1.5 MiB), which keeps the int8 scan about as fast as the float32 one
+CODE_BLOCK_ROWS = 256
+
+
+def exact_index_path(db_path: str, collection_name: str) -> str:
+  return os.path.join(db_path, EXACT_DIR, collection_name)
+
+
+def normalise(vectors: np.ndarray) -> np.ndarray:
+  vectors = np.asarray(vectors, dtype=np.float32)
+  norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+  return vectors / np.where(norms == 0, 1, norms)
+
+
+def quantize(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  """
+    Symmetric int8 scalar quantization of (normalised) `vectors`, with one scale per dimension so the few dimensions
+    with a wide range don't cost the rest their precision. Returns (codes, scales), codes * scales ~ vectors.
+  """
+  scales = np.abs(vectors).max(axis=0) / 127 if len(vectors) else np.ones(vectors.shape[1], dtype=np.float32)
+  scales = np.where(scales == 0, 1, scales).astype(np.float32)
+  codes = np.empty(vectors.shape, dtype=np.int8)
+  for start in range(0, len(vectors), CODE_BLOCK_ROWS):
+    block = np.asarray(vectors[start:start + CODE_BLOCK_ROWS], dtype=np.float32)
+    codes[start:start + CODE_BLOCK_ROWS] = np.clip(np.rint(block / scales), -127, 127)
+  return codes, scales
+
+
+def prefix(vectors: np.ndarray, dims: int) -> np.ndarray:
+  """The Matryoshka view of `vectors`: their first `dims` dimensions, renormalised."""
+  return normalise(np.asarray(vectors[:, :dims], dtype=np.float32))
+
+
+def top_k(distances: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+  """Columns and values of the `k` smallest `distances` of every row, smallest first. Only those k are sorted."""
+  top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+  top_distances = np.take_along_axis(distances, top, axis=1)
+  order = np.argsort(top_distances, axis=1)
+  return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_distances, order, axis=1)
+
+
+def collection_space(collection) -> str:
+  """The distance function ("l2", "cosine" or "ip") a Chroma collection is configured with."""
+  configuration = getattr(collection, "configuration_json", None) or {}
+  space = (configuration.get("hnsw") or {}).get("space") or (collection.metadata or {}).get("hnsw:space")
+  return space or "l2"
+
+
+def filter_key(value) -> str:
+  """How a metadata value is keyed in filters.json (as JSON, so "1" and 1 stay different, like in Chroma)."""
+  return json.dumps(value)
+
+
+def export_collection(collection, path: str, page_size=5000, filter_fields=None, coarse_dims=None) -> int:
+  """
+    Writes every row of a Chroma `collection` to an exact index at `path`, replacing any previous export there.
+    Row sets are precomputed for every field in `filter_fields` (by default, every metadata field but "text"), and
+    with `coarse_dims` the coarse view for two stage search is written too.
+    Returns the number of rows. Written off to the side and renamed into place, so readers see one or the other.
+  """
+  tmp = path + ".tmp"
+  shutil.rmtree(tmp, ignore_errors=True)
+  os.makedirs(tmp)
+
+  (ids, vectors, norms) = ([], [], [])
+  postings = defaultdict(lambda: defaultdict(list))
+  with open(os.path.join(tmp, "metadatas.jsonl"), "w") as f:
+    while True:
+      page = collection.get(include=["embeddings", "metadatas"], limit=page_size, offset=len(ids))
+      if len(page["ids"]):
+        embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+        vectors.append(normalise(embeddings))
+        norms.append(np.linalg.norm(embeddings, axis=1))
+      for (row, metadata) in enumerate(page["metadatas"], start=len(ids)):
+        f.write(json.dumps(metadata) + "\n")
+        for (field, value) in (metadata or {}).items():
+          if (field in filter_fields) if filter_fields is not None else field != "text":
+            postings[field][filter_key(value)].append(row)
+      ids.extend(page["ids"])
+      if len(page["ids"]) < page_size:
+        break
+
+  # Every (field, value)'s rows, one after the other in a single array, with their offsets in filters.json
+  (filters, runs, start) = ({}, [], 0)
+  for (field, values) in postings.items():
+    filters[field] = {}
+    for (value, rows) in values.items():
+      filters[field][value] = [start, len(rows)]
+      runs.append(np.asarray(rows, dtype=np.int32))
+      start += len(rows)
+  np.save(os.path.join(tmp, "filter_rows.npy"), np.concatenate(runs) if runs else np.zeros(0, dtype=np.int32))
+  with open(os.path.join(tmp, "filters.json"), "w") as f:
+    json.dump(filters, f)
+
+  matrix = np.concatenate(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+  np.save(os.path.join(tmp, "vectors.npy"), matrix)
+  (codes, scales) = quantize(matrix)
+  np.save(os.path.join(tmp, "codes.npy"), codes)
+  np.save(os.path.join(tmp, "scales.npy"), scales)
+  coarse_dims = min(coarse_dims, matrix.shape[1]) if coarse_dims and matrix.size else None
+  if coarse_dims:
+    np.save(os.path.join(tmp, "coarse.npy"), prefix(matrix, coarse_dims))
+  np.save(os.path.join(tmp, "norms.npy"), np.concatenate(norms) if norms else np.zeros(0, dtype=np.float32))
+  with open(os.path.join(tmp, "ids.json"), "w") as f:
+    json.dump(ids, f)
+  with open(os.path.join(tmp, "manifest.json"), "w") as f:
+    json.dump({
+      "rows": len(ids),
+      "dim": int(matrix.shape[1]),
+      "space": collection_space(collection),
+      "coarse_dims": coarse_dims,
+      "exported_at": time.time()
+    }, f)
+
+  if os.path.exists(path):
+    os.replace(path, path + ".old")
+  os.replace(tmp, path)
+  shutil.rmtree(path + ".old", ignore_errors=True)
+  return len(ids)
+
+
+def similarity(distance: float, space: str) -> float:
+  """Turns a Chroma distance back into a similarity (higher is closer), assuming unit length embeddings for l2."""
+  return 1 - distance / 2 if space == "l2" else 1 - distance
+
+
+def group_hits(hits: list[dict], n_results: int, group_by: str, aggregate: str, space: str) -> list[dict]:
+  """
+    Folds chunk `hits` ({id, metadata, score} dicts, closest first) into the best `n_results` groups by metadata
+    field `group_by` (e.g. "courseID"), scoring each group by the "max" or "sum" of its chunks' similarities.
+    Every group is its closest chunk's {id, metadata, score}, plus its "group_score" and all its "chunks".
+  """
+  if aggregate not in ("max", "sum"):
+    raise ValueError(f"Unknown aggregate {aggregate}, expected max or sum")
+
+  groups = {}
+  for hit in hits:
+    key = hit["metadata"].get(group_by)
+    value = similarity(hit["score"], space)
+    if key not in groups:
+      groups[key] = {**hit, "group_score": value, "chunks": [hit]}
+      continue
+    group = groups[key]
+    group["group_score"] = group["group_score"] + value if aggregate == "sum" else max(group["group_score"], value)
+    group["chunks"].append(hit)
+
+  # Stable, so equal scores keep the order of their closest chunks
+  return sorted(groups.values(), key=lambda group: -group["group_score"])[:n_results]
+
+
+def read_stamp(path: str):
+  """When the export at `path` was written (None if there isn't one), to tell if a loaded index is out of date."""
+  try:
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+      return json.load(f)["exported_at"]
+  except FileNotFoundError:
+    return None
+
+
+def intersect(row_sets: list[np.ndarray]) -> np.ndarray:
+  """Rows in all of `row_sets` (sorted, unique), starting from the smallest so the work shrinks as it goes."""
+  row_sets = sorted(row_sets, key=len)
+  rows = row_sets[0]
+  for other in row_sets[1:]:
+    if not len(rows):
+      break
+    rows = np.intersect1d(rows, other, assume_unique=True)
+  return rows
+
+
+def union(row_sets: list[np.ndarray]) -> np.ndarray:
+  """Rows in any of `row_sets` (sorted, unique)."""
+  if len(row_sets) == 1:
+    return row_sets[0]
+  return np.unique(np.concatenate(row_sets))
+
+
+class ExactIndex:
+  """
+    An exported collection, searched exactly with NumPy. With `quantized`, searched over its int8 codes first, and the
+    top `n_results * rescore` rows of that rescored exactly. Searches given a `shortlist` rank the coarse view first.
+  """
+
+  def __init__(self, path: str, quantized=False, rescore=4):
+    self.path = path
+    self.quantized = quantized
+    self.rescore = rescore
+    with open(os.path.join(path, "manifest.json"), "r") as f:
+      self.manifest = json.load(f)
+    self.stamp = self.manifest["exported_at"]
+    self.space = self.manifest["space"]
+    self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+    self.norms = np.load(os.path.join(path, "norms.npy"))
+    with open(os.path.join(path, "ids.json"), "r") as f:
+      self.ids = json.load(f)
+    with open(os.path.join(path, "metadatas.jsonl"), "r") as f:
+      self.metadatas = [json.loads(line) for line in f]
+    self.rows = len(self.ids)
+    self.all_rows = np.arange(self.rows, dtype=np.int32)
+    self.columns = {}
+
+    # Read into memory (unlike the vectors), since every query scans all of them. Exports from before there were
+    # codes get quantized here instead.
+    (self.codes, self.scales) = (None, None)
+    if quantized and os.path.exists(os.path.join(path, "codes.npy")):
+      (self.codes, self.scales) = (np.load(os.path.join(path, "codes.npy")), np.load(os.path.join(path, "scales.npy")))
+    elif quantized:
+      (self.codes, self.scales) = quantize(self.vectors)
+
+    # A sixth of the size of the vectors (at 256 of 1536 dimensions), and scanned by every two stage search
+    self.coarse = None
+    if os.path.exists(os.path.join(path, "coarse.npy")):
+      self.coarse = np.load(os.path.join(path, "coarse.npy"))
+
+    # field -> value key -> sorted row numbers (views into one array). Exports from before there were
+    # filter indexes have none, and get every field scanned instead.
+    self.filters = {}
+    if os.path.exists(os.path.join(path, "filters.json")):
+      filter_rows = np.load(os.path.join(path, "filter_rows.npy"))
+      with open(os.path.join(path, "filters.json"), "r") as f:
+        self.filters = {
+          field: {value: filter_rows[start:start + count] for (value, (start, count)) in values.items()}
+          for (field, values) in json.load(f).items()
+        }
+
+    # The same few filter combinations come up again and again, so keep what they resolved to
+    self.resolved = OrderedDict()
+    self.resolved_lock = threading.Lock()
+    self.max_resolved = 256
+
+  def column(self, field: str) -> np.ndarray:
+    """One metadata field for every row (None where missing), built on first use. Only for unindexed fields."""
+    if field not in self.columns:
+      self.columns[field] = np.array([metadata.get(field) for metadata in self.metadatas], dtype=object)
+    return self.columns[field]
+
+  def where_rows(self, where: dict):
+    """
+      Row numbers (sorted) matching a Chroma style `where`, or None for no filter. Supports field equality,
+      `$eq`/`$ne`/`$in`/`$nin` on a field, and `$and`/`$or` of those; several fields in one dict are ANDed.
+    """
+    if not where:
+      return None
+
+    key = json.dumps(where, sort_keys=True)
+    with self.resolved_lock:
+      if key in self.resolved:
+        self.resolved.move_to_end(key)
+        return self.resolved[key]
+
+    rows = self.__rows(where)
+    with self.resolved_lock:
+      self.resolved[key] = rows
+      if len(self.resolved) > self.max_resolved:
+        self.resolved.popitem(last=False)
+    return rows
+
+  def __rows(self, where: dict) -> np.ndarray:
+    clauses = []
+    for (key, value) in where.items():
+      if key == "$and":
+        clauses.append(intersect([self.__rows(clause) for clause in value]))
+      elif key == "$or":
+        clauses.append(union([self.__rows(clause) for clause in value]))
+      else:
+        clauses.append(self.__field_rows(key, value))
+    return intersect(clauses)
+
+  def __field_rows(self, field: str, condition) -> np.ndarray:
+    (op, value) = next(iter(condition.items())) if isinstance(condition, dict) else ("$eq", condition)
+    if op not in ("$eq", "$ne", "$in", "$nin"):
+      raise ValueError(f"Unsupported filter operator {op}")
+    values = value if op in ("$in", "$nin") else [value]
+
+    if field in self.filters:
+      rows = union([self.filters[field].get(filter_key(value), self.all_rows[:0]) for value in values])
+    else:
+      # Not indexed, so scan the field (the export indexes everything create_vector_db.py filters on)
+      rows = np.flatnonzero(np.isin(self.column(field), np.array(values, dtype=object))).astype(np.int32)
+
+    return rows if op in ("$eq", "$in") else np.setdiff1d(self.all_rows, rows, assume_unique=True)
+
+  def distances(self, queries: np.ndarray, similarities: np.ndarray, rows=None) -> np.ndarray:
+    """Chroma's distances, from the cosine `similarities` of `queries` to the (`rows` of the) index."""
+    if self.space == "cosine":
+      return 1 - similarities
+    query_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+    norms = self.norms if rows is None else self.norms[rows]
+    if self.space == "ip":
+      return 1 - similarities * query_norms * norms
+    return query_norms ** 2 + norms ** 2 - 2 * similarities * query_norms * norms
+
+  def search(self, queries, n_results: int, rows=None, shortlist=None) -> list[list[tuple[int, float]]]:
+    """
+      Top `n_results` rows for each query vector, closest first, as (row, score) pairs.
+      Only `rows` (an array of row numbers) can be returned, if given. With a `shortlist` (and a coarse view in the
+      export), the best `shortlist` rows by the coarse view are reranked with every dimension instead.
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    available = self.rows if rows is None else len(rows)
+    k = min(n_results, available)
+    if k <= 0:
+      return [[] for _ in queries]
+
+    if shortlist and self.coarse is not None:
+      (candidates, _) = self.__scan(queries, min(max(shortlist, k), available), rows, self.coarse)
+      return self.__rerank(queries, candidates, k)
+
+    if self.codes is None:
+      (top, scores) = self.__scan(queries, k, rows, self.vectors)
+      return [list(zip(top_rows.tolist(), top_scores.tolist())) for (top_rows, top_scores) in zip(top, scores)]
+
+    # Shortlist from the codes, then score only the shortlist with the full precision vectors
+    (candidates, _) = self.__scan(queries, min(k * self.rescore, available), rows, self.codes)
+    return self.__rerank(queries, candidates, k)
+
+  def __rerank(self, queries: np.ndarray, candidates: np.ndarray, k: int) -> list[list[tuple[int, float]]]:
+    """Top `k` of each query's `candidates` rows by the full precision vectors (read from disk, in row order)."""
+    results = []
+    for (query, query_candidates) in zip(queries, candidates):
+      query_candidates = np.sort(query_candidates)
+      similarities = normalise(query[None]) @ self.vectors[query_candidates].T
+      (top, scores) = top_k(self.distances(query[None], similarities, query_candidates), k)
+      results.append(list(zip(query_candidates[top[0]].tolist(), scores[0].tolist())))
+    return results
+
+  def __scan(self, queries: np.ndarray, k: int, rows, matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Top `k` of `rows` (or every row) for each query by scoring `matrix`: the vectors, their codes or coarse view."""
+    # A filter matching most of the index is cheaper to apply after scoring everything (one pass over contiguous
+    # memory) than by gathering its rows first
+    masked = rows is not None and len(rows) > DENSE_FILTER_FRACTION * self.rows
+    if rows is None or masked:
+      distances = self.distances(queries, self.__similarities(queries, matrix))
+      if masked:
+        excluded = np.ones(self.rows, dtype=bool)
+        excluded[rows] = False
+        distances[:, excluded] = np.inf
+        rows = None
+    else:
+      distances = self.distances(queries, self.__similarities(queries, matrix[rows]), rows)
+
+    (top, scores) = top_k(distances, k)
+    return (top if rows is None else rows[top]), scores
+
+  def __similarities(self, queries: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """Cosine similarities of `queries` to every row of `matrix`, approximate for int8 codes and the coarse view."""
+    if matrix.dtype != np.int8:
+      return prefix(queries, matrix.shape[1]) @ matrix.T
+    scaled = normalise(queries) * self.scales
+    similarities = np.empty((len(queries), len(matrix)), dtype=np.float32)
+    for start in range(0, len(matrix), CODE_BLOCK_ROWS):
+      block = matrix[start:start + CODE_BLOCK_ROWS]
+      similarities[:, start:start + len(block)] = scaled @ block.astype(np.float32).T
+    return similarities
+
+  def query(self, query_embeddings, n_results: int, where=None, shortlist=None) -> list[list[dict]]:
+    """Like `search`, with Chroma's filters, formatted as the {id, metadata, score} dicts `VectorDatabase.query` returns."""
+    hits = self.search(query_embeddings, n_results, self.where_rows(where), shortlist)
+    return [
+      [{"id": self.ids[row], "metadata": self.metadatas[row], "score": score} for (row, score) in query_hits]
+      for query_hits in hits
+    ]
+
+  def query_grouped(
+    self, query_embeddings, n_results: int, group_by: str, aggregate="max", overfetch=4, where=None, shortlist=None
+  ) -> list[list[dict]]:
+    """
+      Like `query`, but returns the best `n_results` distinct values of `group_by` (see `group_hits`), from the top
+      `n_results * overfetch` chunks. A query whose chunks come from too few groups is widened to every matching row,
+      which only costs another pass over memory, so there are always `n_results` groups if the index has them.
+    """
+    rows = self.where_rows(where)
+    available = self.rows if rows is None else len(rows)
+    queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+
+    results = []
+    for (query, hits) in zip(queries, self.search(queries, n_results * overfetch, rows, shortlist)):
+      if len(hits) < available and len({self.metadatas[row].get(group_by) for (row, _) in hits}) < n_results:
+        hits = self.search(query, available, rows, shortlist)[0]
+      hits = [{"id": self.ids[row], "metadata": self.metadatas[row], "score": score} for (row, score) in hits]
+      results.append(group_hits(hits, n_results, group_by, aggregate, self.space))
+    return results
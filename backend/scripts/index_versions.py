@@ -0,0 +1,118 @@
+"""
+Blue/green versions of the vector database.
+
+Rather than one Chroma directory that gets rebuilt in place under the running server, `vector_db` holds
+
+  vector_db/
+    CURRENT                   name of the version being served
+    versions/<version>/       one complete Chroma database each
+      manifest.json           what went into it (files, model, vectors...), written once it's finished
+
+A new index is built into a fresh version directory off to the side, and only once it is complete does `publish`
+point CURRENT at it, by atomically replacing the file, so readers only ever see the old version or the new one.
+`VectorDatabase.reload` then swaps the server over. A `vector_db` without CURRENT is an old single directory
+database, and is served as is.
+
+Doesn't import config/utils, so the backend can use it too (`from scripts.index_versions import ...`).
+"""
+import json
+import os
+import shutil
+import time
+
+CURRENT_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+MANIFEST_FILE = "manifest.json"
+
+
+def version_path(root: str, version: str) -> str:
+  return os.path.join(root, VERSIONS_DIR, version)
+
+
+def new_version(root: str) -> tuple[str, str]:
+  """Name and (created, empty) directory for a new version to build. Names sort by build time."""
+  version = time.strftime("%Y%m%d-%H%M%S")
+  suffix = 0
+  while os.path.exists(version_path(root, version if not suffix else f"{version}-{suffix}")):
+    suffix += 1
+  version = version if not suffix else f"{version}-{suffix}"
+  os.makedirs(version_path(root, version))
+  return version, version_path(root, version)
+
+
+def current_version(root: str):
+  """The version CURRENT points at, or None for a database that isn't versioned (yet)."""
+  try:
+    with open(os.path.join(root, CURRENT_FILE), "r") as f:
+      return f.read().strip() or None
+  except FileNotFoundError:
+    return None
+
+
+def resolve(root: str) -> str:
+  """The Chroma directory to serve: the current version, or `root` itself if it isn't versioned."""
+  version = current_version(root)
+  return version_path(root, version) if version else root
+
+
+def write_manifest(path: str, **info):
+  """Records what went into the version at `path`. Written last, so a version with a manifest is complete."""
+  manifest = {"version": os.path.basename(path), "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), **info}
+  with open(os.path.join(path, MANIFEST_FILE + ".tmp"), "w") as f:
+    json.dump(manifest, f, indent=2)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(os.path.join(path, MANIFEST_FILE + ".tmp"), os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(path: str) -> dict:
+  """The manifest of the version at `path` ({} if it has none, i.e. it's unversioned or was never finished)."""
+  try:
+    with open(os.path.join(path, MANIFEST_FILE), "r") as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {}
+
+
+def list_versions(root: str) -> list[str]:
+  """Every finished version (one with a manifest), oldest first."""
+  versions_dir = os.path.join(root, VERSIONS_DIR)
+  if not os.path.isdir(versions_dir):
+    return []
+  return sorted(
+    version for version in os.listdir(versions_dir)
+    if os.path.exists(os.path.join(versions_dir, version, MANIFEST_FILE))
+  )
+
+
+def publish(root: str, version: str):
+  """Atomically points CURRENT at `version`. Servers pick it up on their next `VectorDatabase.reload`."""
+  if not read_manifest(version_path(root, version)):
+    raise ValueError(f"Version {version} has no manifest, it was never finished building")
+
+  tmp = os.path.join(root, CURRENT_FILE + ".tmp")
+  with open(tmp, "w") as f:
+    f.write(version + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp, os.path.join(root, CURRENT_FILE))
+
+
+def remove_old_versions(root: str, keep=2) -> list[str]:
+  """
+    Deletes all but the newest `keep` finished versions, never the current one, along with any unfinished builds
+    older than them. Returns the versions removed. Keeping at least 2 leaves the previous one to roll back to.
+  """
+  current = current_version(root)
+  finished = list_versions(root)
+  kept = set(finished[-keep:]) | {current}
+  oldest_kept = min(kept - {None}, default="")
+
+  removed = []
+  versions_dir = os.path.join(root, VERSIONS_DIR)
+  for version in sorted(os.listdir(versions_dir)) if os.path.isdir(versions_dir) else []:
+    if version in kept or (version not in finished and version >= oldest_kept):
+      continue
+    shutil.rmtree(os.path.join(versions_dir, version))
+    removed.append(version)
+  return removed
@@ -3,6 +3,7 @@ import json
 import os
 import sys
 from config import CONFIG
+from catalog import iter_courses
 
 # Function to convert Python object to JSON-formatted string if not None
 def json_dumps_or_none(obj):
@@ -11,78 +12,144 @@ def json_dumps_or_none(obj):
 # File path to your JSON data
 # json_file_path = os.path.join(os.path.dirname(__file__), "..", "data", "2252.json")
 
-# Connect to SQLite database (or create it if it doesn't exist)
-conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), "..", "courses.db"))
-cursor = conn.cursor()
-
-# Create table
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS courses (
-    courseID TEXT,
-    termDescription TEXT,
-    sessionDescription TEXT,
-    catalogSchoolDescription TEXT,
-    catalogSubject TEXT,
-    catalogSubjectDescription TEXT,
-    courseDescription TEXT,
-    courseNumber TEXT,
-    courseTitle TEXT,
-    courseNotes TEXT,
-    classLevelAttributeDescription TEXT,
-    classCapacity INTEGER,
-    subjectDescription TEXT,
-    divisionalDistribution TEXT,
-    quantitativeReasoning TEXT,
-    courseComponent TEXT,
-    gradingBasisDescription TEXT,
-    publishedInstructors TEXT,
-    meetings TEXT
-)
-''')
+INSERT_COURSE = '''
+INSERT INTO courses (
+    courseID, termDescription, sessionDescription, catalogSchoolDescription, catalogSubject,
+    catalogSubjectDescription, courseDescription, courseNumber, courseTitle, courseNotes,
+    classLevelAttributeDescription, classCapacity, subjectDescription, divisionalDistribution,
+    quantitativeReasoning, courseComponent, gradingBasisDescription, publishedInstructors, meetings
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def create_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS courses (
+        courseRowID INTEGER PRIMARY KEY,
+        courseID TEXT,
+        termDescription TEXT,
+        sessionDescription TEXT,
+        catalogSchoolDescription TEXT,
+        catalogSubject TEXT,
+        catalogSubjectDescription TEXT,
+        courseDescription TEXT,
+        courseNumber TEXT,
+        courseTitle TEXT,
+        courseNotes TEXT,
+        classLevelAttributeDescription TEXT,
+        classCapacity INTEGER,
+        subjectDescription TEXT,
+        divisionalDistribution TEXT,
+        quantitativeReasoning TEXT,
+        courseComponent TEXT,
+        gradingBasisDescription TEXT,
+        publishedInstructors TEXT,
+        meetings TEXT
+    )
+    ''')
+
+# Full text index over the columns people search courses by. It's an external content table (it stores only the
+# index, and reads the text from `courses`), kept in step with `courses` by triggers, so every insert/delete of a
+# course, including the ones update_incremental.py makes, is indexed without anything else having to know.
+FTS_COLUMNS = [
+    'courseTitle', 'courseDescription', 'publishedInstructors', 'catalogSubjectDescription', 'catalogSubject',
+    'courseNumber'
+]
+
+def add_row_ids(cursor) -> bool:
+    """
+    Gives a courses table from before courseRowID that column, by rebuilding it. Returns whether it had to.
+
+    The index is keyed by it: an INTEGER PRIMARY KEY is the rowid, so it stays put through a VACUUM, where the
+    implicit rowids of a table without one can be renumbered, leaving the index pointing at the wrong courses.
+    """
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(courses)")]
+    if 'courseRowID' in columns:
+        return False
+    cursor.execute("ALTER TABLE courses RENAME TO courses_without_row_ids")
+    create_table(cursor)
+    cursor.execute(
+        f"INSERT INTO courses ({', '.join(columns)}) SELECT {', '.join(columns)} FROM courses_without_row_ids"
+    )
+    # Takes the old index's triggers, which followed it through the rename, with it
+    cursor.execute("DROP TABLE courses_without_row_ids")
+    return True
+
+def create_fts_index(cursor):
+    """Creates the courses_fts index and its triggers, indexing any courses already in the table the first time."""
+    if add_row_ids(cursor):
+        cursor.execute("DROP TABLE IF EXISTS courses_fts")
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'courses_fts'").fetchone()
+    columns = ', '.join(FTS_COLUMNS)
+    new_columns = ', '.join(f'new.{column}' for column in FTS_COLUMNS)
+    old_columns = ', '.join(f'old.{column}' for column in FTS_COLUMNS)
+    # One statement at a time, since executescript would commit whatever transaction the caller has open
+    statements = [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS courses_fts USING fts5(
+            {columns}, content='courses', content_rowid='courseRowID', tokenize='unicode61 remove_diacritics 2'
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS courses_fts_insert AFTER INSERT ON courses BEGIN
+            INSERT INTO courses_fts (rowid, {columns}) VALUES (new.courseRowID, {new_columns});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS courses_fts_delete AFTER DELETE ON courses BEGIN
+            INSERT INTO courses_fts (courses_fts, rowid, {columns}) VALUES ('delete', old.courseRowID, {old_columns});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS courses_fts_update AFTER UPDATE ON courses BEGIN
+            INSERT INTO courses_fts (courses_fts, rowid, {columns}) VALUES ('delete', old.courseRowID, {old_columns});
+            INSERT INTO courses_fts (rowid, {columns}) VALUES (new.courseRowID, {new_columns});
+        END""",
+    ]
+    for statement in statements:
+        cursor.execute(statement)
+    if not exists:
+        cursor.execute("INSERT INTO courses_fts (courses_fts) VALUES ('rebuild')")
 
 # Function to convert list of dictionaries to a JSON array of names
 def json_instructor_names(instructors):
     return json.dumps([instructor['instructorName'] for instructor in instructors]) if instructors else json.dumps([])
 
+def course_row(course):
+    """The values of `course` to insert into the courses table, in `INSERT_COURSE` order."""
+    return (
+        course['courseID'],
+        course['termDescription'],
+        course['sessionDescription'],
+        course['catalogSchoolDescription'],
+        course['catalogSubject'],
+        course['catalogSubjectDescription'],
+        course['courseDescription'],
+        course['courseNumber'],
+        course['courseTitle'],
+        course['courseNotes'],
+        course['classLevelAttributeDescription'],
+        course['classCapacity'],
+        course['subjectDescription'],
+        course['divisionalDistribution'],
+        json_dumps_or_none(course.get('quantitativeReasoning')),
+        course['courseComponent'],
+        course['gradingBasisDescription'],
+        json_instructor_names(course.get('publishedInstructors')),
+        json.dumps(course.get('meetings'))
+    )
+
+def insert_courses(cursor, courses):
+    cursor.executemany(INSERT_COURSE, (course_row(course) for course in courses))
+
+
+if __name__ == "__main__":
+  # Connect to SQLite database (or create it if it doesn't exist)
+  conn = sqlite3.connect(CONFIG.sql_db_path)
+  cursor = conn.cursor()
+
+  # Create table, and the full text index that follows it
+  create_table(cursor)
+  create_fts_index(cursor)
 
-for input_file in CONFIG.raw_input_files:
-  # Read JSON data from file
-  with open(input_file, 'r') as file:
-    data = json.load(file)
-
-    # Insert data into the table
-    for course in data['courses']:
-      cursor.execute('''
-      INSERT INTO courses (
-          courseID, termDescription, sessionDescription, catalogSchoolDescription, catalogSubject,
-          catalogSubjectDescription, courseDescription, courseNumber, courseTitle, courseNotes,
-          classLevelAttributeDescription, classCapacity, subjectDescription, divisionalDistribution,
-          quantitativeReasoning, courseComponent, gradingBasisDescription, publishedInstructors, meetings
-      ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-      ''', (
-          course['courseID'],
-          course['termDescription'],
-          course['sessionDescription'],
-          course['catalogSchoolDescription'],
-          course['catalogSubject'],
-          course['catalogSubjectDescription'],
-          course['courseDescription'],
-          course['courseNumber'],
-          course['courseTitle'],
-          course['courseNotes'],
-          course['classLevelAttributeDescription'],
-          course['classCapacity'],
-          course['subjectDescription'],
-          course['divisionalDistribution'],
-          json_dumps_or_none(course.get('quantitativeReasoning')),
-          course['courseComponent'],
-          course['gradingBasisDescription'],
-          json_instructor_names(course.get('publishedInstructors')),
-          json.dumps(course.get('meetings'))
-      ))
+  for input_file in CONFIG.raw_input_files:
+    # Insert data into the table, streaming the courses out of the file one at a time
+    insert_courses(cursor, iter_courses(input_file))
 
     # Commit change
     conn.commit()
 
-# close connection
-conn.close()
\ No newline at end of file
+  # close connection
+  conn.close()
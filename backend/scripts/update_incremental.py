@@ -0,0 +1,192 @@
+"""
+Incremental update of the vector database and courses.db from a new copy of a term's catalog.
+
+Compares the new catalog with the snapshot taken the last time the term was ingested, by courseID and
+content fingerprint, then only:
+  - re-chunks and re-embeds courses that were added, or whose embedded fields changed,
+  - rewrites the courses.db rows of courses that changed in any way,
+  - deletes the vectors and rows of courses that were removed,
+and finally saves the new snapshot. After a full rebuild, run once with --init to record the baseline.
+
+  python update_incremental.py --term fall24
+  python update_incremental.py --term spring25 --catalog ../data/2252_new.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import chromadb
+from config import CONFIG
+from catalog import iter_courses
+from create_embeddings import DATA, Embedder, client
+from index_versions import resolve
+from create_vector_db import course_wheres, delete_ids, get_collection, iter_batches, matching_ids, refresh_exact_index
+from to_sql import create_fts_index, create_table, insert_courses
+
+# Every field `embed_course_v3` reads. A change to anything else only needs the SQL row rewriting.
+EMBEDDED_FIELDS = [
+  "courseDescription",
+  "termDescription",
+  "catalogSubject",
+  "catalogSubjectDescription",
+  "courseNumber",
+  "courseTitle",
+  "classLevelAttributeDescription",
+  "crossRegistrationEligibleAttribute",
+  "divisionalDistribution",
+  "quantitativeReasoning",
+  "publishedInstructors",
+  "meetings",
+]
+
+
+def fingerprint(value) -> str:
+  return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def course_fingerprints(course) -> dict:
+  """Fingerprints of the whole course (for courses.db) and of just the fields that end up in its embeddings."""
+  return {
+    "row": fingerprint(course),
+    "embedded": fingerprint({field: course.get(field) for field in EMBEDDED_FIELDS}),
+    "termDescription": course["termDescription"],
+  }
+
+
+def snapshot_file(term: str) -> str:
+  return os.path.join(CONFIG.snapshot_path, f"{term}.json")
+
+
+def load_snapshot(term: str) -> dict:
+  """courseID -> fingerprints, as of the last ingestion of `term`. Empty if it was never snapshotted."""
+  path = snapshot_file(term)
+  if not os.path.exists(path):
+    return {}
+  with open(path, "r") as f:
+    return json.load(f)
+
+
+def save_snapshot(term: str, snapshot: dict):
+  """Writes the snapshot via a temporary file, so a crash never leaves a half written one behind."""
+  os.makedirs(CONFIG.snapshot_path, exist_ok=True)
+  path = snapshot_file(term)
+  with open(path + ".tmp", "w") as f:
+    json.dump(snapshot, f)
+  os.replace(path + ".tmp", path)
+
+
+def diff_catalog(courses, snapshot: dict) -> dict:
+  """
+    Splits the courses of a new catalog (any iterable of course dicts) against the last snapshot.
+    Returns the new snapshot, along with lists of courses that were `added`, changed in embedded fields
+    (`reembed`), or only changed elsewhere (`rewrite`), and the snapshot entries of courses that were `removed`.
+  """
+  new_snapshot = {}
+  added, reembed, rewrite = [], [], []
+
+  for course in courses:
+    course_id = str(course["courseID"])
+    prints = course_fingerprints(course)
+    new_snapshot[course_id] = prints
+    old = snapshot.get(course_id)
+
+    if old is None:
+      added.append(course)
+    elif old["embedded"] != prints["embedded"]:
+      reembed.append(course)
+    elif old["row"] != prints["row"]:
+      rewrite.append(course)
+
+  removed = {course_id: old for (course_id, old) in snapshot.items() if course_id not in new_snapshot}
+  return {"snapshot": new_snapshot, "added": added, "reembed": reembed, "rewrite": rewrite, "removed": removed}
+
+
+def apply_to_vector_db(collection, embeddings: dict, stale: dict, batch_size=5000):
+  """
+    Upserts the new `embeddings` under their stable chunk ids, then deletes whatever else is stored for the `stale`
+    courses (courseID -> termDescription): removed courses, chunks a re-embedded course no longer has, and ids
+    from older loads. Changed courses are overwritten in place, so they never disappear from search meanwhile.
+  """
+  written = set()
+  for (ids, vectors, metadatas) in iter_batches(embeddings.items(), batch_size):
+    collection.upsert(ids=ids, embeddings=vectors, metadatas=metadatas)
+    written.update(ids)
+
+  stale_ids = [
+    id for (course_id, term_description) in stale.items() for where in course_wheres(course_id, term_description)
+    for id in matching_ids(collection, where, batch_size) if id not in written
+  ]
+  delete_ids(collection, stale_ids, batch_size)
+
+
+def apply_to_sql(con, courses: list[dict], stale: dict):
+  """Deletes the rows of `stale` courses (courseID -> termDescription) and inserts `courses`, in one transaction."""
+  with con:
+    cursor = con.cursor()
+    create_table(cursor)
+    create_fts_index(cursor)
+    cursor.executemany(
+      "DELETE FROM courses WHERE courseID = ? AND termDescription IS ?",
+      list(stale.items())
+    )
+    insert_courses(cursor, courses)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--term", required=True, choices=DATA.keys())
+  parser.add_argument("--catalog", help="path of the new catalog, defaults to the term's usual data file")
+  parser.add_argument("--init", action="store_true", help="only record the catalog as the ingested baseline")
+  args = parser.parse_args()
+
+  # Streamed, so only the courses that need re-embedding or rewriting are ever held in memory
+  old = load_snapshot(args.term)
+  diff = diff_catalog(iter_courses(args.catalog or DATA[args.term]), old)
+  if args.init:
+    save_snapshot(args.term, diff["snapshot"])
+    print(f"Recorded {len(diff['snapshot'])} courses as the {args.term} baseline")
+    raise SystemExit(0)
+
+  print(
+    f"{args.term}: {len(diff['added'])} added, {len(diff['reembed'])} re-embedded, "
+    f"{len(diff['rewrite'])} rewritten, {len(diff['removed'])} removed"
+  )
+
+  # Embed first: if that fails, nothing has been touched yet
+  embedder = Embedder(
+    input_data=DATA,
+    output_path=os.path.join(os.path.dirname(__file__), "..", "embeddings"),
+    sample_output_path=os.path.join(os.path.dirname(__file__), "..", "embeddings", "samples"),
+    client=client,
+    max_in_flight=8,
+    cache_path=CONFIG.embedding_cache_path
+  )
+  embeddings = embedder.embed_courses_v3(diff["added"] + diff["reembed"])
+
+  # Old vectors/rows to drop, keyed by courseID with the term they were stored under
+  reembed_stale = {str(c["courseID"]): old[str(c["courseID"])]["termDescription"] for c in diff["reembed"]}
+  rewrite_stale = {str(c["courseID"]): old[str(c["courseID"])]["termDescription"] for c in diff["rewrite"]}
+  removed_stale = {course_id: prints["termDescription"] for (course_id, prints) in diff["removed"].items()}
+
+  # Into the version being served, in place (upserts by stable id, so it never drops out of search)
+  db_path = resolve(CONFIG.vector_db_path)
+  chroma_client = chromadb.PersistentClient(path=db_path)
+  course_collection = get_collection(chroma_client)
+  apply_to_vector_db(
+    course_collection,
+    embeddings,
+    {**reembed_stale, **removed_stale},
+    batch_size=chroma_client.get_max_batch_size()
+  )
+  refresh_exact_index(course_collection, db_path)
+
+  with sqlite3.connect(CONFIG.sql_db_path) as con:
+    apply_to_sql(
+      con,
+      diff["added"] + diff["reembed"] + diff["rewrite"],
+      {**reembed_stale, **rewrite_stale, **removed_stale}
+    )
+
+  save_snapshot(args.term, diff["snapshot"])
+  print(f"Applied {args.term} delta, snapshot saved to {snapshot_file(args.term)}")